@@ -0,0 +1,190 @@
+"""
+Shared HTTP client for Puploader's external API wrappers (PetFinder, Charity Navigator).
+
+Concurrent identical GETs are coalesced into a single in-flight call, outbound calls are held to a
+token-bucket budget, and 429/503 responses are retried honoring Retry-After with jittered backoff.
+"""
+import email.utils
+import json
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional
+import requests
+from requests.adapters import HTTPAdapter
+from metrics.metrics import span
+
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class ApiError(Exception):
+    """
+    Raised when an external API call fails, carrying enough detail to log or render.
+    """
+
+    def __init__(self, message: str, status_code: Optional[int] = None, url: Optional[str] = None,
+                 body: Optional[str] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.url = url
+        self.body = body
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_response(cls, response: requests.Response, message: Optional[str] = None):
+        """Build an error describing an unsuccessful response."""
+        return cls(message or f'{response.request.method} {response.url} returned {response.status_code}',
+                   status_code=response.status_code, url=response.url, body=response.text[:500],
+                   retry_after=parse_retry_after(response.headers.get('Retry-After')))
+
+
+class RateLimitError(ApiError):
+    """
+    Raised when an API (or our own outbound budget) asks us to back off for longer than we will wait.
+    """
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given either as seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` calls per second with bursts of up to `capacity`.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Take a token, waiting up to `timeout` seconds (forever if None) for one to become available."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls sharing a key so only one of them runs; the rest wait for its result.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Dict[str, Any]] = {}
+
+    def do(self, key: Hashable, function: Callable[[], Any]) -> Any:
+        """Run `function` unless a call with the same key is already in flight, then share its outcome."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+
+        if not leader:
+            call['done'].wait()
+        else:
+            try:
+                call['result'] = function()
+            except BaseException as exc:
+                call['error'] = exc
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call['done'].set()
+
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
+
+
+class ApiClient:
+    """
+    Pooled, rate-limited HTTP client with request coalescing and retries.
+    """
+
+    def __init__(self, rate: float = 5, burst: float = 10, max_retries: int = 3, backoff: float = 0.5,
+                 max_backoff: float = 30, timeout: float = 10, pool_size: int = 10, name: str = 'http'):
+        self.name = name
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self.session = requests.session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.bucket = TokenBucket(rate, burst)
+        self.flights = SingleFlight()
+
+    def _delay(self, attempt: int, retry_after: Optional[float]) -> float:
+        """Seconds to wait before retry number `attempt` - Retry-After if given, else full-jitter backoff."""
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a request, retrying transient failures. Raises ApiError if it never succeeds."""
+        with span(f'api.{self.name}'):
+            return self._send_with_retries(method, url, **kwargs)
+
+    def _send_with_retries(self, method: str, url: str, **kwargs) -> requests.Response:
+        for attempt in range(self.max_retries + 1):
+            if not self.bucket.acquire(timeout=self.max_backoff):
+                raise RateLimitError(f'Outbound rate limit exceeded for {url}', url=url)
+
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except requests.RequestException as exc:
+                if attempt == self.max_retries:
+                    raise ApiError(f'{method} {url} failed: {exc}', url=url) from exc
+                time.sleep(self._delay(attempt, None))
+                continue
+
+            if response.status_code not in RETRY_STATUSES:
+                return response
+
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if attempt == self.max_retries or (retry_after or 0) > self.max_backoff:
+                error = RateLimitError if response.status_code == 429 else ApiError
+                raise error.from_response(response)
+            time.sleep(self._delay(attempt, retry_after))
+
+        raise ApiError(f'{method} {url} failed', url=url)
+
+    def get(self, url: str, params: Optional[Dict] = None, headers: Optional[Dict] = None) -> requests.Response:
+        """GET a URL, sharing the response with any identical GET already in flight."""
+        key = ('GET', url, json.dumps(params or {}, sort_keys=True, default=str),
+               json.dumps(headers or {}, sort_keys=True))
+        return self.flights.do(key, lambda: self._send('GET', url, params=params, headers=headers))
+
+    def post(self, url: str, data: Optional[Dict] = None, headers: Optional[Dict] = None) -> requests.Response:
+        """POST to a URL - Never coalesced."""
+        return self._send('POST', url, data=data, headers=headers)
@@ -1,44 +1,168 @@
 """
 Puploader's app factory. Primarily called from run.py in order to execute the application.
 """
+import io
 import os
+from typing import Any, Dict, Optional
 from flask import Flask
-import pymongo
+from caching.pages import init_page_cache
+from caching.result_cache import init_result_cache
+from catalog.catalog import get_catalog, init_catalog
+from catalog.eviction import init_eviction
+from catalog.similarity import init_similarity
+from db import init_db
+from imaging.phash import dhash
+from imaging.thumbnails import S3_VARIANT_PREFIX, init_pipeline, variant_names
+from jobs.queue import get_jobs, init_jobs, worker_config
+from metrics.metrics import init_metrics
+from security.oidc import init_oidc
+from security.passwords import init_hasher
+from storage.disk_cache import cached_s3_object, get_s3_cache, init_s3_cache
+from storage.s3 import download_object, get_listing
+from user import init_user_cache
 from views.auth import auth
 from views.photos import photos
 from views.resources import resources
+from views.uploads import compress_static, init_static, uploads
 
 
-def create_app():
+def create_app(config: Optional[Dict[str, Any]] = None):
     """App factory - Returns base application configured based on ./cfg file.
 
+    Settings from the file named by $PUPLOADER_SETTINGS, then from `config`, override the .cfg
+    file - e.g. to point the app at local stand-ins. Either makes a missing .cfg file acceptable.
+
+    Args:
+        config (Dict): Settings applied last.
+
     Returns:
-        Base application, petfinder_api instance, and MongoDB connection.
+        Base application and its shared MongoDB handle.
     """
     app = Flask(__name__)
 
     app.register_blueprint(auth, url_prefix='/')
     app.register_blueprint(photos, url_prefix='/')
     app.register_blueprint(resources, url_prefix='/')
+    app.register_blueprint(uploads, url_prefix='/')
 
     try:
         app.config.from_pyfile('./config/development.cfg')
     except FileNotFoundError:
-        app.config.from_pyfile('./config/production.cfg')
+        app.config.from_pyfile('./config/production.cfg',
+                               silent=config is not None or 'PUPLOADER_SETTINGS' in os.environ)
+
+    app.config.from_envvar('PUPLOADER_SETTINGS', silent=True)
+    if config:
+        app.config.update(config)
 
     if os.environ.get('SECRET_KEY'):
         app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
 
+    init_metrics(app)
+
     if not os.path.exists(app.config['UPLOAD_FOLDER']):
         os.mkdir(app.config['UPLOAD_FOLDER'])
 
-    if app.config['MONGODB_URI']:
-        mongo_uri = app.config['MONGODB_URI']
-    else:
-        mongo_uri = os.environ.get('MONGODB_URI')
+    init_static(app)
+
+    @app.cli.command('compress-static')
+    def compress_static_files():
+        """Precompress static assets for WhiteNoise - Already-compressed formats are skipped."""
+        print(f'Compressed {compress_static(app)} static files.')
+
+    catalog = init_catalog(app)
+    init_eviction(app, catalog)
+
+    @app.cli.command('rebuild-catalog')
+    def rebuild_catalog():
+        """Re-index UPLOAD_FOLDER from disk."""
+        print(f'Catalogued {get_catalog().rebuild()} photos.')
+
+    init_similarity(app)
+
+    @app.cli.command('backfill-phashes')
+    def backfill_phashes():
+        """Compute perceptual hashes for every catalogued photo (or recorded S3 object) missing one."""
+        catalog, hashed, failed = get_catalog(), 0, 0
+        for photo in catalog.missing_phashes():
+            try:
+                catalog.set_phash(photo['folder'], photo['name'],
+                                  dhash(os.path.join(catalog.folder_path(photo['folder']), photo['name'])))
+                hashed += 1
+            except (OSError, ValueError) as exc:
+                print(f"Could not hash {photo['folder']}/{photo['name']}: {exc}")
+                failed += 1
+
+        if app.config['S3_BUCKET']:
+            listing, cache = get_listing(app.config['S3_BUCKET']), get_s3_cache()
+            for key in catalog.s3_objects_missing_phashes():
+                obj = listing.lookup(key)
+                if obj is None:
+                    continue
+                try:
+                    if cache is not None:
+                        source = cached_s3_object(cache, listing, obj)
+                    else:
+                        source = io.BytesIO()
+                        download_object(listing, key, obj['etag'], source)
+                        source.seek(0)
+                    catalog.set_s3_phash(key, dhash(source))
+                    hashed += 1
+                except Exception as exc:
+                    print(f'Could not hash {key}: {exc}')
+                    failed += 1
+
+        print(f'Hashed {hashed} photos ({failed} failed).')
+
+    init_result_cache(app)
+    init_page_cache(app)
+    init_s3_cache(app)
+
+    @app.cli.command('s3-cache-status')
+    def s3_cache_status():
+        """Show how many S3 objects the local disk cache holds and how much space they take."""
+        cache = get_s3_cache()
+        if cache is None:
+            print('The S3 disk cache is disabled.')
+        else:
+            print(', '.join(f'{name}: {value}' for name, value in cache.stats().items()))
+
+    pipeline = init_pipeline(app)
+
+    @app.cli.command('backfill-variants')
+    def backfill_variants():
+        """Generate thumbnail/WebP variants for every photo that is missing them."""
+        if app.config['S3_BUCKET']:
+            listing = get_listing(app.config['S3_BUCKET'])
+            keys = {obj['key'] for obj in listing.list()}
+            futures = [pipeline.submit_s3(listing, key) for key in keys
+                       if not key.startswith(S3_VARIANT_PREFIX)
+                       and S3_VARIANT_PREFIX + variant_names(key)['thumb'] not in keys]
+        else:
+            catalog = get_catalog()
+            futures = [pipeline.submit_local(catalog, photo['folder'], photo['name'])
+                       for photo in catalog.missing_variants()]
+
+        pipeline.shutdown()
+        failed = sum(1 for future in futures if future.exception() is not None)
+        print(f'Generated variants for {len(futures) - failed} photos ({failed} failed).')
+
+    init_jobs(app)
+
+    @app.cli.command('jobs-status')
+    def jobs_status():
+        """Show how many post-upload jobs are queued, running, done and failed."""
+        print(', '.join(f'{status}: {count}' for status, count in get_jobs().stats().items()))
+
+    @app.cli.command('run-jobs')
+    def run_jobs():
+        """Run a job worker in the foreground - For deployments that don't serve requests from this host."""
+        from jobs.worker import run_worker
+        run_worker(worker_config(app))
 
-    client = pymongo.MongoClient(mongo_uri, 27017)
-    database = client['AUTH']
-    users = database['USERS']
+    database = init_db(app)
+    init_user_cache(app)
+    init_hasher(app)
+    init_oidc(app)
 
-    return app, users
+    return app, database
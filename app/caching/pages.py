@@ -0,0 +1,92 @@
+"""
+Conditional GET and rendered-fragment caching for pages that only change when storage does.
+
+Page ETags are derived from the catalog's storage version, so a revisit to an unchanged gallery
+is answered with a 304 before anything is listed or rendered. Rendered photo grids are cached
+per process under the same version.
+"""
+import hashlib
+import os
+import time
+from typing import Callable, Dict, Hashable
+from flask import current_app, make_response, render_template, request, session
+from markupsafe import Markup
+from caching.lru import BoundedTTLCache
+from catalog.catalog import get_catalog
+
+
+class PageCache:
+    """
+    Storage-versioned ETags and an LRU of rendered template fragments.
+    """
+
+    def __init__(self, template_folder: str, max_fragments: int = 256, fragment_ttl: float = 3600,
+                 s3_listing_ttl: float = 60):
+        self.s3_listing_ttl = s3_listing_ttl
+        self.template_fingerprint = self._fingerprint(template_folder)
+        self.fragments = BoundedTTLCache(maxsize=max_fragments, ttl=fragment_ttl)
+
+    @staticmethod
+    def _fingerprint(template_folder: str) -> str:
+        """Digest of the templates on disk, so a deploy that changes them changes every ETag."""
+        digest = hashlib.sha1()
+        for root, _, names in sorted(os.walk(template_folder)):
+            for name in sorted(names):
+                stat = os.stat(os.path.join(root, name))
+                digest.update(f'{root}/{name}:{stat.st_size}:{stat.st_mtime_ns};'.encode('utf-8'))
+        return digest.hexdigest()[:12]
+
+    def storage_version(self) -> str:
+        """Current storage version.
+
+        Public instances can gain objects behind our back (browser uploads straight to S3), so their
+        version also rolls over once per listing TTL - The same staleness the listing cache allows.
+        """
+        version = str(get_catalog().version())
+        if current_app.config['S3_BUCKET']:
+            version += f'.{int(time.time() // max(self.s3_listing_ttl, 1))}'
+        return version
+
+    def etag(self, page: str) -> str:
+        """ETag for `page` as the current visitor would see it."""
+        parts = (page, self.storage_version(), self.template_fingerprint, 'username' in session)
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:20]
+
+    def fragment(self, template: str, key: Hashable, load: Callable[[], Dict]) -> Markup:
+        """Render `template` with the context returned by `load`, reusing it while storage is unchanged."""
+        cache_key = (template, key, self.storage_version(), self.template_fingerprint)
+        html = self.fragments.get(cache_key)
+        if html is None:
+            html = Markup(render_template(template, **load()))
+            self.fragments.set(cache_key, html)
+        return html
+
+
+def cached_page(page: str, render: Callable[[], str]):
+    """Respond with `render()` tagged with the page's ETag, or with a 304 if the client already has it."""
+    etag = get_page_cache().etag(page)
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
+def init_page_cache(app) -> PageCache:
+    """Attach a PageCache configured from the app to it."""
+    cache = PageCache(os.path.join(app.root_path, app.template_folder),
+                      max_fragments=app.config.get('PAGE_FRAGMENT_CACHE_SIZE', 256),
+                      fragment_ttl=app.config.get('PAGE_FRAGMENT_CACHE_TTL', 3600),
+                      s3_listing_ttl=app.config.get('S3_LISTING_TTL', 60))
+    app.extensions['page_cache'] = cache
+    return cache
+
+
+def get_page_cache() -> PageCache:
+    """Return the current app's page cache."""
+    return current_app.extensions['page_cache']
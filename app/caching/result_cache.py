@@ -0,0 +1,168 @@
+"""
+Two-tier cache for results of slow external lookups (PetFinder, Charity Navigator).
+
+Entries are fresh for `ttl` seconds, then served stale for up to `stale_ttl` more while a background
+thread refreshes them. A SQLite file backs the in-memory tier so warm entries survive restarts.
+Lookups are counted on /metrics as cache 'api', by result ('hit', 'stale' or 'miss').
+"""
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+from flask import current_app
+from caching.lru import BoundedTTLCache
+from metrics.metrics import record_cache
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    fresh_until REAL NOT NULL,
+    stale_until REAL NOT NULL
+);
+"""
+
+# Result label each lookup counter is exported under on /metrics, as cache 'api'.
+_LOOKUP_RESULTS = {'hits': 'hit', 'stale_hits': 'stale', 'misses': 'miss'}
+
+
+def cache_key(endpoint: str, params: Dict) -> str:
+    """Build a stable key from an endpoint and its params, ignoring case, whitespace and unset values."""
+    normalized = {name: value.strip().lower() if isinstance(value, str) else value
+                  for name, value in params.items() if value not in (None, '')}
+    return f'{endpoint}?{json.dumps(normalized, sort_keys=True)}'
+
+
+class ResultCache:
+    """
+    Bounded result cache keyed by (endpoint, normalized params) with stale-while-revalidate refreshes.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, max_entries: int = 512,
+                 ttl: float = 600, stale_ttl: float = 3600):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+        self._memory = BoundedTTLCache(maxsize=max_entries)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self.counters = {'hits': 0, 'stale_hits': 0, 'disk_hits': 0, 'misses': 0,
+                         'refreshes': 0, 'refresh_errors': 0}
+
+        if self.db_path:
+            self._connect().executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection to the disk tier, reopening it after a fork."""
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.conn = sqlite3.connect(self.db_path, timeout=30)
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def _count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+        if counter in _LOOKUP_RESULTS:
+            record_cache('api', _LOOKUP_RESULTS[counter])
+
+    def _load(self, key: str) -> Optional[tuple]:
+        """Look an entry up in memory, then on disk."""
+        entry = self._memory.get(key)
+        if entry is not None or not self.db_path:
+            return entry
+
+        row = self._connect().execute('SELECT value, fresh_until, stale_until FROM results WHERE key = ?',
+                                      (key,)).fetchone()
+        if row is None or row[2] <= time.time():
+            return None
+
+        entry = (json.loads(row[0]), row[1], row[2])
+        self._memory.set(key, entry, ttl=row[2] - time.time())
+        self._count('disk_hits')
+        return entry
+
+    def _store(self, key: str, value: Any, ttl: float, stale_ttl: float):
+        now = time.time()
+        entry = (value, now + ttl, now + ttl + stale_ttl)
+        self._memory.set(key, entry, ttl=ttl + stale_ttl)
+
+        if self.db_path:
+            with self._connect() as conn:
+                conn.execute('INSERT OR REPLACE INTO results (key, value, fresh_until, stale_until) '
+                             'VALUES (?, ?, ?, ?)', (key, json.dumps(value), entry[1], entry[2]))
+
+    def _refresh(self, key: str, fetch: Callable[[], Any], ttl: float, stale_ttl: float):
+        """Re-fetch a stale entry, keeping the stale value if the fetch fails."""
+        try:
+            value = fetch()
+            if value is not None:
+                self._store(key, value, ttl, stale_ttl)
+                self._count('refreshes')
+            else:
+                self._count('refresh_errors')
+        except Exception as exc:
+            print(f'Error refreshing {key}: ', exc)
+            self._count('refresh_errors')
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def get_or_fetch(self, endpoint: str, params: Dict, fetch: Callable[[], Any],
+                     ttl: Optional[float] = None, stale_ttl: Optional[float] = None) -> Any:
+        """Return the cached result for (endpoint, params), calling `fetch` only on a miss.
+
+        Stale results are returned immediately while `fetch` runs in the background. Results of None
+        are never cached. Callers get their own copy of the value and may mutate it freely.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        stale_ttl = self.stale_ttl if stale_ttl is None else stale_ttl
+        key = cache_key(endpoint, params)
+
+        entry = self._load(key)
+        if entry is not None:
+            value, fresh_until, _ = entry
+            if time.time() < fresh_until:
+                self._count('hits')
+            else:
+                self._count('stale_hits')
+                with self._lock:
+                    start_refresh = key not in self._refreshing
+                    self._refreshing.add(key)
+                if start_refresh:
+                    threading.Thread(target=self._refresh, args=(key, fetch, ttl, stale_ttl), daemon=True).start()
+            return copy.deepcopy(value)
+
+        self._count('misses')
+        value = fetch()
+        if value is not None:
+            self._store(key, value, ttl, stale_ttl)
+        return copy.deepcopy(value)
+
+    def stats(self) -> Dict[str, int]:
+        """Snapshot of the hit/miss counters."""
+        with self._lock:
+            return dict(self.counters, entries=len(self._memory))
+
+
+def init_result_cache(app) -> ResultCache:
+    """Attach a ResultCache configured from the app to it."""
+    db_path = app.config.get('API_CACHE_PATH', os.path.join(app.instance_path, 'api_cache.sqlite3'))
+    if db_path:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+    cache = ResultCache(db_path=db_path,
+                        max_entries=app.config.get('API_CACHE_SIZE', 512),
+                        ttl=app.config.get('API_CACHE_TTL', 600),
+                        stale_ttl=app.config.get('API_CACHE_STALE_TTL', 3600))
+    app.extensions['api_cache'] = cache
+    return cache
+
+
+def get_result_cache() -> ResultCache:
+    """Return the current app's result cache."""
+    return current_app.extensions['api_cache']
@@ -0,0 +1,492 @@
+"""
+Persistent index of the photos stored under Puploader's UPLOAD_FOLDER.
+
+The catalog lives in a small SQLite database shared by every gunicorn worker on the host,
+so views can answer "which photos are in this folder?" without listing the filesystem.
+"""
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+from flask import current_app
+from imaging.phash import from_db, to_db
+from imaging.thumbnails import VARIANT_DIR, variant_names
+
+PHOTO_EXTENSIONS = {'gif', 'jpg', 'jpeg', 'png'}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS photos (
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (folder, name)
+);
+CREATE INDEX IF NOT EXISTS photos_by_mtime ON photos (folder, mtime);
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    parent TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS s3_objects (
+    key TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS s3_objects_by_sha256 ON s3_objects (sha256);
+CREATE TABLE IF NOT EXISTS folder_stats (
+    folder TEXT PRIMARY KEY,
+    count INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0
+);
+CREATE TRIGGER IF NOT EXISTS photos_stats_insert AFTER INSERT ON photos BEGIN
+    INSERT INTO folder_stats (folder, count, bytes) VALUES (NEW.folder, 1, NEW.size)
+        ON CONFLICT (folder) DO UPDATE SET count = count + 1, bytes = bytes + excluded.bytes;
+END;
+CREATE TRIGGER IF NOT EXISTS photos_stats_delete AFTER DELETE ON photos BEGIN
+    UPDATE folder_stats SET count = count - 1, bytes = bytes - OLD.size WHERE folder = OLD.folder;
+END;
+CREATE TRIGGER IF NOT EXISTS photos_stats_update AFTER UPDATE OF folder, size ON photos BEGIN
+    UPDATE folder_stats SET count = count - 1, bytes = bytes - OLD.size WHERE folder = OLD.folder;
+    INSERT INTO folder_stats (folder, count, bytes) VALUES (NEW.folder, 1, NEW.size)
+        ON CONFLICT (folder) DO UPDATE SET count = count + 1, bytes = bytes + excluded.bytes;
+END;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('storage_version', 0);
+CREATE TRIGGER IF NOT EXISTS folders_version_insert AFTER INSERT ON folders BEGIN
+    UPDATE meta SET value = value + 1 WHERE key = 'storage_version';
+END;
+CREATE TRIGGER IF NOT EXISTS folders_version_delete AFTER DELETE ON folders BEGIN
+    UPDATE meta SET value = value + 1 WHERE key = 'storage_version';
+END;
+CREATE TRIGGER IF NOT EXISTS s3_objects_version_insert AFTER INSERT ON s3_objects BEGIN
+    UPDATE meta SET value = value + 1 WHERE key = 'storage_version';
+END;
+CREATE TRIGGER IF NOT EXISTS s3_objects_version_delete AFTER DELETE ON s3_objects BEGIN
+    UPDATE meta SET value = value + 1 WHERE key = 'storage_version';
+END;
+"""
+
+# Columns added after the initial schema, per table - Created on existing catalogs at startup.
+_ADDED_COLUMNS = {
+    'photos': {
+        'has_variants': 'INTEGER NOT NULL DEFAULT 0',
+        'sha256': 'TEXT',
+        'atime': 'REAL',
+        'width': 'INTEGER',
+        'height': 'INTEGER',
+        'taken_at': 'REAL',
+        'phash': 'INTEGER',
+        'similar_to': 'TEXT',
+    },
+    's3_objects': {
+        'phash': 'INTEGER',
+        'similar_to': 'TEXT',
+    },
+}
+
+# Indexes over added columns, created once the columns exist.
+_ADDED_INDEXES = """
+CREATE INDEX IF NOT EXISTS photos_by_sha256 ON photos (sha256);
+CREATE INDEX IF NOT EXISTS photos_by_atime ON photos (folder, atime);
+CREATE INDEX IF NOT EXISTS photos_by_global_mtime ON photos (mtime);
+CREATE INDEX IF NOT EXISTS photos_by_global_atime ON photos (atime);
+CREATE INDEX IF NOT EXISTS photos_by_similar_to ON photos (similar_to);
+CREATE INDEX IF NOT EXISTS s3_objects_by_similar_to ON s3_objects (similar_to);
+"""
+
+# Any change to what a page of photos shows bumps the storage version - Access times don't.
+_VERSION_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS photos_version_insert AFTER INSERT ON photos BEGIN
+    UPDATE meta SET value = value + 1 WHERE key = 'storage_version';
+END;
+CREATE TRIGGER IF NOT EXISTS photos_version_delete AFTER DELETE ON photos BEGIN
+    UPDATE meta SET value = value + 1 WHERE key = 'storage_version';
+END;
+CREATE TRIGGER IF NOT EXISTS photos_version_update
+AFTER UPDATE OF folder, name, size, mtime, has_variants, sha256 ON photos BEGIN
+    UPDATE meta SET value = value + 1 WHERE key = 'storage_version';
+END;
+"""
+
+# Every change to a perceptual hash is appended to phash_log, so similarity indexes can catch up
+# incrementally - A NULL phash means the path no longer has one.
+_PHASH_LOG = """
+CREATE TABLE IF NOT EXISTS phash_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    phash INTEGER
+);
+CREATE TRIGGER IF NOT EXISTS photos_phash_insert AFTER INSERT ON photos WHEN NEW.phash IS NOT NULL BEGIN
+    INSERT INTO phash_log (path, phash)
+        VALUES (CASE NEW.folder WHEN '' THEN NEW.name ELSE NEW.folder || '/' || NEW.name END, NEW.phash);
+END;
+CREATE TRIGGER IF NOT EXISTS photos_phash_delete AFTER DELETE ON photos WHEN OLD.phash IS NOT NULL BEGIN
+    INSERT INTO phash_log (path, phash)
+        VALUES (CASE OLD.folder WHEN '' THEN OLD.name ELSE OLD.folder || '/' || OLD.name END, NULL);
+END;
+CREATE TRIGGER IF NOT EXISTS photos_phash_update AFTER UPDATE OF folder, name, phash ON photos
+WHEN OLD.phash IS NOT NULL OR NEW.phash IS NOT NULL BEGIN
+    INSERT INTO phash_log (path, phash)
+        VALUES (CASE OLD.folder WHEN '' THEN OLD.name ELSE OLD.folder || '/' || OLD.name END, NULL);
+    INSERT INTO phash_log (path, phash)
+        VALUES (CASE NEW.folder WHEN '' THEN NEW.name ELSE NEW.folder || '/' || NEW.name END, NEW.phash);
+END;
+CREATE TRIGGER IF NOT EXISTS s3_objects_phash_insert AFTER INSERT ON s3_objects WHEN NEW.phash IS NOT NULL BEGIN
+    INSERT INTO phash_log (path, phash) VALUES (NEW.key, NEW.phash);
+END;
+CREATE TRIGGER IF NOT EXISTS s3_objects_phash_delete AFTER DELETE ON s3_objects WHEN OLD.phash IS NOT NULL BEGIN
+    INSERT INTO phash_log (path, phash) VALUES (OLD.key, NULL);
+END;
+CREATE TRIGGER IF NOT EXISTS s3_objects_phash_update AFTER UPDATE OF phash ON s3_objects BEGIN
+    INSERT INTO phash_log (path, phash) VALUES (NEW.key, NEW.phash);
+END;
+"""
+
+# Columns photos can be evicted by, oldest first.
+EVICTION_ORDERS = {'upload': 'mtime', 'access': 'atime'}
+
+
+def is_photo(name: str) -> bool:
+    """Return True if the given filename looks like an uploadable photo."""
+    stem, dot, extension = name.rpartition('.')
+    return bool(stem and dot) and not name.startswith('.') and extension.lower() in PHOTO_EXTENSIONS
+
+
+class PhotoCatalog:
+    """
+    SQLite-backed catalog of photos keyed by folder.
+
+    Folders are stored relative to the base path - '' is the base upload folder itself.
+    """
+
+    def __init__(self, db_path: str, base_path: str):
+        self.db_path = db_path
+        self.base_path = base_path
+        self._local = threading.local()
+
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(_SCHEMA)
+        with conn:
+            for table, columns in _ADDED_COLUMNS.items():
+                existing = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+                for column, definition in columns.items():
+                    if column not in existing:
+                        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            conn.execute('UPDATE photos SET atime = mtime WHERE atime IS NULL')
+            if conn.execute('SELECT 1 FROM folder_stats LIMIT 1').fetchone() is None:
+                conn.execute('INSERT INTO folder_stats (folder, count, bytes) '
+                             'SELECT folder, COUNT(*), SUM(size) FROM photos GROUP BY folder')
+        conn.executescript(_ADDED_INDEXES)
+        conn.executescript(_VERSION_TRIGGERS)
+        conn.executescript(_PHASH_LOG)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection, reopening it after a fork."""
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.conn = sqlite3.connect(self.db_path, timeout=30)
+            self._local.conn.row_factory = sqlite3.Row
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def version(self) -> int:
+        """Counter bumped whenever photos or folders are added, changed or removed."""
+        return self._connect().execute("SELECT value FROM meta WHERE key = 'storage_version'").fetchone()[0]
+
+    def bump_version(self):
+        """Mark storage as changed by something the catalog doesn't track (e.g. a direct S3 upload)."""
+        with self._connect() as conn:
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'storage_version'")
+
+    def folder_path(self, folder: str) -> str:
+        """Absolute path on disk for a catalog folder."""
+        return os.path.join(self.base_path, folder) if folder else self.base_path
+
+    def add_photo(self, folder: str, name: str, size: Optional[int] = None, mtime: Optional[float] = None,
+                  sha256: Optional[str] = None, phash: Optional[int] = None, similar_to: Optional[str] = None):
+        """Record a photo, reading its size/mtime from disk when not supplied.
+
+        Args:
+            phash (int): Perceptual hash of the photo (see imaging.phash).
+            similar_to (str): Path of the photo it was grouped with as a near-duplicate, if any.
+        """
+        if size is None or mtime is None:
+            stat = os.stat(os.path.join(self.folder_path(folder), name))
+            size, mtime = stat.st_size, stat.st_mtime
+
+        with self._connect() as conn:
+            conn.execute('INSERT INTO photos (folder, name, size, mtime, atime, sha256, phash, similar_to) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                         'ON CONFLICT (folder, name) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, '
+                         'atime = excluded.atime, sha256 = excluded.sha256, phash = excluded.phash, '
+                         'similar_to = excluded.similar_to, has_variants = 0',
+                         (folder, name, size, mtime, mtime, sha256, None if phash is None else to_db(phash),
+                          similar_to))
+
+    def get_photo(self, folder: str, name: str) -> Optional[Dict]:
+        """Return a photo's catalog entry, or None if it isn't catalogued."""
+        row = self._connect().execute('SELECT folder, name, size, mtime, sha256, phash, similar_to FROM photos '
+                                      'WHERE folder = ? AND name = ?', (folder, name)).fetchone()
+        if row is None:
+            return None
+        photo = dict(row)
+        photo['phash'] = None if photo['phash'] is None else from_db(photo['phash'])
+        return photo
+
+    def touch(self, folder: str, name: str, atime: float):
+        """Record that a photo was just served, for access-ordered eviction."""
+        with self._connect() as conn:
+            conn.execute('UPDATE photos SET atime = ? WHERE folder = ? AND name = ?', (atime, folder, name))
+
+    def find_by_hash(self, sha256: str, folder: Optional[str] = None) -> Optional[Dict]:
+        """Return a stored photo (preferring one in `folder`) whose contents hash to `sha256`."""
+        row = self._connect().execute(
+            'SELECT folder, name FROM photos WHERE sha256 = ? ORDER BY folder = ? DESC LIMIT 1',
+            (sha256, folder)).fetchone()
+        return dict(row) if row else None
+
+    def add_s3_object(self, key: str, sha256: str, phash: Optional[int] = None, similar_to: Optional[str] = None):
+        """Record the content hash (and perceptual hash) of an object uploaded to S3."""
+        with self._connect() as conn:
+            conn.execute('INSERT INTO s3_objects (key, sha256, phash, similar_to) VALUES (?, ?, ?, ?) '
+                         'ON CONFLICT (key) DO UPDATE SET sha256 = excluded.sha256, phash = excluded.phash, '
+                         'similar_to = excluded.similar_to',
+                         (key, sha256, None if phash is None else to_db(phash), similar_to))
+
+    def find_s3_object(self, sha256: str) -> Optional[str]:
+        """Return the key of an S3 object whose contents hash to `sha256`."""
+        row = self._connect().execute('SELECT key FROM s3_objects WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone()
+        return row['key'] if row else None
+
+    def remove_s3_object(self, key: str):
+        """Forget an object removed from S3."""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM s3_objects WHERE key = ?', (key,))
+
+    def remove_photo(self, folder: str, name: str):
+        """Forget a photo that was deleted from disk."""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM photos WHERE folder = ? AND name = ?', (folder, name))
+
+    def add_folder(self, folder: str):
+        """Record a newly created folder."""
+        parent = folder.rsplit('/', 1)[0] if '/' in folder else ''
+        with self._connect() as conn:
+            conn.execute('INSERT OR IGNORE INTO folders (path, parent) VALUES (?, ?)', (folder, parent))
+
+    def list_photos(self, folder: str = '') -> List[Dict]:
+        """List the photos in a folder, newest first."""
+        rows = self._connect().execute(
+            'SELECT folder, name, size, mtime, has_variants FROM photos WHERE folder = ? ORDER BY mtime DESC, name',
+            (folder,))
+        return [dict(row) for row in rows]
+
+    def page_photos(self, folder: str = '', after: Optional[Tuple[float, str]] = None,
+                    limit: int = 24) -> List[Dict]:
+        """List up to `limit` photos in a folder, newest first, starting after the (mtime, name) key."""
+        if after is None:
+            rows = self._connect().execute(
+                'SELECT folder, name, size, mtime, has_variants, sha256 FROM photos WHERE folder = ? '
+                'ORDER BY mtime DESC, name LIMIT ?', (folder, limit))
+        else:
+            mtime, name = after
+            rows = self._connect().execute(
+                'SELECT folder, name, size, mtime, has_variants, sha256 FROM photos WHERE folder = ? '
+                'AND (mtime < ? OR (mtime = ? AND name > ?)) '
+                'ORDER BY mtime DESC, name LIMIT ?', (folder, mtime, mtime, name, limit))
+        return [dict(row) for row in rows]
+
+    def set_has_variants(self, folder: str, name: str, has_variants: bool = True):
+        """Flag whether thumbnail/WebP variants exist for a photo."""
+        with self._connect() as conn:
+            conn.execute('UPDATE photos SET has_variants = ? WHERE folder = ? AND name = ?',
+                         (int(has_variants), folder, name))
+
+    def set_metadata(self, folder: str, name: str, width: int, height: int, taken_at: Optional[float] = None):
+        """Record a photo's dimensions and, if its EXIF data has one, when it was taken."""
+        with self._connect() as conn:
+            conn.execute('UPDATE photos SET width = ?, height = ?, taken_at = ? WHERE folder = ? AND name = ?',
+                         (width, height, taken_at, folder, name))
+
+    def set_phash(self, folder: str, name: str, phash: int):
+        """Record a photo's perceptual hash."""
+        with self._connect() as conn:
+            conn.execute('UPDATE photos SET phash = ? WHERE folder = ? AND name = ?', (to_db(phash), folder, name))
+
+    def set_s3_phash(self, key: str, phash: int):
+        """Record an S3 object's perceptual hash."""
+        with self._connect() as conn:
+            conn.execute('UPDATE s3_objects SET phash = ? WHERE key = ?', (to_db(phash), key))
+
+    def phash_entries(self) -> Tuple[int, List[Tuple[str, int]]]:
+        """Every hashed photo's (path, perceptual hash) - 'folder/name' locally, the key for S3 objects.
+
+        Returns:
+            Tuple: The phash_log position the entries are at least as new as, and the entries.
+        """
+        # Read the position first - Replaying changes the entries already include is harmless.
+        seq = self._connect().execute('SELECT COALESCE(MAX(seq), 0) FROM phash_log').fetchone()[0]
+        rows = self._connect().execute(
+            "SELECT CASE folder WHEN '' THEN name ELSE folder || '/' || name END, phash FROM photos "
+            'WHERE phash IS NOT NULL UNION ALL SELECT key, phash FROM s3_objects WHERE phash IS NOT NULL')
+        return seq, [(row[0], from_db(row[1])) for row in rows]
+
+    def phash_changes(self, after: int, keep: int = 10000) -> Optional[List[Tuple[int, str, Optional[int]]]]:
+        """(seq, path, phash) of every perceptual hash change logged after position `after`.
+
+        The log is trimmed to its last `keep` changes as it grows, so a caller that fell further
+        behind than that gets None and has to reload phash_entries().
+        """
+        conn = self._connect()
+        first, last = conn.execute('SELECT MIN(seq), MAX(seq) FROM phash_log').fetchone()
+        if last is None or last <= after:
+            return []
+        if last - first > 2 * keep:
+            with conn:
+                conn.execute('DELETE FROM phash_log WHERE seq <= ?', (last - keep,))
+            first = last - keep + 1
+        if after < first - 1:
+            return None
+
+        rows = conn.execute('SELECT seq, path, phash FROM phash_log WHERE seq > ? ORDER BY seq', (after,))
+        return [(row[0], row[1], None if row[2] is None else from_db(row[2])) for row in rows]
+
+    def find_phash(self, path: str) -> Optional[int]:
+        """Perceptual hash of the photo (or S3 object) at `path`, if it has been hashed."""
+        folder, _, name = path.rpartition('/')
+        row = self._connect().execute(
+            'SELECT phash FROM photos WHERE folder = ? AND name = ? AND phash IS NOT NULL '
+            'UNION ALL SELECT phash FROM s3_objects WHERE key = ? AND phash IS NOT NULL LIMIT 1',
+            (folder, name, path)).fetchone()
+        return from_db(row[0]) if row else None
+
+    def similar_to(self, path: str) -> List[str]:
+        """Paths of the photos grouped with `path` as its near-duplicates at upload time."""
+        rows = self._connect().execute(
+            "SELECT CASE folder WHEN '' THEN name ELSE folder || '/' || name END FROM photos WHERE similar_to = ? "
+            'UNION ALL SELECT key FROM s3_objects WHERE similar_to = ?', (path, path))
+        return [row[0] for row in rows]
+
+    def missing_phashes(self) -> List[Dict]:
+        """List every photo whose perceptual hash has not been computed yet."""
+        rows = self._connect().execute('SELECT folder, name FROM photos WHERE phash IS NULL')
+        return [dict(row) for row in rows]
+
+    def s3_objects_missing_phashes(self) -> List[str]:
+        """Keys of the recorded S3 objects whose perceptual hash has not been computed yet."""
+        return [row['key'] for row in self._connect().execute('SELECT key FROM s3_objects WHERE phash IS NULL')]
+
+    def missing_variants(self) -> List[Dict]:
+        """List every photo whose variants have not been generated yet."""
+        rows = self._connect().execute('SELECT folder, name FROM photos WHERE has_variants = 0')
+        return [dict(row) for row in rows]
+
+    def photo_names(self, folder: str = '') -> Set[str]:
+        """Return the set of photo names stored in a folder."""
+        rows = self._connect().execute('SELECT name FROM photos WHERE folder = ?', (folder,))
+        return {row['name'] for row in rows}
+
+    def oldest_photos(self, folder: Optional[str], limit: int, order: str = 'upload') -> List[Dict]:
+        """Return up to `limit` of the oldest photos in a folder (or anywhere, if folder is None).
+
+        Args:
+            order (str): 'upload' to order by upload time, 'access' to order by last access (see touch()).
+        """
+        column = EVICTION_ORDERS[order]
+        if folder is None:
+            rows = self._connect().execute(
+                f'SELECT folder, name, size FROM photos ORDER BY {column} LIMIT ?', (limit,))
+        else:
+            rows = self._connect().execute(
+                f'SELECT folder, name, size FROM photos WHERE folder = ? ORDER BY {column} LIMIT ?',
+                (folder, limit))
+        return [dict(row) for row in rows]
+
+    def stats(self, folder: Optional[str] = None) -> Tuple[int, int]:
+        """Photo count and total bytes for a folder, or for the whole catalog if folder is None."""
+        if folder is None:
+            row = self._connect().execute('SELECT SUM(count), SUM(bytes) FROM folder_stats').fetchone()
+        else:
+            row = self._connect().execute('SELECT count, bytes FROM folder_stats WHERE folder = ?',
+                                          (folder,)).fetchone()
+        return (row[0] or 0, row[1] or 0) if row else (0, 0)
+
+    def count(self, folder: str = '') -> int:
+        """Number of photos in a folder."""
+        return self.stats(folder)[0]
+
+    def list_folders(self, parent: str = '') -> List[str]:
+        """List the names of the direct subfolders of `parent`."""
+        rows = self._connect().execute('SELECT path FROM folders WHERE parent = ? ORDER BY path', (parent,))
+        return [row['path'].rsplit('/', 1)[-1] for row in rows]
+
+    def is_empty(self) -> bool:
+        """True if nothing has been catalogued yet."""
+        conn = self._connect()
+        return (conn.execute('SELECT 1 FROM photos LIMIT 1').fetchone() is None
+                and conn.execute('SELECT 1 FROM folders LIMIT 1').fetchone() is None)
+
+    def rebuild(self) -> int:
+        """Re-sync the catalog with the filesystem using a single os.scandir sweep.
+
+        Returns:
+            int: Number of photos catalogued.
+        """
+        # Hashing every file again would dominate the sweep, so carry hashes over for known files.
+        known_hashes = {(row['folder'], row['name'], row['size']): (row['sha256'], row['phash'])
+                        for row in self._connect().execute(
+                            'SELECT folder, name, size, sha256, phash FROM photos '
+                            'WHERE sha256 IS NOT NULL OR phash IS NOT NULL')}
+
+        photos, folders = [], []
+        pending = ['']
+        while pending:
+            folder = pending.pop()
+            try:
+                variants = set(os.listdir(os.path.join(self.folder_path(folder), VARIANT_DIR)))
+            except FileNotFoundError:
+                variants = set()
+
+            with os.scandir(self.folder_path(folder)) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        path = f'{folder}/{entry.name}' if folder else entry.name
+                        folders.append((path, folder))
+                        pending.append(path)
+                    elif entry.is_file() and is_photo(entry.name):
+                        stat = entry.stat()
+                        photos.append((folder, entry.name, stat.st_size, stat.st_mtime, stat.st_mtime,
+                                       int(variant_names(entry.name)['thumb'] in variants),
+                                       *known_hashes.get((folder, entry.name, stat.st_size), (None, None))))
+
+        with self._connect() as conn:
+            conn.execute('DELETE FROM photos')
+            conn.execute('DELETE FROM folder_stats')
+            conn.execute('DELETE FROM folders')
+            conn.executemany('INSERT INTO photos (folder, name, size, mtime, atime, has_variants, sha256, phash) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', photos)
+            conn.executemany('INSERT INTO folders (path, parent) VALUES (?, ?)', folders)
+
+        return len(photos)
+
+
+def init_catalog(app) -> PhotoCatalog:
+    """Attach a PhotoCatalog to the app, building it from disk on first use."""
+    db_path = app.config.get('CATALOG_PATH') or os.path.join(app.instance_path, 'catalog.sqlite3')
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+    catalog = PhotoCatalog(db_path, app.config['UPLOAD_FOLDER'])
+    if catalog.is_empty():
+        catalog.rebuild()
+
+    app.extensions['catalog'] = catalog
+    return catalog
+
+
+def get_catalog() -> PhotoCatalog:
+    """Return the current app's photo catalog."""
+    return current_app.extensions['catalog']
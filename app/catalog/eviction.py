@@ -0,0 +1,89 @@
+"""
+Quota-driven eviction of the oldest photos from Puploader's UPLOAD_FOLDER.
+"""
+import os
+from typing import Dict, List, Optional
+from flask import current_app
+from imaging.thumbnails import remove_local_variants
+
+# Rows fetched per index seek while looking for enough photos to get back under quota.
+_BATCH_SIZE = 64
+
+
+class EvictionEngine:
+    """
+    Enforces file-count and byte quotas, per folder and across the whole collection.
+
+    Counts and sizes come from the catalog's incrementally maintained folder_stats, and victims
+    are read off its (folder, time) indexes, so each eviction costs an index seek rather than a scan.
+
+    With order='access', photos go least recently served first - Accesses are recorded by the
+    /uploads route (serve_upload), so a photo that was never served there ranks by its upload time.
+    """
+
+    def __init__(self, catalog, max_files: Optional[int] = None, max_bytes: Optional[int] = None,
+                 total_max_files: Optional[int] = None, total_max_bytes: Optional[int] = None,
+                 order: str = 'upload'):
+        self.catalog = catalog
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.total_max_files = total_max_files
+        self.total_max_bytes = total_max_bytes
+        self.order = order
+
+    def _evict_scope(self, folder: Optional[str], max_files: Optional[int],
+                     max_bytes: Optional[int]) -> List[Dict]:
+        """Remove the oldest photos in `folder` (or everywhere, if None) until it fits its quotas."""
+        count, size = self.catalog.stats(folder)
+        excess_files = count - max_files if max_files is not None else 0
+        excess_bytes = size - max_bytes if max_bytes is not None else 0
+
+        evicted = []
+        while excess_files > 0 or excess_bytes > 0:
+            batch = self.catalog.oldest_photos(folder, _BATCH_SIZE, self.order)
+            if not batch:
+                break
+            for photo in batch:
+                if excess_files <= 0 and excess_bytes <= 0:
+                    break
+                self.remove(photo['folder'], photo['name'])
+                evicted.append(photo)
+                excess_files -= 1
+                excess_bytes -= photo['size']
+        return evicted
+
+    def evict(self, folder: str = '') -> List[Dict]:
+        """Delete the oldest photos (and their variants) until `folder` and the collection fit their quotas.
+
+        Returns:
+            List: The evicted photos' folder, name and size.
+        """
+        return (self._evict_scope(folder, self.max_files, self.max_bytes)
+                + self._evict_scope(None, self.total_max_files, self.total_max_bytes))
+
+    def remove(self, folder: str, name: str):
+        """Delete a photo, its variants and its catalog entry."""
+        directory = self.catalog.folder_path(folder)
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+        remove_local_variants(directory, name)
+        self.catalog.remove_photo(folder, name)
+
+
+def init_eviction(app, catalog) -> EvictionEngine:
+    """Attach an EvictionEngine configured from the app's quotas."""
+    engine = EvictionEngine(catalog,
+                            max_files=app.config.get('UPLOAD_FOLDER_MAX'),
+                            max_bytes=app.config.get('UPLOAD_FOLDER_MAX_BYTES'),
+                            total_max_files=app.config.get('UPLOAD_TOTAL_MAX_FILES'),
+                            total_max_bytes=app.config.get('UPLOAD_TOTAL_MAX_BYTES'),
+                            order=app.config.get('EVICTION_ORDER', 'upload'))
+    app.extensions['eviction'] = engine
+    return engine
+
+
+def get_eviction() -> EvictionEngine:
+    """Return the current app's eviction engine."""
+    return current_app.extensions['eviction']
@@ -0,0 +1,172 @@
+"""
+In-memory index of the catalog's perceptual hashes, for finding visually similar photos.
+
+Each process keeps the hashes in a NumPy array and answers a query with one vectorized XOR and
+popcount over the whole collection - About a millisecond for hundreds of thousands of photos.
+Changes made by any process are picked up from the catalog's phash log at most once per
+`refresh_interval` seconds, so photos hashed elsewhere show up after that long.
+"""
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from flask import current_app
+from imaging.phash import hamming
+
+NEAR_DUPLICATE_POLICIES = ('off', 'reject', 'group')
+
+
+def _popcount(values):
+    """Set bits in each element of a uint64 array."""
+    import numpy as np
+
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    # NumPy < 2.0 - Count each byte through a lookup table.
+    table = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+    return table[values.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+class SimilarityIndex:
+    """
+    Hamming-distance search over every hashed photo in a catalog.
+
+    Paths and hashes live in parallel arrays. Changes are applied in place from the catalog's
+    phash_log - Removed entries are masked out until they make up a quarter of the arrays, which
+    are then compacted.
+    """
+
+    def __init__(self, catalog, refresh_interval: float = 2):
+        self.catalog = catalog
+        self.refresh_interval = refresh_interval
+
+        self._lock = threading.Lock()
+        self._paths: List[Optional[str]] = []
+        self._positions: Dict[str, int] = {}
+        self._hashes = None  # uint64 array, parallel to _paths
+        self._live = None  # bool array - False where an entry was removed
+        self._seq = None
+        self._checked_at = 0.0
+
+    def _load(self, entries: List[Tuple[str, int]]):
+        import numpy as np
+
+        self._paths = [path for path, _ in entries]
+        self._positions = {path: position for position, path in enumerate(self._paths)}
+        self._hashes = np.fromiter((phash for _, phash in entries), dtype=np.uint64, count=len(entries))
+        self._live = np.ones(len(entries), dtype=bool)
+
+    def _apply(self, changes: List[Tuple[int, str, Optional[int]]]):
+        import numpy as np
+
+        latest = {path: phash for _, path, phash in changes}
+        added = []
+        for path, phash in latest.items():
+            position = self._positions.get(path)
+            if position is not None and phash is not None:
+                self._hashes[position] = phash
+            elif position is not None:
+                del self._positions[path]
+                self._paths[position] = None
+                self._live[position] = False
+            elif phash is not None:
+                added.append((path, phash))
+
+        if added:
+            for path, _ in added:
+                self._positions[path] = len(self._paths)
+                self._paths.append(path)
+            self._hashes = np.concatenate([self._hashes, np.array([phash for _, phash in added], dtype=np.uint64)])
+            self._live = np.concatenate([self._live, np.ones(len(added), dtype=bool)])
+
+        if len(self._paths) - len(self._positions) > len(self._paths) // 4:
+            self._load([(path, int(phash)) for path, phash, alive in zip(self._paths, self._hashes, self._live)
+                        if alive])
+
+    def _refresh(self):
+        """Catch up with the catalog's hashes, unless that was done less than `refresh_interval` ago."""
+        if time.monotonic() - self._checked_at < self.refresh_interval:
+            return
+
+        with self._lock:
+            if time.monotonic() - self._checked_at < self.refresh_interval:
+                return
+            changes = None if self._seq is None else self.catalog.phash_changes(self._seq)
+            if changes is None:
+                self._seq, entries = self.catalog.phash_entries()
+                self._load(entries)
+            elif changes:
+                self._apply(changes)
+                self._seq = changes[-1][0]
+            self._checked_at = time.monotonic()
+
+    def search(self, phash: int, max_distance: int, limit: int = 20,
+               exclude: Optional[str] = None) -> List[Tuple[str, int]]:
+        """Photos within `max_distance` bits of `phash`, closest first.
+
+        Returns:
+            List: (path, distance) pairs - Paths are 'folder/name' for local photos, keys for S3 objects.
+        """
+        import numpy as np
+
+        self._refresh()
+        with self._lock:
+            paths, hashes, live = self._paths, self._hashes, self._live
+            if not paths:
+                return []
+
+            distances = _popcount(hashes ^ np.uint64(phash))
+            matches = np.flatnonzero((distances <= max_distance) & live)
+            matches = matches[np.argsort(distances[matches], kind='stable')]
+            results = [(paths[index], int(distances[index])) for index in matches[:limit + 1]
+                       if paths[index] != exclude]
+        return results[:limit]
+
+    def nearest(self, phash: int, max_distance: int) -> Optional[Tuple[str, int]]:
+        """The closest photo within `max_distance` bits of `phash`, if any."""
+        results = self.search(phash, max_distance, limit=1)
+        return results[0] if results else None
+
+
+class NearDuplicateScreen:
+    """
+    Checks one batch of uploads against the collection and against each other.
+
+    With the 'off' policy nothing is checked - The screen only marks that hashes are computed at upload.
+    """
+
+    def __init__(self, index: SimilarityIndex, policy: str = 'off', max_distance: int = 6):
+        if policy not in NEAR_DUPLICATE_POLICIES:
+            raise ValueError(f'NEAR_DUPLICATE_POLICY must be one of {", ".join(NEAR_DUPLICATE_POLICIES)}.')
+        self.index = index
+        self.policy = policy
+        self.max_distance = max_distance
+
+        self._batch: List[Tuple[int, str]] = []
+        self._lock = threading.Lock()
+
+    def check(self, phash: Optional[int], path: str) -> Optional[str]:
+        """Path of a stored (or earlier in the batch) photo that `path` is a near-duplicate of, if any."""
+        if self.policy == 'off' or phash is None:
+            return None
+
+        match = self.index.nearest(phash, self.max_distance)
+        with self._lock:
+            similar = match[0] if match else next((other for other_hash, other in self._batch
+                                                   if hamming(other_hash, phash) <= self.max_distance), None)
+            # Uploads that are turned away mustn't make later ones look like duplicates of them.
+            if similar is None or self.policy == 'group':
+                self._batch.append((phash, path))
+        return similar
+
+
+def init_similarity(app) -> SimilarityIndex:
+    """Attach a SimilarityIndex over the app's catalog to it."""
+    index = SimilarityIndex(app.extensions['catalog'],
+                            refresh_interval=app.config.get('SIMILARITY_REFRESH_SECONDS', 2))
+    app.extensions['similarity'] = index
+    return index
+
+
+def get_similarity() -> SimilarityIndex:
+    """Return the current app's similarity index."""
+    return current_app.extensions['similarity']
@@ -1,21 +1,23 @@
-import requests
 from typing import List
+from api_client.api_client import ApiClient, ApiError
+
+BASE_URL = 'https://api.data.charitynavigator.org/v2'
 
 
 class CharityNavAPI:
     """
-    Wrapper for CharityNavigator's REST API.
+    Wrapper for CharityNavigator's REST API. Failed calls raise api_client.ApiError.
     """
 
-    def __init__(self, app_id: str, app_key: str):
+    def __init__(self, app_id: str, app_key: str, client: ApiClient = None, base_url: str = BASE_URL):
         """
         Constructor for CharityNav's wrapper.
         """
         self.app_id = app_id
         self.app_key = app_key
-        self.base_url = "https://api.data.charitynavigator.org/v2"
+        self.base_url = base_url
 
-        self.client = requests.session()
+        self.client = client or ApiClient()
 
     def get_organizations(self, category_id: int, **kwargs) -> List:
         """
@@ -33,4 +35,4 @@ class CharityNavAPI:
         if orgs.status_code == 200:
             return orgs.json()
 
-        print(orgs.status_code, orgs.headers, orgs.text)
+        raise ApiError.from_response(orgs)
@@ -0,0 +1,133 @@
+"""
+Shared MongoDB access for Puploader.
+
+One client (and so one connection pool) is used per process. It is created lazily on first use
+(or from gunicorn's post_worker_init hook), so each worker opens its own pool after fork rather
+than inheriting the master's. pymongo itself is only imported once a client is needed.
+"""
+import os
+import threading
+from typing import TYPE_CHECKING, Optional
+from flask import current_app
+from metrics.metrics import mongo_command_listener
+
+if TYPE_CHECKING:
+    import pymongo
+    from pymongo.collection import Collection
+
+
+class Database:
+    """
+    Fork-safe handle on Puploader's AUTH database.
+    """
+
+    def __init__(self, uri: str, max_pool_size: int = 50, min_pool_size: int = 0,
+                 server_selection_timeout: float = 5, name: str = 'AUTH'):
+        self.uri = uri
+        self.max_pool_size = max_pool_size
+        self.min_pool_size = min_pool_size
+        self.server_selection_timeout = server_selection_timeout
+        self.name = name
+
+        self._client: Optional['pymongo.MongoClient'] = None
+        self._client_pid = None
+        self._lock = threading.Lock()
+
+    def _get_client(self, connect: bool) -> 'pymongo.MongoClient':
+        with self._lock:
+            if self._client_pid != os.getpid():
+                import pymongo
+                self._client = pymongo.MongoClient(self.uri, 27017,
+                                                   maxPoolSize=self.max_pool_size,
+                                                   minPoolSize=self.min_pool_size,
+                                                   serverSelectionTimeoutMS=int(self.server_selection_timeout * 1000),
+                                                   event_listeners=[mongo_command_listener()],
+                                                   connect=connect)
+                self._client_pid = os.getpid()
+            return self._client
+
+    @property
+    def client(self) -> 'pymongo.MongoClient':
+        """This process's client, created on first use (and again after a fork)."""
+        return self._get_client(connect=False)
+
+    def open(self):
+        """Create this process's client and start connecting in the background, ahead of the first request."""
+        self._get_client(connect=True)
+
+    @property
+    def users(self) -> 'Collection':
+        """The USERS collection."""
+        return self.client[self.name]['USERS']
+
+    def ensure_indexes(self):
+        """Create the unique indexes user lookups rely on - Safe to call on every startup."""
+        from pymongo.errors import OperationFailure, PyMongoError
+
+        try:
+            self.users.create_index('email', unique=True, name='email_unique')
+            # Only Google accounts carry a user_id, so form-registered users are left out of the index.
+            self.users.create_index('user_id', unique=True, name='user_id_unique',
+                                    partialFilterExpression={'user_id': {'$exists': True}})
+        except OperationFailure as exc:
+            print('Error creating user indexes (are there duplicate users?): ', exc)
+        except PyMongoError as exc:
+            # Don't refuse to start just because MongoDB is briefly unreachable.
+            print('Error creating user indexes: ', exc)
+
+    def reset(self):
+        """Forget a client inherited across a fork so the next use opens a fresh pool."""
+        with self._lock:
+            if self._client_pid != os.getpid():
+                self._client = self._client_pid = None
+
+    def close(self):
+        """Close this process's client, if it has one."""
+        with self._lock:
+            if self._client is not None and self._client_pid == os.getpid():
+                self._client.close()
+            self._client = self._client_pid = None
+
+
+_databases = []
+
+
+def init_db(app) -> Database:
+    """Attach a Database configured from the app to it and make sure its indexes exist."""
+    uri = app.config.get('MONGODB_URI') or os.environ.get('MONGODB_URI') or '127.0.0.1'
+
+    database = Database(uri,
+                        max_pool_size=app.config.get('MONGO_MAX_POOL_SIZE', 50),
+                        min_pool_size=app.config.get('MONGO_MIN_POOL_SIZE', 0),
+                        server_selection_timeout=app.config.get('MONGO_SERVER_SELECTION_TIMEOUT', 5))
+    app.extensions['mongo'] = database
+    _databases.append(database)
+
+    if app.config.get('MONGO_ENSURE_INDEXES', True):
+        database.ensure_indexes()
+        # Don't hand the startup connection down to forked workers.
+        database.close()
+
+    return database
+
+
+def reset_after_fork():
+    """Drop clients inherited from a parent process - Called from gunicorn's post_fork hook."""
+    for database in _databases:
+        database.reset()
+
+
+def open_connections():
+    """Start this worker's connection pools - Called from gunicorn's post_worker_init hook."""
+    for database in _databases:
+        database.open()
+
+
+def get_db() -> Database:
+    """Return the current app's database."""
+    return current_app.extensions['mongo']
+
+
+def get_users() -> 'Collection':
+    """Return the USERS collection for the current app."""
+    return get_db().users
@@ -1,4 +1,50 @@
-bind = "0.0.0.0:8000"
+import gc
+import os
+import shutil
+import tempfile
+
+# Platforms such as Heroku pick the port through $PORT - A -b on the command line overrides this.
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
 workers = 4
 threads = 4
 timeout = 120
+
+# Import and build the app once in the master, so workers share its memory copy-on-write and
+# start without re-importing anything. Set GUNICORN_PRELOAD=0 to load the app in each worker.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1').lower() not in ('0', 'false', 'no')
+
+# prometheus_client reads this when first imported, which a preloaded app does before on_starting.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'puploader-metrics'))
+
+
+def on_starting(server):
+    """Give prometheus_client a clean directory in which to aggregate metrics across workers."""
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+
+def when_ready(server):
+    """Move the preloaded app's objects out of the collector's reach, so workers' GC passes don't un-share its pages."""
+    if preload_app:
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    """Give each worker its own MongoDB connection pool instead of one inherited from the master."""
+    from db import reset_after_fork
+    reset_after_fork()
+
+
+def post_worker_init(worker):
+    """Start connecting to MongoDB before the worker's first request rather than during it, and start its job workers."""
+    from db import open_connections
+    from jobs.queue import start_job_workers
+    open_connections()
+    start_job_workers(worker.wsgi)
+
+
+def child_exit(server, worker):
+    """Fold an exited worker's metrics into the totals."""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
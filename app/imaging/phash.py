@@ -0,0 +1,45 @@
+"""
+Perceptual (difference) hashes of photos, for spotting near-duplicates that differ byte-wise.
+
+A dHash shrinks the image to 9x8 greyscale and records, for each row, whether each pixel is
+brighter than its right-hand neighbour - 64 bits that survive re-encoding, resizing and small
+edits. The number of differing bits (Hamming distance) between two hashes measures similarity.
+"""
+from typing import BinaryIO, Union
+
+HASH_BITS = 64
+
+
+def dhash(source: Union[str, BinaryIO]) -> int:
+    """64-bit difference hash of the image at a path or in a file object (rewound afterwards)."""
+    from PIL import Image, ImageOps
+
+    with Image.open(source) as image:
+        # Lets the JPEG decoder downscale while decoding, instead of decoding every pixel.
+        image.draft('L', (64, 64))
+        small = ImageOps.exif_transpose(image).convert('L').resize((9, 8), Image.BILINEAR)
+        pixels = list(small.getdata())
+
+    if not isinstance(source, str):
+        source.seek(0)
+
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            value = (value << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    """Number of bits in which two hashes differ."""
+    return bin(a ^ b).count('1')
+
+
+def to_db(value: int) -> int:
+    """Store an unsigned 64-bit hash in a signed SQLite INTEGER."""
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def from_db(value: int) -> int:
+    """Inverse of to_db."""
+    return value + (1 << HASH_BITS) if value < 0 else value
@@ -0,0 +1,174 @@
+"""
+Background generation of thumbnail and WebP variants for uploaded photos.
+
+Variants are stored next to the original in a hidden `.variants` folder when running privately,
+or under the `variants/` prefix of the bucket when running against S3.
+"""
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, List, Optional
+from flask import current_app
+
+VARIANT_DIR = '.variants'
+S3_VARIANT_PREFIX = 'variants/'
+
+
+def variant_names(name: str) -> Dict[str, str]:
+    """Names of the variants generated for a photo, keyed by variant type."""
+    return {'thumb': f'{name}.thumb.jpg',
+            'thumb_webp': f'{name}.thumb.webp',
+            'webp': f'{name}.webp'}
+
+
+def render_variants(data: bytes, width: int) -> Dict[str, bytes]:
+    """Render a fixed-width JPEG/WebP thumbnail and a full-size WebP copy of an image."""
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+        thumbnail = image.copy()
+        if thumbnail.width > width:
+            thumbnail = thumbnail.resize((width, max(1, round(thumbnail.height * width / thumbnail.width))),
+                                         Image.LANCZOS)
+
+        rendered = {}
+        for variant, (source, fmt) in {'thumb': (thumbnail.convert('RGB'), 'JPEG'),
+                                       'thumb_webp': (thumbnail, 'WEBP'),
+                                       'webp': (image, 'WEBP')}.items():
+            buffer = io.BytesIO()
+            source.save(buffer, fmt, quality=80)
+            rendered[variant] = buffer.getvalue()
+
+    return rendered
+
+
+def generate_local_variants(directory: str, name: str, width: int) -> List[str]:
+    """Write the variants for `directory/name` into `directory/.variants`. Runs in a pool process."""
+    with open(os.path.join(directory, name), 'rb') as original:
+        rendered = render_variants(original.read(), width)
+
+    variant_dir = os.path.join(directory, VARIANT_DIR)
+    os.makedirs(variant_dir, exist_ok=True)
+
+    names = variant_names(name)
+    for variant, data in rendered.items():
+        path = os.path.join(variant_dir, names[variant])
+        with open(f'{path}.tmp', 'wb') as output:
+            output.write(data)
+        os.replace(f'{path}.tmp', path)
+
+    return list(names.values())
+
+
+def generate_s3_variants(bucket_name: str, key: str, width: int, endpoint_url: Optional[str] = None,
+                         source_path: Optional[str] = None) -> Dict[str, Dict]:
+    """Upload the variants for `key` under the bucket's variant prefix. Runs in a pool process.
+
+    Args:
+        source_path (str): Local copy of the object (e.g. in the disk cache) to render from instead of downloading it.
+    """
+    import boto3  # pylint: disable=import-outside-toplevel
+    s3_client = boto3.client('s3', endpoint_url=endpoint_url)
+    if source_path:
+        with open(source_path, 'rb') as source:
+            data = source.read()
+    else:
+        data = s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+    rendered = render_variants(data, width)
+
+    uploaded = {}
+    names = variant_names(key)
+    for variant, data in rendered.items():
+        variant_key = S3_VARIANT_PREFIX + names[variant]
+        content_type = 'image/jpeg' if variant == 'thumb' else 'image/webp'
+        response = s3_client.put_object(Bucket=bucket_name, Key=variant_key, Body=data, ContentType=content_type)
+        uploaded[variant_key] = {'size': len(data), 'etag': response['ETag']}
+
+    return uploaded
+
+
+def remove_local_variants(directory: str, name: str):
+    """Delete any variants generated for `directory/name`."""
+    for variant in variant_names(name).values():
+        try:
+            os.remove(os.path.join(directory, VARIANT_DIR, variant))
+        except FileNotFoundError:
+            pass
+
+
+class VariantPipeline:
+    """
+    Process-pool backed queue of variant generation jobs.
+
+    The pool is created lazily (and re-created after a fork) so each gunicorn worker owns its own.
+    """
+
+    def __init__(self, width: int = 400, max_workers: int = 2):
+        self.width = width
+        self.max_workers = max_workers
+
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        """The worker pool for this process."""
+        with self._lock:
+            if self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def submit_local(self, catalog, folder: str, name: str) -> Future:
+        """Queue variants for a photo stored locally, flagging it in the catalog once they exist."""
+        future = self.pool.submit(generate_local_variants, catalog.folder_path(folder), name, self.width)
+
+        def _done(done: Future):
+            if done.exception() is None:
+                catalog.set_has_variants(folder, name)
+            else:
+                print(f'Error generating variants for {folder}/{name}:', done.exception())
+
+        future.add_done_callback(_done)
+        return future
+
+    def submit_s3(self, listing, key: str) -> Future:
+        """Queue variants for an S3 object, patching the bucket's cached listing once uploaded."""
+        future = self.pool.submit(generate_s3_variants, listing.bucket_name, key, self.width, listing.endpoint_url)
+
+        def _done(done: Future):
+            if done.exception() is None:
+                for variant_key, obj in done.result().items():
+                    listing.record_put(variant_key, obj['size'], obj['etag'])
+            else:
+                print(f'Error generating variants for {key}:', done.exception())
+
+        future.add_done_callback(_done)
+        return future
+
+    def shutdown(self):
+        """Wait for queued jobs and stop the pool."""
+        with self._lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown(wait=True)
+            self._pool = self._pool_pid = None
+
+
+def init_pipeline(app) -> VariantPipeline:
+    """Attach a VariantPipeline to the app."""
+    pipeline = VariantPipeline(width=app.config.get('THUMBNAIL_WIDTH', 400),
+                               max_workers=app.config.get('VARIANT_WORKERS', 2))
+    app.extensions['variants'] = pipeline
+    return pipeline
+
+
+def get_pipeline() -> VariantPipeline:
+    """Return the current app's variant pipeline."""
+    return current_app.extensions['variants']
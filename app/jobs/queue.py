@@ -0,0 +1,253 @@
+"""
+Durable job queue for post-upload processing, backed by a SQLite file on the local host.
+
+Jobs survive restarts and worker crashes: a worker leases a job while running it, and a job
+whose lease runs out (because its worker died) is handed to the next worker that asks. Failed
+jobs are retried with exponential backoff up to `max_attempts` times. Enqueueing with an
+idempotency key that is already known returns the existing job instead of adding another.
+"""
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from flask import current_app
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    idempotency_key TEXT UNIQUE,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_after REAL NOT NULL,
+    lease_until REAL,
+    worker TEXT,
+    last_error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_after);
+CREATE INDEX IF NOT EXISTS jobs_leased ON jobs (status, lease_until);
+"""
+
+STATUSES = ('queued', 'running', 'done', 'failed')
+
+
+class JobQueue:
+    """
+    SQLite-backed queue shared by every process on the host, plus this process's job workers.
+
+    Worker processes are started once per app process (see start_job_workers) and restarted by a
+    supervisor thread if they die. They exit on their own once that process is gone.
+    """
+
+    def __init__(self, db_path: str, workers: int = 1, lease_seconds: float = 300, max_attempts: int = 5,
+                 retry_backoff: float = 2, poll_interval: float = 1):
+        self.db_path = db_path
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.poll_interval = poll_interval
+
+        self._local = threading.local()
+        self._processes: List[multiprocessing.Process] = []
+        self._processes_pid = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection, reopening it after a fork."""
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.conn = sqlite3.connect(self.db_path, timeout=30)
+            self._local.conn.row_factory = sqlite3.Row
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def enqueue(self, kind: str, payload: Dict[str, Any], key: Optional[str] = None,
+                then: Optional[List[str]] = None, delay: float = 0) -> int:
+        """Queue a job, returning its ID.
+
+        Args:
+            key (str): Idempotency key - If a job with this key exists, its ID is returned instead.
+            then (List): Kinds of jobs to queue, one after another, with the same payload once this one is done.
+            delay (float): Seconds to wait before the job may run.
+        """
+        now = time.time()
+        payload = {**payload, 'then': list(then)} if then else payload
+        with self._connect() as conn:
+            cursor = conn.execute('INSERT INTO jobs (kind, payload, idempotency_key, max_attempts, run_after, '
+                                  'created, updated) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                                  'ON CONFLICT (idempotency_key) DO NOTHING',
+                                  (kind, json.dumps(payload), key, self.max_attempts, now + delay, now, now))
+            if cursor.rowcount:
+                return cursor.lastrowid
+            return conn.execute('SELECT id FROM jobs WHERE idempotency_key = ?', (key,)).fetchone()['id']
+
+    def claim(self, worker: str) -> Optional[Dict]:
+        """Lease the next runnable job to `worker` - Either a queued job that is due, or one whose lease expired.
+
+        A job whose lease expired on its last attempt (its worker died running it, e.g. killed for
+        using too much memory) is marked failed instead of being handed out again.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            abandoned = conn.execute(
+                "UPDATE jobs SET status = 'failed', lease_until = NULL, updated = ?, "
+                "last_error = COALESCE(last_error || ' - ', '') || 'Worker died while running the job.' "
+                "WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts "
+                "RETURNING id, kind, attempts", (now, now)).fetchall()
+            row = conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, worker = ?, "
+                "updated = ? WHERE id = (SELECT id FROM jobs WHERE (status = 'queued' AND run_after <= ?) "
+                "OR (status = 'running' AND lease_until < ? AND attempts < max_attempts) "
+                "ORDER BY run_after, id LIMIT 1) "
+                "RETURNING id, kind, payload, attempts, max_attempts",
+                (now + self.lease_seconds, worker, now, now, now)).fetchone()
+
+        for job in abandoned:
+            print(f"Job {job['id']} ({job['kind']}) failed after {job['attempts']} attempts: Its worker died.")
+
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        return job
+
+    def complete(self, job: Dict, worker: str):
+        """Mark a leased job done and queue the next job in its chain, if any."""
+        with self._connect() as conn:
+            updated = conn.execute("UPDATE jobs SET status = 'done', lease_until = NULL, updated = ? "
+                                   "WHERE id = ? AND worker = ? AND status = 'running'",
+                                   (time.time(), job['id'], worker)).rowcount
+
+        chain = job['payload'].get('then')
+        if updated and chain:
+            payload = {name: value for name, value in job['payload'].items() if name != 'then'}
+            self.enqueue(chain[0], payload, key=f"{job['id']}:then:{chain[0]}", then=chain[1:])
+
+    def fail(self, job: Dict, worker: str, error: str):
+        """Record a failed attempt - The job is retried after a backoff until it runs out of attempts."""
+        now = time.time()
+        exhausted = job['attempts'] >= job['max_attempts']
+        with self._connect() as conn:
+            conn.execute('UPDATE jobs SET status = ?, run_after = ?, lease_until = NULL, last_error = ?, updated = ? '
+                         "WHERE id = ? AND worker = ? AND status = 'running'",
+                         ('failed' if exhausted else 'queued',
+                          now + self.retry_backoff * 2 ** (job['attempts'] - 1),
+                          error, now, job['id'], worker))
+        if exhausted:
+            print(f"Job {job['id']} ({job['kind']}) failed after {job['attempts']} attempts: {error}")
+
+    def pending(self, kind: str) -> List[Dict]:
+        """Payloads of the jobs of `kind` that haven't finished yet."""
+        rows = self._connect().execute("SELECT payload FROM jobs WHERE status IN ('queued', 'running') AND kind = ?",
+                                       (kind,))
+        return [json.loads(row['payload']) for row in rows]
+
+    def purge(self, older_than: float) -> int:
+        """Delete finished jobs last updated more than `older_than` seconds ago."""
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM jobs WHERE status = 'done' AND updated < ?",
+                                (time.time() - older_than,)).rowcount
+
+    def stats(self) -> Dict[str, int]:
+        """Number of jobs in each status."""
+        counts = dict.fromkeys(STATUSES, 0)
+        for row in self._connect().execute('SELECT status, COUNT(*) AS count FROM jobs GROUP BY status'):
+            counts[row['status']] = row['count']
+        return counts
+
+    def _spawn_missing(self, config: Dict[str, Any]):
+        """Start workers until this process has `workers` of them alive."""
+        from jobs.worker import run_worker
+
+        context = multiprocessing.get_context('spawn')
+        self._processes = [process for process in self._processes if process.is_alive()]
+        while len(self._processes) < self.workers:
+            process = context.Process(target=run_worker, args=(config, os.getpid()), daemon=True,
+                                      name='puploader-jobs')
+            process.start()
+            self._processes.append(process)
+
+    def _supervise(self, config: Dict[str, Any]):
+        """Restart workers that died (e.g. killed for using too much memory) until stop_workers is called."""
+        while not self._stopped.wait(self.poll_interval):
+            with self._lock:
+                if self._stopped.is_set() or self._processes_pid != os.getpid():
+                    return
+                self._spawn_missing(config)
+
+    def start_workers(self, config: Dict[str, Any]):
+        """Start this process's job workers, unless they are already running.
+
+        Args:
+            config (Dict): Settings the workers build their own app from.
+        """
+        if self.workers <= 0:
+            return
+
+        with self._lock:
+            if self._processes_pid == os.getpid():
+                return
+            self._processes, self._processes_pid = [], os.getpid()
+            self._stopped.clear()
+            self._spawn_missing(config)
+
+        threading.Thread(target=self._supervise, args=(config,), daemon=True, name='puploader-jobs-supervisor').start()
+
+    def stop_workers(self):
+        """Stop this process's job workers - Jobs they were running are picked up again once their lease runs out."""
+        self._stopped.set()
+        with self._lock:
+            if self._processes_pid == os.getpid():
+                for process in self._processes:
+                    process.terminate()
+                for process in self._processes:
+                    process.join()
+            self._processes = []
+
+
+def worker_config(app) -> Dict[str, Any]:
+    """Settings for job worker processes - The app's own, minus anything that would start more workers."""
+    config = {name: value for name, value in app.config.items() if name.isupper()}
+    config.update(JOB_WORKERS=0, MONGO_ENSURE_INDEXES=False)
+    return config
+
+
+def init_jobs(app) -> JobQueue:
+    """Attach a JobQueue to the app and keep its workers running while the app serves requests."""
+    db_path = app.config.get('JOB_QUEUE_PATH') or os.path.join(app.instance_path, 'jobs.sqlite3')
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+    queue = JobQueue(db_path,
+                     workers=app.config.get('JOB_WORKERS', 1) if app.config.get('JOBS_ENABLED', True) else 0,
+                     lease_seconds=app.config.get('JOB_LEASE_SECONDS', 300),
+                     max_attempts=app.config.get('JOB_MAX_ATTEMPTS', 5),
+                     retry_backoff=app.config.get('JOB_RETRY_BACKOFF', 2),
+                     poll_interval=app.config.get('JOB_POLL_INTERVAL', 1))
+    app.extensions['jobs'] = queue
+    return queue
+
+
+def start_job_workers(app):
+    """Start the app's job workers in this process - Called once per server process that should run jobs.
+
+    gunicorn does so from post_worker_init, `python run.py` before serving. Elsewhere (e.g. `flask run`),
+    run `flask run-jobs` alongside the app.
+    """
+    app.extensions['jobs'].start_workers(worker_config(app))
+
+
+def get_jobs() -> JobQueue:
+    """Return the current app's job queue."""
+    return current_app.extensions['jobs']
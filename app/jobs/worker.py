@@ -0,0 +1,280 @@
+"""
+Job handlers and the loop run by each job worker process.
+
+Handlers are idempotent - Running one twice (after a retry, or a worker dying mid-job) leaves
+storage as running it once would, and a job whose photo has since been evicted is a no-op.
+"""
+import datetime
+import os
+import socket
+import sqlite3
+import tempfile
+import time
+from typing import Any, Callable, Dict, Optional
+from flask import current_app
+from PIL import Image
+from catalog.catalog import get_catalog
+from catalog.eviction import get_eviction
+from catalog.similarity import NearDuplicateScreen, get_similarity
+from imaging.phash import dhash
+from imaging.thumbnails import generate_local_variants, generate_s3_variants
+from storage.disk_cache import cached_s3_object, get_s3_cache
+from storage.local import commit_staged, hash_stream
+from storage.s3 import (delete_object, download_object, find_stored_object, get_listing, object_exists,
+                        record_uploaded, upload_stream)
+
+TASKS: Dict[str, Callable[[Dict], None]] = {}
+
+# Seconds between sweeps of finished jobs out of the queue.
+_PURGE_INTERVAL = 3600
+
+_EXIF_ORIENTATION = 0x0112
+_EXIF_IFD = 0x8769
+_EXIF_DATETIME_ORIGINAL = 0x9003
+
+
+def task(kind: str):
+    """Register a function as the handler for jobs of `kind`."""
+    def register(function: Callable[[Dict], None]):
+        TASKS[kind] = function
+        return function
+    return register
+
+
+def _local_path(payload: Dict) -> Optional[str]:
+    """Path of the job's local photo, or None if it has been removed since the job was queued."""
+    path = os.path.join(get_catalog().folder_path(payload['folder']), payload['name'])
+    if get_catalog().get_photo(payload['folder'], payload['name']) is None or not os.path.exists(path):
+        return None
+    return path
+
+
+@task('strip_exif')
+def strip_exif(payload: Dict):
+    """Drop EXIF data (GPS position, camera serials, ...) from a local JPEG, keeping only its orientation."""
+    path = _local_path(payload)
+    if path is None:
+        return
+
+    with Image.open(path) as image:
+        exif = image.getexif()
+        if image.format != 'JPEG' or not set(exif) - {_EXIF_ORIENTATION}:
+            return
+
+        kept = Image.Exif()
+        if _EXIF_ORIENTATION in exif:
+            kept[_EXIF_ORIENTATION] = exif[_EXIF_ORIENTATION]
+        tmp_path = f'{path}.exif.tmp'
+        image.save(tmp_path, 'JPEG', quality='keep', exif=kept.tobytes(),
+                   icc_profile=image.info.get('icc_profile'))
+
+    with open(tmp_path, 'rb') as stripped:
+        size, sha256 = hash_stream(stripped)
+    commit_staged(tmp_path, path)
+
+    catalog = get_catalog()
+    photo = catalog.get_photo(payload['folder'], payload['name'])
+    catalog.add_photo(payload['folder'], payload['name'], size, photo['mtime'], sha256, photo['phash'],
+                      photo['similar_to'])
+
+
+@task('extract_metadata')
+def extract_metadata(payload: Dict):
+    """Record a local photo's dimensions, EXIF capture time and (if not hashed at upload) perceptual hash."""
+    path = _local_path(payload)
+    if path is None:
+        return
+
+    with Image.open(path) as image:
+        width, height = image.size
+        taken = image.getexif().get_ifd(_EXIF_IFD).get(_EXIF_DATETIME_ORIGINAL)
+
+    taken_at = None
+    if isinstance(taken, str):
+        try:
+            taken_at = datetime.datetime.strptime(taken.strip('\x00 '), '%Y:%m:%d %H:%M:%S').timestamp()
+        except ValueError:
+            pass
+
+    catalog = get_catalog()
+    catalog.set_metadata(payload['folder'], payload['name'], width, height, taken_at)
+    if catalog.get_photo(payload['folder'], payload['name'])['phash'] is None:
+        catalog.set_phash(payload['folder'], payload['name'], dhash(path))
+
+
+@task('generate_variants')
+def generate_variants(payload: Dict):
+    """Render thumbnail/WebP variants for a local photo or an S3 object."""
+    width = current_app.config.get('THUMBNAIL_WIDTH', 400)
+
+    if 'key' in payload:
+        listing = get_listing(payload['bucket'])
+        if listing.lookup(payload['key']) is None and not object_exists(listing, payload['key']):
+            return
+        cache, obj = get_s3_cache(), listing.lookup(payload['key'])
+        source_path = cached_s3_object(cache, listing, obj) if cache is not None and obj is not None else None
+        generate_s3_variants(listing.bucket_name, payload['key'], width, listing.endpoint_url, source_path)
+        # Web workers' cached listings don't know about the variants yet.
+        get_catalog().bump_version()
+        return
+
+    if _local_path(payload) is None:
+        return
+    generate_local_variants(get_catalog().folder_path(payload['folder']), payload['name'], width)
+    get_catalog().set_has_variants(payload['folder'], payload['name'])
+
+
+@task('evict')
+def evict(payload: Dict):
+    """Bring a folder (and the whole collection) back under its quotas."""
+    get_eviction().evict(payload['folder'])
+
+
+def register_s3_object(listing, catalog, key: str, screen: Optional[NearDuplicateScreen], cache=None) -> Dict:
+    """Hash an object a browser uploaded straight to the bucket, then dedupe, screen and record it.
+
+    Objects byte-identical to one already stored, or turned away by `screen`, are deleted from the bucket.
+
+    Returns:
+        Dict: Like upload_to_s3's - 'key', 'size', 'sha256', 'duplicate_of', 'phash', 'near_duplicate_of'
+              and 'rejected'.
+    """
+    obj = record_uploaded(listing, key)
+    with tempfile.TemporaryFile() as copy:
+        if cache is not None:
+            source = open(cached_s3_object(cache, listing, obj), 'rb')
+        else:
+            download_object(listing, key, obj['etag'], copy)
+            source = copy
+
+        with source:
+            size, sha256 = hash_stream(source)
+            existing_key = find_stored_object(listing, catalog, sha256, cache)
+            if existing_key == key:
+                # Already registered - e.g. by an earlier attempt of the same job.
+                return {'key': key, 'size': size, 'sha256': sha256, 'duplicate_of': None, 'phash': None,
+                        'near_duplicate_of': None, 'rejected': False}
+
+            phash = None
+            if existing_key is None:
+                try:
+                    phash = dhash(source)
+                except (OSError, ValueError) as exc:
+                    print(f'Could not hash {key}: {exc}')
+
+    similar = screen.check(phash, key) if screen is not None and existing_key is None else None
+    rejected = bool(similar) and screen.policy == 'reject'
+    if existing_key is not None or rejected:
+        delete_object(listing, key)
+        if cache is not None:
+            cache.discard(listing.bucket_name, key)
+    else:
+        catalog.add_s3_object(key, sha256, phash, similar)
+    # Web workers' cached listings and pages pick up the deletion or the grouping.
+    catalog.bump_version()
+
+    return {'key': key, 'size': size, 'sha256': sha256, 'duplicate_of': existing_key, 'phash': phash,
+            'near_duplicate_of': similar, 'rejected': rejected}
+
+
+@task('register_s3')
+def register_s3(payload: Dict):
+    """Dedupe, screen and record an object uploaded straight to the bucket (see register_s3_object)."""
+    listing = get_listing(payload['bucket'])
+    if not object_exists(listing, payload['key']):
+        return
+
+    screen = NearDuplicateScreen(get_similarity(), current_app.config.get('NEAR_DUPLICATE_POLICY', 'off'),
+                                 current_app.config.get('NEAR_DUPLICATE_DISTANCE', 6))
+    result = register_s3_object(listing, get_catalog(), payload['key'], screen, get_s3_cache())
+    if result['duplicate_of']:
+        print(f"Deleted {payload['key']}: Already uploaded as {result['duplicate_of']}.")
+    elif result['rejected']:
+        print(f"Deleted {payload['key']}: Looks just like {result['near_duplicate_of']}.")
+
+
+@task('store_s3')
+def store_s3(payload: Dict):
+    """Upload a spooled file to S3 and record it (with its perceptual hash), then remove it from the spool."""
+    catalog = get_catalog()
+    if find_stored_object(get_listing(payload['bucket']), catalog, payload['sha256'], get_s3_cache()) is None:
+        if not os.path.exists(payload['path']):
+            raise FileNotFoundError(f"Spooled upload {payload['path']} is missing.")
+
+        phash = payload.get('phash')
+        if phash is None:
+            try:
+                phash = dhash(payload['path'])
+            except (OSError, ValueError) as exc:
+                print(f"Could not hash {payload['key']}: {exc}")
+
+        with open(payload['path'], 'rb') as stream:
+            stored = upload_stream(get_listing(payload['bucket']), payload['key'], stream, payload['size'],
+                                   content_type=payload.get('content_type'),
+                                   multipart_threshold=current_app.config.get('S3_MULTIPART_THRESHOLD',
+                                                                              8 * 1024 * 1024))
+        catalog.add_s3_object(payload['key'], payload['sha256'], phash, payload.get('similar_to'))
+
+        # The first view (and variant generation) can then skip downloading it again.
+        cache = get_s3_cache()
+        if cache is not None:
+            cache.add(payload['bucket'], payload['key'], stored['etag'], payload['path'])
+
+    try:
+        os.remove(payload['path'])
+    except FileNotFoundError:
+        pass
+
+
+def run_worker(config: Dict[str, Any], parent_pid: Optional[int] = None):
+    """Run jobs until the process is stopped. Runs in a job worker process.
+
+    Args:
+        parent_pid (int): PID of the app process that started this worker - The worker exits once
+                          that process is gone (e.g. a gunicorn worker killed on timeout).
+    """
+    from app import create_app
+
+    app, _ = create_app(config)
+    queue = app.extensions['jobs']
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    purged_at = 0.0
+
+    while parent_pid is None or os.getppid() == parent_pid:
+        # A busy or locked queue database is waited out - Exiting would only get the worker respawned.
+        try:
+            if time.monotonic() - purged_at > _PURGE_INTERVAL:
+                queue.purge(app.config.get('JOB_RETENTION', 7 * 24 * 3600))
+                purged_at = time.monotonic()
+
+            job = queue.claim(worker)
+        except sqlite3.Error as exc:
+            print(f'Job worker {worker} could not read the queue: {exc}')
+            time.sleep(queue.poll_interval)
+            continue
+
+        if job is None:
+            time.sleep(queue.poll_interval)
+            continue
+
+        handler = TASKS.get(job['kind'])
+        try:
+            if handler is None:
+                raise LookupError(f"No handler for {job['kind']} jobs.")
+            with app.app_context():
+                handler(job['payload'])
+        except Exception as exc:
+            error = f'{type(exc).__name__}: {exc}'
+        else:
+            error = None
+
+        # If the outcome can't be recorded, the job's lease runs out and it is retried.
+        try:
+            if error is None:
+                queue.complete(job, worker)
+            else:
+                queue.fail(job, worker, error)
+        except sqlite3.Error as exc:
+            print(f"Job worker {worker} could not record the outcome of job {job['id']}: {exc}")
+
+    print(f'Job worker {worker} stopping - The process that started it has exited.')
@@ -0,0 +1,133 @@
+"""
+Request timing and Prometheus metrics for Puploader.
+
+Every request's latency is recorded per route, and `span()` blocks time the slow dependencies
+(S3 listings, Mongo commands, PetFinder/Charity Navigator calls, bcrypt and template rendering).
+Cache lookups are counted by cache and result.
+Under gunicorn, set PROMETHEUS_MULTIPROC_DIR (gunicorn_config.py does) so `/metrics` reports
+totals across all workers. Requests slower than SLOW_REQUEST_LOG_SECONDS are logged with the
+time spent in each span.
+"""
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+from flask import Response, before_render_template, g, has_request_context, request, template_rendered
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess)
+
+REQUEST_LATENCY = Histogram('puploader_request_duration_seconds', 'Time spent serving requests.',
+                            ['method', 'route', 'status'])
+SPAN_LATENCY = Histogram('puploader_span_duration_seconds', 'Time spent in instrumented operations.',
+                         ['span'])
+CACHE_REQUESTS = Counter('puploader_cache_requests_total', 'Cache lookups by result (hit/miss/stale).',
+                         ['cache', 'result'])
+CACHE_BYTES = Counter('puploader_cache_bytes_total', 'Bytes served by cache lookups, by result (hit/miss).',
+                      ['cache', 'result'])
+
+
+def record_span(name: str, seconds: float):
+    """Record time spent in `name`, adding it to the current request's breakdown if there is one."""
+    SPAN_LATENCY.labels(name).observe(seconds)
+
+    if has_request_context():
+        spans: Dict[str, List[float]] = g.setdefault('spans', {})
+        totals = spans.setdefault(name, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += 1
+
+
+def record_cache(cache: str, result: str, size: int = 0):
+    """Count a lookup in `cache` that was a `result` ('hit', 'miss' or 'stale') for an entry of `size` bytes."""
+    CACHE_REQUESTS.labels(cache, result).inc()
+    CACHE_BYTES.labels(cache, result).inc(size)
+
+
+@contextmanager
+def span(name: str):
+    """Time the enclosed block as `name`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started)
+
+
+def mongo_command_listener():
+    """Listener recording every MongoDB command as a `mongo.<command>` span - Pass it to MongoClient.
+
+    Built on demand so that importing this module doesn't import pymongo.
+    """
+    from pymongo import monitoring
+
+    class MongoCommandTimer(monitoring.CommandListener):
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            record_span(f'mongo.{event.command_name}', event.duration_micros / 1e6)
+
+        def failed(self, event):
+            record_span(f'mongo.{event.command_name}', event.duration_micros / 1e6)
+
+    return MongoCommandTimer()
+
+
+def _template_started(sender, template, context, **extra):
+    g.setdefault('template_starts', []).append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    starts = g.get('template_starts')
+    if starts:
+        record_span('render.template', time.perf_counter() - starts.pop())
+
+
+def _record_request(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    REQUEST_LATENCY.labels(request.method, route, str(response.status_code)).observe(elapsed)
+
+    threshold = g.get('slow_request_seconds')
+    if threshold is not None and elapsed >= threshold:
+        spans = g.get('spans', {})
+        breakdown = ', '.join(f'{name}={seconds:.3f}s ({count})'
+                              for name, (seconds, count) in sorted(spans.items(), key=lambda item: -item[1][0]))
+        other = elapsed - sum(seconds for seconds, _ in spans.values())
+        print(f'Slow request: {request.method} {request.full_path.rstrip("?")} {response.status_code} '
+              f'took {elapsed:.3f}s - {breakdown or "no spans"}, other={max(other, 0):.3f}s')
+
+    return response
+
+
+def metrics_registry() -> CollectorRegistry:
+    """Registry to export - Aggregated across worker processes when running under gunicorn."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def init_metrics(app):
+    """Time every request and template render, and serve the metrics on METRICS_PATH."""
+    slow_request_seconds: Optional[float] = app.config.get('SLOW_REQUEST_LOG_SECONDS')
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+        g.slow_request_seconds = slow_request_seconds
+
+    app.after_request(_record_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_rendered, app)
+
+    if app.config.get('METRICS_ENABLED', True):
+        @app.route(app.config.get('METRICS_PATH', '/metrics'))
+        def metrics():
+            """Prometheus scrape endpoint."""
+            return Response(generate_latest(metrics_registry()), content_type=CONTENT_TYPE_LATEST)
@@ -1,16 +1,51 @@
-import requests
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional
+from api_client.api_client import ApiClient, ApiError
+from metrics.metrics import span
+
+BASE_URL = 'https://api.petfinder.com/v2'
 
 
 class PetFinder:
+    """
+    Thread-safe wrapper for PetFinder's REST API.
+
+    One instance is meant to be shared by every request in a process - The access token is cached until
+    shortly before it expires, refreshed in the background, and re-fetched once if PetFinder rejects it.
+    Failed calls raise api_client.ApiError.
+
+    Multi-page and multi-query lookups run on a small thread pool: page iterators prefetch the next
+    page while the caller processes the current one, and batch searches fan out across locations/types.
+    """
 
-    def __init__(self, api_key: str, api_sec: str):
+    def __init__(self, api_key: str, api_sec: str, refresh_margin: float = 60, client: ApiClient = None,
+                 max_workers: int = 4, base_url: str = BASE_URL):
         self.api_key = api_key
         self.api_sec = api_sec
-        self.base_url = 'https://api.petfinder.com/v2'
+        self.base_url = base_url
+        self.refresh_margin = refresh_margin
 
-        self.client = requests.session()
+        self.client = client or ApiClient()
+
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_timer = None
+
+        self.max_workers = max_workers
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pool_pid = None
 
     def auth(self):
+        with self._lock:
+            return self._fetch_token()
+
+    def _fetch_token(self):
+        """Request a new access token - Callers must hold self._lock."""
         data = {'grant_type': 'client_credentials',
                 'client_id': self.api_key,
                 'client_secret': self.api_sec}
@@ -18,34 +53,155 @@ class PetFinder:
         response = self.client.post(f'{self.base_url}/oauth2/token',
                                     data=data)
 
-        if response.status_code == 200:
-            token = response.json()['access_token']
-        else:
-            print('Error authenticating.')
-            return None
+        if response.status_code != 200:
+            raise ApiError.from_response(response, 'Error authenticating with PetFinder.')
 
-        self.client.headers = {'Authorization': f'Bearer {token}'}
+        token = response.json()['access_token']
+        expires_in = response.json().get('expires_in', 3600)
+
+        self._token = token
+        self._expires_at = time.monotonic() + expires_in
+        self._schedule_refresh(expires_in - self.refresh_margin)
 
         return token
 
-    def get_organizations(self, **kwargs):
+    def _schedule_refresh(self, delay: float):
+        """Refresh the token in the background after `delay` seconds."""
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+
+        self._refresh_timer = threading.Timer(max(delay, 1), self._background_refresh)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _background_refresh(self):
+        with self._lock:
+            try:
+                self._fetch_token()
+            except ApiError as exc:
+                print('Error refreshing PetFinder token: ', exc)
+                self._schedule_refresh(30)
+
+    def token(self):
+        """Return a valid access token, fetching one only if the cached token is (nearly) expired."""
+        if self._token and time.monotonic() < self._expires_at - self.refresh_margin:
+            return self._token
+
+        with self._lock:
+            if self._token and time.monotonic() < self._expires_at - self.refresh_margin:
+                return self._token
+            return self._fetch_token()
+
+    def _get(self, path: str, params: dict):
+        """GET an API path, retrying once with a fresh token if the current one is rejected."""
+        token = self.token()
+        response = self.client.get(f'{self.base_url}/{path}', params=params,
+                                   headers={'Authorization': f'Bearer {token}'})
+
+        if response.status_code == 401:
+            with self._lock:
+                # Only re-authenticate if no other thread has already replaced the rejected token.
+                fresh_token = self._token if self._token != token else self._fetch_token()
+            response = self.client.get(f'{self.base_url}/{path}', params=params,
+                                       headers={'Authorization': f'Bearer {fresh_token}'})
+
+        if response.status_code != 200:
+            raise ApiError.from_response(response)
+
+        return response.json()
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        """Thread pool for prefetching and fan-out, recreated after a fork."""
+        with self._lock:
+            if self._pool_pid != os.getpid():
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='petfinder')
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def iter_pages(self, path: str, key: str, params: Dict, max_pages: Optional[int] = None,
+                   prefetch: bool = True) -> Iterator[List[Dict]]:
+        """
+        Yield each page of results for an API path, requesting page n+1 while page n is being consumed.
+
+        Args:
+            path (str): API path, e.g. 'animals'.
+            key (str): Key holding the results in each response, e.g. 'animals'.
+            params (Dict): Query parameters applied to every page.
+            max_pages (int): Stop after this many pages (all pages if None).
+            prefetch (bool): Fetch the next page in the background - Disable when already on the pool.
+        """
+        def fetch(page: int) -> Dict:
+            return self._get(path, dict(params, page=page))
+
+        response = fetch(1)
+        for page in itertools.count(1):
+            pagination = response.get('pagination', {})
+            has_next = (page < pagination.get('total_pages', 1)
+                        and (max_pages is None or page < max_pages))
+
+            upcoming = self.pool.submit(fetch, page + 1) if has_next and prefetch else None
+            try:
+                yield response[key]
+            except GeneratorExit:
+                # The caller stopped early - Don't fetch a page nobody will read.
+                if upcoming is not None:
+                    upcoming.cancel()
+                raise
+
+            if not has_next:
+                return
+            response = upcoming.result() if upcoming is not None else fetch(page + 1)
+
+    def iter_animals(self, max_pages: Optional[int] = None, **kwargs) -> Iterator[Dict]:
+        """Yield every animal matching `kwargs`, page by page."""
+        for page in self.iter_pages('animals', 'animals', kwargs, max_pages=max_pages):
+            yield from page
+
+    def iter_organizations(self, max_pages: Optional[int] = None, **kwargs) -> Iterator[Dict]:
+        """Yield every organization matching `kwargs`, page by page."""
+        for page in self.iter_pages('organizations', 'organizations', kwargs, max_pages=max_pages):
+            yield from page
+
+    def search(self, path: str, key: str, queries: Iterable[Dict], max_pages: int = 1) -> List[Dict]:
+        """
+        Run several queries against an API path concurrently and merge their results.
+
+        Results keep the order of the queries and are de-duplicated by id, so overlapping
+        locations (or an animal matching more than one type) only appear once.
+        """
+        def run(params: Dict) -> List[Dict]:
+            return [result for page in self.iter_pages(path, key, params, max_pages=max_pages, prefetch=False)
+                    for result in page]
+
+        merged, seen = [], set()
+        with span(f'petfinder.search.{path}'):
+            for results in self.pool.map(run, list(queries)):
+                for result in results:
+                    if result.get('id') not in seen:
+                        seen.add(result.get('id'))
+                        merged.append(result)
+        return merged
+
+    def search_animals(self, locations: Iterable[str], types: Iterable[str] = ('dog',), max_pages: int = 1,
+                       **kwargs) -> List[Dict]:
+        """Animals of any of `types` near any of `locations`, fetched concurrently."""
+        queries = [dict(kwargs, type=animal_type, location=location)
+                   for location in locations for animal_type in types]
+        return self.search('animals', 'animals', queries, max_pages=max_pages)
+
+    def search_organizations(self, locations: Iterable[str], max_pages: int = 1, **kwargs) -> List[Dict]:
+        """Organizations near any of `locations`, fetched concurrently."""
+        queries = [dict(kwargs, location=location) for location in locations]
+        return self.search('organizations', 'organizations', queries, max_pages=max_pages)
+
+    def get_organizations(self, limit: Optional[int] = None, **kwargs):
         params = kwargs
-        params['limit'] = 10
-
-        response = self.client.get(f'{self.base_url}/organizations', params=params)
-
-        if response.status_code == 200:
-            return response.json()['organizations']
+        if limit is not None:
+            params['limit'] = limit
 
-        print('Error: ', response.status_code, response.headers, response.text)
-        return None
+        return self._get('organizations', params)['organizations']
 
     def get_animals(self, **kwargs):
 
-        response = self.client.get(f'{self.base_url}/animals', params=kwargs)
-
-        if response.status_code == 200:
-            return response.json()['animals']
-
-        print('Error: ', response.status_code, response.headers, response.text)
-        return None
+        return self._get('animals', kwargs)['animals']
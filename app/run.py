@@ -1,14 +1,16 @@
 """
 This is the primary entrypoint for Puploader.
 """
-import os
-from flask import render_template, session, url_for
+from flask import render_template, session
 from flask_login import LoginManager
-from views.photos import get_s3_photos
+from caching.pages import cached_page
+from views.photos import get_photo_page
 from app import create_app
+from jobs.queue import start_job_workers
+from user import User
 
 
-app, users = create_app()
+app, database = create_app()
 login_manager = LoginManager()
 login_manager.init_app(app)
 
@@ -18,27 +20,24 @@ def load_user(user_id):
     """
     Retrieve user information based on their unique ID.
     """
-    return users.find_one({'user_id': user_id})['user_id']
+    return User.get(user_id)
 
 
 @app.route('/')
 def puploader_landing():
     """
     Puploader's landing page.
-    Renders index.html/index_unauth.html based on session information.
+    Renders index.html/index_unauth.html based on session information, showing the newest page of photos.
     """
-    if app.config['S3_BUCKET']:
-        bucket_name = "https://puploader.s3.us-east-2.amazonaws.com/"
-        photos = get_s3_photos()
-        photos = [f'{bucket_name}' + photo for photo in photos]
-    else:
-        photos = [photo for photo in os.listdir(app.config['UPLOAD_FOLDER']) if '.' in photo]
-        photos = [url_for('static', filename='uploads/' + photo) for photo in photos]
+    def render():
+        photos = get_photo_page()[0]
 
-    if "username" in session:
-        return render_template('index.html', photos=photos, auth=("username" in session))
+        if "username" in session:
+            return render_template('index.html', photos=photos, auth=("username" in session))
 
-    return render_template('index_unauth.html', photos=photos, auth=False)
+        return render_template('index_unauth.html', photos=photos, auth=False)
+
+    return cached_page('index', render)
 
 
 @app.route('/about', methods=['GET'])
@@ -50,4 +49,5 @@ def render_about():
 
 
 if __name__ == '__main__':
+    start_job_workers(app)
     app.run(host='0.0.0.0', port=5000)
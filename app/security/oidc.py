@@ -0,0 +1,188 @@
+"""
+Cached OpenID Connect provider metadata and local ID token validation (used for Google sign-in).
+
+The discovery document and the provider's signing keys (JWKS) are cached process-wide for as
+long as the provider's Cache-Control/Expires headers allow, so a sign-in costs a single
+round trip - the authorization code exchange - instead of fetching them on every request.
+"""
+import email.utils
+import os
+import re
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, Optional
+import requests
+from flask import current_app
+
+if TYPE_CHECKING:
+    import jwt
+
+GOOGLE_DISCOVERY_URL = 'https://accounts.google.com/.well-known/openid-configuration'
+GOOGLE_ISSUERS = ('https://accounts.google.com', 'accounts.google.com')
+
+
+class OidcError(Exception):
+    """
+    Raised when provider metadata can't be fetched or an ID token fails validation.
+    """
+
+
+def cache_lifetime(headers, default: float) -> float:
+    """Seconds a response may be cached for, going by its Cache-Control and Expires headers."""
+    cache_control = headers.get('Cache-Control', '').lower()
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return 0
+
+    max_age = re.search(r'max-age=(\d+)', cache_control)
+    if max_age:
+        return max(float(max_age.group(1)) - float(headers.get('Age', 0) or 0), 0)
+
+    if headers.get('Expires'):
+        try:
+            return max(email.utils.parsedate_to_datetime(headers['Expires']).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return 0
+
+    return default
+
+
+class CachedDocument:
+    """
+    A JSON document fetched over HTTP and cached for as long as its response headers allow.
+
+    If a refresh fails, the last good copy keeps being served rather than failing sign-ins.
+    """
+
+    def __init__(self, url: str, default_ttl: float = 3600, timeout: float = 10):
+        self.url = url
+        self.default_ttl = default_ttl
+        self.timeout = timeout
+
+        self._value: Optional[Dict] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, force: bool = False) -> Dict:
+        """Return the document, fetching it only if the cached copy has expired (or `force` is set)."""
+        if not force and self._value is not None and time.monotonic() < self._expires_at:
+            return self._value
+
+        with self._lock:
+            if not force and self._value is not None and time.monotonic() < self._expires_at:
+                return self._value
+
+            try:
+                response = requests.get(self.url, timeout=self.timeout)
+                response.raise_for_status()
+                value = response.json()
+            except (requests.RequestException, ValueError) as exc:
+                if self._value is None:
+                    raise OidcError(f'Error fetching {self.url}: {exc}') from exc
+                print(f'Error refreshing {self.url} - Serving cached copy: ', exc)
+                self._expires_at = time.monotonic() + min(self.default_ttl, 60)
+                return self._value
+
+            self._value = value
+            self._expires_at = time.monotonic() + cache_lifetime(response.headers, self.default_ttl)
+            return value
+
+
+class OidcProvider:
+    """
+    Process-wide view of an OpenID Connect provider for one client ID.
+    """
+
+    def __init__(self, discovery_url: str, client_id: str, issuers: Optional[Iterable[str]] = None,
+                 default_ttl: float = 3600, min_jwks_refresh: float = 60, leeway: float = 30):
+        self.client_id = client_id
+        self.issuers = list(issuers) if issuers else None
+        self.default_ttl = default_ttl
+        self.min_jwks_refresh = min_jwks_refresh
+        self.leeway = leeway
+
+        self.discovery = CachedDocument(discovery_url, default_ttl=default_ttl)
+        self._jwks: Optional[CachedDocument] = None
+        self._jwks_refreshed = 0.0
+        self._lock = threading.Lock()
+
+    def config(self) -> Dict:
+        """The provider's discovery document."""
+        return self.discovery.get()
+
+    def _jwks_document(self) -> CachedDocument:
+        jwks_uri = self.config()['jwks_uri']
+        with self._lock:
+            if self._jwks is None or self._jwks.url != jwks_uri:
+                self._jwks = CachedDocument(jwks_uri, default_ttl=self.default_ttl)
+            return self._jwks
+
+    def signing_key(self, kid: Optional[str]) -> 'jwt.PyJWK':
+        """Return the provider's signing key with ID `kid`, re-fetching the JWKS once if it is unknown."""
+        import jwt
+
+        document = self._jwks_document()
+
+        for attempt in range(2):
+            for key in document.get(force=attempt > 0).get('keys', []):
+                if kid is None or key.get('kid') == kid:
+                    return jwt.PyJWK(key)
+
+            # Keys rotate - Only refetch early if we haven't just done so.
+            with self._lock:
+                if time.monotonic() - self._jwks_refreshed < self.min_jwks_refresh:
+                    break
+                self._jwks_refreshed = time.monotonic()
+
+        raise OidcError(f'No signing key found for kid {kid!r}.')
+
+    def validate_id_token(self, id_token: str, nonce: str) -> Dict:
+        """
+        Verify an ID token's signature, issuer, audience and expiry locally and return its claims.
+
+        Args:
+            nonce (str): The nonce sent with the authorization request - The token must carry the same one.
+
+        Raises:
+            OidcError: If the token is invalid or was issued for another client/nonce.
+        """
+        import jwt
+
+        if not nonce:
+            raise OidcError('No nonce to check the ID token against - The sign-in was not started here.')
+
+        config = self.config()
+        try:
+            header = jwt.get_unverified_header(id_token)
+            key = self.signing_key(header.get('kid'))
+            algorithms = [alg for alg in config.get('id_token_signing_alg_values_supported', ['RS256'])
+                          if alg != 'none']
+            claims = jwt.decode(id_token, key.key,
+                                algorithms=algorithms,
+                                audience=self.client_id,
+                                issuer=self.issuers or config['issuer'],
+                                leeway=self.leeway,
+                                options={'require': ['exp', 'iat', 'iss', 'aud', 'sub']})
+        except jwt.PyJWTError as exc:
+            raise OidcError(f'Invalid ID token: {exc}') from exc
+
+        if claims.get('nonce') != nonce:
+            raise OidcError('ID token nonce does not match.')
+
+        return claims
+
+
+def init_oidc(app) -> OidcProvider:
+    """Attach the Google OpenID Connect provider configured for the app to it."""
+    discovery_url = app.config.get('GOOGLE_DISCOVERY_URL', GOOGLE_DISCOVERY_URL)
+
+    provider = OidcProvider(discovery_url,
+                            client_id=app.config.get('GOOGLE_CLIENT_ID') or os.environ.get('GOOGLE_CLIENT_ID'),
+                            issuers=GOOGLE_ISSUERS if discovery_url == GOOGLE_DISCOVERY_URL else None,
+                            default_ttl=app.config.get('OIDC_CACHE_TTL', 3600))
+    app.extensions['oidc'] = provider
+    return provider
+
+
+def get_oidc() -> OidcProvider:
+    """Return the current app's OpenID Connect provider."""
+    return current_app.extensions['oidc']
@@ -0,0 +1,127 @@
+"""
+Password hashing and verification on a dedicated process pool.
+
+bcrypt is deliberately slow, so running it on gunicorn's request threads lets a burst of logins
+starve every other request. Work is queued to a small pool instead, and callers are turned away
+immediately (HashingBusy) once too many jobs are waiting.
+"""
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Optional
+from flask import current_app
+from metrics.metrics import span
+
+
+class HashingBusy(Exception):
+    """
+    Raised when the hashing queue is full - Callers should answer with a 503.
+    """
+
+
+def _hash_password(password: bytes, rounds: int) -> bytes:
+    """Hash a password with the given work factor. Runs in a pool process."""
+    import bcrypt
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds))
+
+
+def _check_password(password: bytes, hashed: bytes) -> bool:
+    """Check a password against its hash. Runs in a pool process."""
+    import bcrypt
+    return bcrypt.checkpw(password, hashed)
+
+
+def hash_rounds(hashed: bytes) -> Optional[int]:
+    """Work factor a bcrypt hash was made with, read from its `$2b$<rounds>$` prefix."""
+    try:
+        return int(hashed.split(b'$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """
+    Bounded, process-pool backed bcrypt hasher.
+
+    The pool is created lazily (and re-created after a fork) so each gunicorn worker owns its own.
+    """
+
+    def __init__(self, rounds: int = 12, max_workers: int = 2, max_pending: int = 16, timeout: float = 10):
+        self.rounds = rounds
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        """The hashing pool for this process."""
+        with self._lock:
+            if self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _submit(self, function: Callable, *args) -> Future:
+        """Queue a job, refusing it outright if `max_pending` jobs are already queued or running."""
+        if not self._pending.acquire(blocking=False):
+            raise HashingBusy('Password hashing queue is full.')
+
+        try:
+            future = self.pool.submit(function, *args)
+        except BaseException:
+            self._pending.release()
+            raise
+
+        future.add_done_callback(lambda _: self._pending.release())
+        return future
+
+    def _run(self, function: Callable, *args):
+        """Run a job on the pool and wait for its result, giving up after `timeout` seconds."""
+        future = self._submit(function, *args)
+        try:
+            with span('bcrypt'):
+                return future.result(self.timeout)
+        except concurrent.futures.TimeoutError as exc:
+            future.cancel()
+            raise HashingBusy('Timed out waiting for password hashing.') from exc
+
+    def hash(self, password: str) -> bytes:
+        """Hash a password with the configured work factor."""
+        return self._run(_hash_password, password.encode('utf-8'), self.rounds)
+
+    def verify(self, password: str, hashed: bytes) -> bool:
+        """Check a password against a stored hash."""
+        return self._run(_check_password, password.encode('utf-8'), hashed)
+
+    def needs_rehash(self, hashed: bytes) -> bool:
+        """Whether a stored hash was made with a different work factor than the configured one."""
+        return hash_rounds(hashed) != self.rounds
+
+    def shutdown(self):
+        """Wait for queued jobs and stop the pool."""
+        with self._lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown(wait=True)
+            self._pool = self._pool_pid = None
+
+
+def init_hasher(app) -> PasswordHasher:
+    """Attach a PasswordHasher to the app."""
+    hasher = PasswordHasher(rounds=app.config.get('BCRYPT_ROUNDS', 12),
+                            max_workers=app.config.get('PASSWORD_WORKERS', 2),
+                            max_pending=app.config.get('PASSWORD_MAX_PENDING', 16),
+                            timeout=app.config.get('PASSWORD_TIMEOUT', 10))
+    app.extensions['passwords'] = hasher
+    return hasher
+
+
+def get_hasher() -> PasswordHasher:
+    """Return the current app's password hasher."""
+    return current_app.extensions['passwords']
@@ -0,0 +1,90 @@
+// Direct-to-S3 uploads for public instances - Files go straight from the browser to the bucket,
+// in parallel, using URLs presigned in one batch by /sign_s3/batch. Private instances keep posting the form.
+const uploadForm = document.getElementById("uploadForm");
+const uploadStatus = document.getElementById("uploadStatus");
+const MAX_PARALLEL_UPLOADS = 4;
+
+async function runLimited(tasks, limit) {
+    const results = new Array(tasks.length);
+    let next = 0;
+    async function worker() {
+        while (next < tasks.length) {
+            const index = next++;
+            results[index] = await tasks[index]();
+        }
+    }
+    await Promise.all(Array.from({ length: Math.min(limit, tasks.length) }, worker));
+    return results;
+}
+
+async function postUpload(file, post) {
+    const body = new FormData();
+    Object.entries(post.fields).forEach(([name, value]) => body.append(name, value));
+    body.append("file", file);
+
+    const response = await fetch(post.url, { method: "POST", body: body });
+    if (!response.ok) {
+        throw new Error(`S3 rejected the upload (${response.status})`);
+    }
+    return {};
+}
+
+async function multipartUpload(file, multipart) {
+    const tasks = multipart.parts.map((part) => async () => {
+        const start = (part.part_number - 1) * multipart.part_size;
+        const response = await fetch(part.url, { method: "PUT", body: file.slice(start, start + multipart.part_size) });
+        if (!response.ok) {
+            throw new Error(`S3 rejected part ${part.part_number} (${response.status})`);
+        }
+        return { part_number: part.part_number, etag: response.headers.get("ETag") };
+    });
+    return { parts: await runLimited(tasks, MAX_PARALLEL_UPLOADS) };
+}
+
+async function uploadOne(file, upload) {
+    try {
+        const result = upload.multipart ? await multipartUpload(file, upload.multipart) : await postUpload(file, upload.post);
+        return { token: upload.token, ...result };
+    } catch (error) {
+        return { token: upload.token, error: error.message };
+    }
+}
+
+async function directUpload(event) {
+    event.preventDefault();
+    const files = Array.from(document.getElementById("files").files);
+    if (!files.length) {
+        uploadForm.submit();
+        return;
+    }
+
+    uploadStatus.textContent = `Uploading ${files.length} file(s)...`;
+    const signResponse = await fetch("/sign_s3/batch", {
+        method: "POST",
+        credentials: "same-origin",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ files: files.map((file) => ({ name: file.name, type: file.type, size: file.size })) }),
+    });
+    if (!signResponse.ok) {
+        uploadStatus.textContent = "Could not start the upload - Please try again.";
+        return;
+    }
+
+    const signed = (await signResponse.json()).uploads;
+    const tasks = signed.map((upload, index) => () => (upload.token ? uploadOne(files[index], upload) : null));
+    const results = (await runLimited(tasks, MAX_PARALLEL_UPLOADS)).filter((result) => result);
+
+    await fetch("/uploaded/complete", {
+        method: "POST",
+        credentials: "same-origin",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ uploads: results }),
+    });
+
+    // Outcomes are flashed server-side, as they are for regular uploads.
+    window.location = "/upload";
+}
+
+if (uploadForm && uploadForm.dataset.directUpload === "true") {
+    uploadForm.addEventListener("submit", directUpload);
+}
@@ -0,0 +1,74 @@
+// Infinite scroll for the gallery - Fetches the next page from /api/photos as the sentinel comes into view.
+const grid = document.getElementById("photoGrid");
+const sentinel = document.getElementById("gallerySentinel");
+let loading = false;
+
+function appendPhoto(photo) {
+    const col = document.createElement("div");
+    col.className = "col-lg-4";
+
+    const card = document.createElement("div");
+    card.className = "card";
+
+    // Thumbnails fall back to the original until the variant pipeline has caught up.
+    const picture = document.createElement("picture");
+    if (photo.thumb_webp) {
+        const source = document.createElement("source");
+        source.srcset = photo.thumb_webp;
+        source.type = "image/webp";
+        picture.appendChild(source);
+    }
+
+    const img = document.createElement("img");
+    img.className = "card-img-top";
+    img.title = photo.name;
+    img.alt = "card-img";
+    img.loading = "lazy";
+    img.src = photo.thumb;
+    picture.appendChild(img);
+
+    card.appendChild(picture);
+    col.appendChild(card);
+    grid.appendChild(col);
+}
+
+async function loadNextPage(observer) {
+    const cursor = grid.dataset.nextCursor;
+    if (loading || !cursor) {
+        return;
+    }
+
+    loading = true;
+    const params = new URLSearchParams({ folder: grid.dataset.folder, cursor: cursor });
+    try {
+        const response = await fetch(`/api/photos?${params}`, { credentials: "same-origin" });
+        if (!response.ok) {
+            throw new Error(`Failed to load photos: ${response.status}`);
+        }
+        const page = await response.json();
+        page.photos.forEach(appendPhoto);
+        grid.dataset.nextCursor = page.next_cursor || "";
+        if (!page.next_cursor) {
+            observer.disconnect();
+        }
+    } catch (error) {
+        console.log(error);
+        observer.disconnect();
+    } finally {
+        loading = false;
+    }
+
+    // The observer only fires on changes, so keep going while the sentinel is still on screen.
+    if (grid.dataset.nextCursor && sentinel.getBoundingClientRect().top < window.innerHeight + 600) {
+        loadNextPage(observer);
+    }
+}
+
+if (grid && sentinel && grid.dataset.nextCursor) {
+    const observer = new IntersectionObserver((entries) => {
+        if (entries.some((entry) => entry.isIntersecting)) {
+            loadNextPage(observer);
+        }
+    }, { rootMargin: "600px" });
+    observer.observe(sentinel);
+}
@@ -0,0 +1,115 @@
+"""
+ZIP archives of photos, streamed out as they are built and read in one entry at a time.
+
+Exports are written with Python's zipfile into a sink the response generator drains after every
+chunk, so only one chunk of a photo is in memory at a time and nothing touches disk. Entries are
+stored uncompressed (photos don't compress) and, as the output can't be seeked back into, each
+entry's CRC and sizes follow its data in a data descriptor.
+
+Imports walk the archive's central directory and hand out one entry at a time as a file object -
+Only the entry being ingested is ever decompressed.
+"""
+import io
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from contextlib import closing
+from typing import BinaryIO, Callable, Iterable, Iterator, List, Tuple
+from catalog.catalog import is_photo
+from storage.local import CHUNK_SIZE
+
+# (name in the archive, size, mtime, callable opening the photo for reading)
+ExportEntry = Tuple[str, int, float, Callable[[], BinaryIO]]
+
+# Earliest timestamp a ZIP entry can carry.
+_ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only stream that holds what was written until it is taken."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries: Iterable[ExportEntry], chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Generate a ZIP archive of `entries` chunk by chunk.
+
+    Photos that can't be opened are left out - Errors while reading one that was opened end the archive.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+        for name, size, mtime, open_photo in entries:
+            try:
+                source = open_photo()
+            except Exception as exc:
+                print(f'Could not export {name}: {exc}')
+                continue
+
+            info = zipfile.ZipInfo(name, max(time.localtime(mtime)[:6], _ZIP_EPOCH))
+            info.external_attr = 0o644 << 16
+            with closing(source), archive.open(info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as member:
+                for chunk in iter(lambda: source.read(chunk_size), b''):
+                    member.write(chunk)
+                    yield sink.take()
+            yield sink.take()
+    yield sink.take()
+
+
+def seekable_upload(stream: BinaryIO) -> BinaryIO:
+    """An uploaded archive as a file zipfile can read entries from - `stream` itself, or a temporary copy.
+
+    Werkzeug spools uploads into a SpooledTemporaryFile, which only has seekable() from Python 3.11.
+    """
+    if hasattr(stream, 'seekable'):
+        return stream
+
+    copy = tempfile.TemporaryFile()
+    shutil.copyfileobj(stream, copy, CHUNK_SIZE)
+    copy.seek(0)
+    return copy
+
+
+def archive_photos(archive: zipfile.ZipFile, max_entries: int, max_bytes: int) -> Tuple[List[zipfile.ZipInfo], int]:
+    """Photo entries of an archive to import, checked against the import limits before anything is read.
+
+    Directories, hidden files (and macOS resource forks) and anything that isn't a photo are skipped.
+
+    Returns:
+        Tuple: The photo entries and how many other entries were skipped.
+
+    Raises:
+        ValueError: If the archive holds more than `max_entries` photos or more than `max_bytes` of them
+                    once decompressed.
+    """
+    photos, skipped = [], 0
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        name = os.path.basename(info.filename)
+        if name.startswith('.') or '__MACOSX/' in info.filename or not is_photo(name):
+            skipped += 1
+            continue
+        photos.append(info)
+
+    if len(photos) > max_entries:
+        raise ValueError(f'Archive holds {len(photos)} photos - At most {max_entries} can be imported at once.')
+    total = sum(info.file_size for info in photos)
+    if total > max_bytes:
+        raise ValueError(f'Archive holds {total} bytes of photos - At most {max_bytes} can be imported at once.')
+    return photos, skipped
@@ -0,0 +1,245 @@
+"""
+Read-through local disk cache for S3 objects, shared by every process on the host.
+
+Objects are cached under (bucket, key, ETag), so an overwritten object is simply a miss. The index
+lives in a SQLite file next to the cached files and is evicted least-recently-used first once the
+cached bytes exceed `max_bytes`. Files are written to a temporary name and renamed into place, and
+a striped set of flock()ed lock files makes sure only one process downloads a given object at a time.
+"""
+import fcntl
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, Callable, Dict, Optional, Tuple
+from flask import current_app
+from metrics.metrics import record_cache, span
+from storage.s3 import S3Listing, download_object
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    file TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (bucket, key)
+);
+CREATE INDEX IF NOT EXISTS objects_lru ON objects (accessed);
+"""
+
+# Number of lock files downloads are striped across.
+_LOCK_STRIPES = 64
+
+
+class DiskCache:
+    """
+    Size-bounded LRU of S3 objects on local disk.
+
+    Hits only record their access time once per `access_resolution` seconds, to keep reads from
+    turning into index writes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1024 ** 3, access_resolution: float = 10):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.access_resolution = access_resolution
+
+        self._local = threading.local()
+        for subdirectory in ('objects', 'locks', 'tmp'):
+            os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection to the index, reopening it after a fork."""
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.conn = sqlite3.connect(os.path.join(self.directory, 'index.sqlite3'), timeout=30)
+            self._local.conn.row_factory = sqlite3.Row
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    @staticmethod
+    def _file_name(bucket: str, key: str, etag: str) -> str:
+        digest = hashlib.sha256(f'{bucket}\0{key}\0{etag}'.encode('utf-8')).hexdigest()
+        return os.path.join(digest[:2], digest)
+
+    @contextmanager
+    def _locked(self, name: str, blocking: bool = True):
+        """Hold an exclusive flock on `locks/<name>` - Yields False if `blocking` is off and it is taken."""
+        with open(os.path.join(self.directory, 'locks', name), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _lookup(self, bucket: str, key: str, etag: str) -> Optional[str]:
+        """Path of the cached copy of this version of the object, if there is one on disk - Counted as a hit."""
+        row = self._connect().execute('SELECT file, size, accessed FROM objects '
+                                      'WHERE bucket = ? AND key = ? AND etag = ?', (bucket, key, etag)).fetchone()
+        if row is None:
+            return None
+
+        path = os.path.join(self.directory, 'objects', row['file'])
+        if not os.path.exists(path):
+            return None
+
+        now = time.time()
+        if now - row['accessed'] >= self.access_resolution:
+            with self._connect() as conn:
+                conn.execute('UPDATE objects SET accessed = ? WHERE bucket = ? AND key = ?', (now, bucket, key))
+        record_cache('s3_disk', 'hit', row['size'])
+        return path
+
+    def _store(self, bucket: str, key: str, etag: str, write: Callable[[BinaryIO], None]) -> Tuple[str, int]:
+        """Write a new cached copy with `write` and index it, replacing any older version of the object.
+
+        Returns:
+            Tuple: Path and size of the cached copy.
+        """
+        file_name = self._file_name(bucket, key, etag)
+        path = os.path.join(self.directory, 'objects', file_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.directory, 'tmp'))
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                write(output)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        conn = self._connect()
+        with conn:
+            old = conn.execute('SELECT file FROM objects WHERE bucket = ? AND key = ?', (bucket, key)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO objects (bucket, key, etag, file, size, accessed) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (bucket, key, etag, file_name, size, time.time()))
+        if old is not None and old['file'] != file_name:
+            self._remove_file(old['file'])
+
+        self.evict(keep=file_name)
+        return path, size
+
+    def _remove_file(self, file_name: str):
+        # Processes already sending the file keep reading it through their open handle.
+        try:
+            os.remove(os.path.join(self.directory, 'objects', file_name))
+        except FileNotFoundError:
+            pass
+
+    def fetch(self, bucket: str, key: str, etag: str, download: Callable[[BinaryIO], None]) -> str:
+        """Return the path of a local copy of an object, downloading it with `download` on a miss.
+
+        Args:
+            download (Callable): Writes this version of the object to the file it is given.
+        """
+        etag = etag.strip('"')
+        path = self._lookup(bucket, key, etag)
+        if path is not None:
+            return path
+
+        stripe = int(hashlib.sha1(f'{bucket}/{key}'.encode('utf-8')).hexdigest(), 16) % _LOCK_STRIPES
+        with self._locked(f'fetch-{stripe}'):
+            # Another process may have downloaded it while we waited for the lock.
+            path = self._lookup(bucket, key, etag)
+            if path is not None:
+                return path
+
+            with span('s3.download'):
+                path, size = self._store(bucket, key, etag, download)
+        record_cache('s3_disk', 'miss', size)
+        return path
+
+    def add(self, bucket: str, key: str, etag: str, source_path: str) -> str:
+        """Seed the cache with a local file known to hold this version of the object - e.g. one just uploaded."""
+        def copy(output: BinaryIO):
+            with open(source_path, 'rb') as source:
+                shutil.copyfileobj(source, output, 1024 * 1024)
+
+        return self._store(bucket, key, etag.strip('"'), copy)[0]
+
+    def discard(self, bucket: str, key: str):
+        """Drop an object from the cache - e.g. after it was deleted from the bucket."""
+        conn = self._connect()
+        with conn:
+            row = conn.execute('DELETE FROM objects WHERE bucket = ? AND key = ? RETURNING file',
+                               (bucket, key)).fetchone()
+        if row is not None:
+            self._remove_file(row['file'])
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """Remove least recently used objects until the cache fits in `max_bytes`, returning how many were removed.
+
+        Args:
+            keep (str): Cached file that must stay - The one the caller is about to serve.
+
+        Only one process evicts at a time - Others skip it, as the running eviction covers their writes too.
+        """
+        removed = 0
+        with self._locked('evict', blocking=False) as acquired:
+            if not acquired:
+                return 0
+
+            conn = self._connect()
+            excess = conn.execute('SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0] - self.max_bytes
+            while excess > 0:
+                rows = conn.execute('SELECT bucket, key, file, size FROM objects WHERE file != ? '
+                                    'ORDER BY accessed LIMIT 64', (keep or '',)).fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    if excess <= 0:
+                        break
+                    with conn:
+                        conn.execute('DELETE FROM objects WHERE bucket = ? AND key = ? AND file = ?',
+                                     (row['bucket'], row['key'], row['file']))
+                    self._remove_file(row['file'])
+                    excess -= row['size']
+                    removed += 1
+        return removed
+
+    def stats(self) -> Dict[str, int]:
+        """Number of cached objects and their total size."""
+        row = self._connect().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects').fetchone()
+        return {'objects': row[0], 'bytes': row[1], 'max_bytes': self.max_bytes}
+
+
+def cached_s3_object(cache: DiskCache, listing: S3Listing, obj: Dict) -> str:
+    """Local path of an S3 object (as listed), downloading it into the cache on a miss.
+
+    Raises:
+        botocore.exceptions.ClientError: If the object is gone or changed since it was listed.
+    """
+    return cache.fetch(listing.bucket_name, obj['key'], obj['etag'],
+                       lambda output: download_object(listing, obj['key'], obj['etag'], output))
+
+
+def init_s3_cache(app) -> Optional[DiskCache]:
+    """Attach a DiskCache for the app's bucket to it - None unless S3_BUCKET is set and S3_CACHE_MAX_BYTES > 0."""
+    max_bytes = app.config.get('S3_CACHE_MAX_BYTES', 1024 ** 3)
+    cache = None
+    if app.config['S3_BUCKET'] and max_bytes > 0:
+        cache = DiskCache(app.config.get('S3_CACHE_FOLDER') or os.path.join(app.instance_path, 's3-cache'),
+                          max_bytes=max_bytes)
+    app.extensions['s3_cache'] = cache
+    return cache
+
+
+def get_s3_cache() -> Optional[DiskCache]:
+    """Return the current app's S3 disk cache, if it has one."""
+    return current_app.extensions['s3_cache']
@@ -0,0 +1,72 @@
+"""
+Streaming writes of uploaded photos to local storage.
+"""
+import hashlib
+import os
+import tempfile
+from typing import BinaryIO, Tuple
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def stage_stream(stream: BinaryIO, directory: str, chunk_size: int = CHUNK_SIZE,
+                 durable: bool = False) -> Tuple[str, int, str]:
+    """Copy a stream in chunks into a temporary file in `directory`, hashing it on the way.
+
+    With `durable`, the file is fsynced before returning, so it survives a crash or power loss.
+
+    Returns:
+        Tuple: Temporary file path, number of bytes written and the SHA-256 hex digest.
+    """
+    file_descriptor, tmp_path = tempfile.mkstemp(prefix='.upload.', suffix='.part', dir=directory)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(file_descriptor, 'wb') as output:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                digest.update(chunk)
+                output.write(chunk)
+                size += len(chunk)
+            if durable:
+                output.flush()
+                os.fsync(output.fileno())
+        os.chmod(tmp_path, 0o644)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return tmp_path, size, digest.hexdigest()
+
+
+def commit_staged(tmp_path: str, path: str):
+    """Atomically move a staged upload into place."""
+    os.replace(tmp_path, path)
+
+
+def link_existing(existing_path: str, path: str) -> bool:
+    """Hard-link an already stored blob to `path` so identical uploads share their bytes.
+
+    Returns:
+        bool: False if the filesystem refused the link.
+    """
+    try:
+        os.link(existing_path, path)
+    except OSError:
+        return False
+    return True
+
+
+def hash_stream(stream: BinaryIO, chunk_size: int = CHUNK_SIZE) -> Tuple[int, str]:
+    """Hash a seekable stream in chunks, leaving it rewound.
+
+    Returns:
+        Tuple: Stream length and SHA-256 hex digest.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+        size += len(chunk)
+    stream.seek(0)
+    return size, digest.hexdigest()
@@ -0,0 +1,273 @@
+"""
+Cached, paginated access to the S3 bucket backing public Puploader instances.
+"""
+import os
+import threading
+import time
+from typing import BinaryIO, Dict, List, Optional
+from flask import current_app
+from metrics.metrics import span
+
+
+class S3Listing:
+    """
+    Process-wide listing of a bucket's objects.
+
+    Listings are fetched page by page (following continuation tokens), cached per prefix for
+    `ttl` seconds and patched in place when Puploader itself writes to the bucket.
+    """
+
+    def __init__(self, bucket_name: str, ttl: float = 60, endpoint_url: Optional[str] = None):
+        self.bucket_name = bucket_name
+        self.ttl = ttl
+        self.endpoint_url = endpoint_url
+
+        self._client = None
+        self._client_pid = None
+        self._lock = threading.Lock()
+        self._fetch_locks: Dict[str, threading.Lock] = {}
+        self._cache: Dict[str, tuple] = {}  # prefix -> (fetched_at, {key: object metadata})
+        self._version = None
+
+    @property
+    def client(self):
+        """Shared boto3 client, recreated after a fork."""
+        if self._client_pid != os.getpid():
+            import boto3
+            self._client = boto3.client('s3', endpoint_url=self.endpoint_url)
+            self._client_pid = os.getpid()
+        return self._client
+
+    def _fetch(self, prefix: str) -> Dict[str, Dict]:
+        """List every object under `prefix`, however many pages that takes."""
+        objects = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                objects[obj['Key']] = {'key': obj['Key'],
+                                       'size': obj['Size'],
+                                       'etag': obj['ETag'].strip('"'),
+                                       'last_modified': obj['LastModified'].timestamp()}
+        return objects
+
+    def _cached(self, prefix: str) -> Optional[Dict[str, Dict]]:
+        """Return a fresh cached listing covering `prefix`, if there is one."""
+        now = time.monotonic()
+        with self._lock:
+            for cached_prefix, (fetched_at, objects) in self._cache.items():
+                if now - fetched_at < self.ttl and prefix.startswith(cached_prefix):
+                    if cached_prefix == prefix:
+                        return objects
+                    return {key: obj for key, obj in objects.items() if key.startswith(prefix)}
+        return None
+
+    def list(self, prefix: str = '') -> List[Dict]:
+        """List the objects under `prefix`, sorted by key."""
+        with span('s3.list'):
+            objects = self._objects(prefix)
+        return [objects[key] for key in sorted(objects)]
+
+    def lookup(self, key: str) -> Optional[Dict]:
+        """Metadata of `key` from the (cached) listing of its folder, or None if it isn't in the bucket."""
+        prefix = key.rsplit('/', 1)[0] + '/' if '/' in key else ''
+        with span('s3.list'):
+            return self._objects(prefix).get(key)
+
+    def _objects(self, prefix: str) -> Dict[str, Dict]:
+        objects = self._cached(prefix)
+        if objects is None:
+            with self._lock:
+                fetch_lock = self._fetch_locks.setdefault(prefix, threading.Lock())
+            with fetch_lock:
+                # Another thread may have refreshed the listing while we waited.
+                objects = self._cached(prefix)
+                if objects is None:
+                    objects = self._fetch(prefix)
+                    with self._lock:
+                        self._cache[prefix] = (time.monotonic(), objects)
+        return objects
+
+    def record_put(self, key: str, size: int, etag: str, last_modified: Optional[float] = None):
+        """Patch cached listings after writing `key` to the bucket."""
+        obj = {'key': key, 'size': size, 'etag': etag.strip('"'),
+               'last_modified': last_modified if last_modified is not None else time.time()}
+        with self._lock:
+            for prefix, (_, objects) in self._cache.items():
+                if key.startswith(prefix):
+                    objects[key] = obj
+
+    def record_delete(self, key: str):
+        """Patch cached listings after removing `key` from the bucket."""
+        with self._lock:
+            for _, objects in self._cache.values():
+                objects.pop(key, None)
+
+    def sync_version(self, version: int):
+        """Drop cached listings if the catalog's storage version moved - e.g. a job worker wrote to the bucket."""
+        with self._lock:
+            if self._version is not None and version != self._version:
+                self._cache.clear()
+            self._version = version
+
+    def invalidate(self, prefix: str = ''):
+        """Drop cached listings under `prefix` (everything by default)."""
+        with self._lock:
+            for cached_prefix in [cached for cached in self._cache if cached.startswith(prefix)]:
+                del self._cache[cached_prefix]
+
+
+def upload_stream(listing: S3Listing, key: str, stream: BinaryIO, size: int,
+                  content_type: Optional[str] = None, multipart_threshold: int = 8 * 1024 * 1024) -> Dict:
+    """Stream an upload into the listing's bucket, using multipart uploads for large files.
+
+    Returns:
+        Dict: Metadata of the new object as recorded in the listing.
+    """
+    extra_args = {'ContentType': content_type} if content_type else {}
+
+    with span('s3.upload'):
+        etag = _put(listing, key, stream, size, extra_args, multipart_threshold)
+
+    listing.record_put(key, size, etag)
+    return {'key': key, 'size': size, 'etag': etag.strip('"')}
+
+
+def _put(listing: S3Listing, key: str, stream: BinaryIO, size: int, extra_args: Dict,
+         multipart_threshold: int) -> str:
+    """Write an object with a single PUT or a multipart upload, returning its ETag."""
+    if size < multipart_threshold:
+        response = listing.client.put_object(Bucket=listing.bucket_name, Key=key, Body=stream, **extra_args)
+        etag = response['ETag']
+    else:
+        from boto3.s3.transfer import TransferConfig
+        config = TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_threshold)
+        listing.client.upload_fileobj(stream, listing.bucket_name, key, ExtraArgs=extra_args, Config=config)
+        etag = listing.client.head_object(Bucket=listing.bucket_name, Key=key)['ETag']
+
+    return etag
+
+
+def object_exists(listing: S3Listing, key: str) -> bool:
+    """Whether `key` is still in the bucket, asked of S3 rather than the cached listing.
+
+    A missing key is dropped from the cached listings too.
+    """
+    from botocore.exceptions import ClientError
+
+    try:
+        listing.client.head_object(Bucket=listing.bucket_name, Key=key)
+    except ClientError as exc:
+        if exc.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+        listing.record_delete(key)
+        return False
+    return True
+
+
+def delete_object(listing: S3Listing, key: str):
+    """Delete an object from the bucket and the cached listings."""
+    listing.client.delete_object(Bucket=listing.bucket_name, Key=key)
+    listing.record_delete(key)
+
+
+def find_stored_object(listing: S3Listing, catalog, sha256: str, cache=None) -> Optional[str]:
+    """Key of an object in the bucket whose contents hash to `sha256`, according to the catalog.
+
+    Catalog entries for objects since deleted from the bucket are dropped along the way, together
+    with their copy in the disk cache (if one is given).
+    """
+    while True:
+        key = catalog.find_s3_object(sha256)
+        if key is None or object_exists(listing, key):
+            return key
+
+        catalog.remove_s3_object(key)
+        catalog.bump_version()
+        if cache is not None:
+            cache.discard(listing.bucket_name, key)
+
+
+def open_object(listing: S3Listing, key: str, etag: str):
+    """Open an object's body for streaming reads - A botocore StreamingBody.
+
+    Raises:
+        botocore.exceptions.ClientError: If the object is gone or no longer has ETag `etag`.
+    """
+    return listing.client.get_object(Bucket=listing.bucket_name, Key=key, IfMatch=f'"{etag}"')['Body']
+
+
+def download_object(listing: S3Listing, key: str, etag: str, output: BinaryIO):
+    """Stream an object into `output`.
+
+    Raises:
+        botocore.exceptions.ClientError: If the object is gone or no longer has ETag `etag`.
+    """
+    for chunk in open_object(listing, key, etag).iter_chunks(1024 * 1024):
+        output.write(chunk)
+
+
+def presign_post(listing: S3Listing, key: str, content_type: str, size: int, expires: int = 3600) -> Dict:
+    """Presigned POST letting a browser upload exactly `size` bytes to `key` itself."""
+    return listing.client.generate_presigned_post(
+        Bucket=listing.bucket_name,
+        Key=key,
+        Fields={'acl': 'public-read', 'Content-Type': content_type},
+        Conditions=[{'acl': 'public-read'}, {'Content-Type': content_type},
+                    ['content-length-range', size, size]],
+        ExpiresIn=expires
+    )
+
+
+def presign_multipart(listing: S3Listing, key: str, content_type: str, size: int, part_size: int,
+                      expires: int = 3600) -> Dict:
+    """Start a multipart upload and presign a PUT URL for each of its parts.
+
+    S3 allows at most 10,000 parts, so `part_size` is raised for very large files.
+    """
+    part_size = max(part_size, -(-size // 10000))
+    upload_id = listing.client.create_multipart_upload(Bucket=listing.bucket_name, Key=key,
+                                                       ACL='public-read', ContentType=content_type)['UploadId']
+    parts = [{'part_number': number,
+              'url': listing.client.generate_presigned_url(
+                  'upload_part',
+                  Params={'Bucket': listing.bucket_name, 'Key': key, 'UploadId': upload_id, 'PartNumber': number},
+                  ExpiresIn=expires)}
+             for number in range(1, -(-size // part_size) + 1)]
+    return {'upload_id': upload_id, 'part_size': part_size, 'parts': parts}
+
+
+def complete_multipart(listing: S3Listing, key: str, upload_id: str, parts: List[Dict]):
+    """Assemble an uploaded multipart object from its parts' numbers and ETags."""
+    listing.client.complete_multipart_upload(
+        Bucket=listing.bucket_name, Key=key, UploadId=upload_id,
+        MultipartUpload={'Parts': sorted(({'PartNumber': int(part['part_number']), 'ETag': part['etag']}
+                                          for part in parts), key=lambda part: part['PartNumber'])})
+
+
+def abort_multipart(listing: S3Listing, key: str, upload_id: str):
+    """Discard the parts of an abandoned multipart upload."""
+    listing.client.abort_multipart_upload(Bucket=listing.bucket_name, Key=key, UploadId=upload_id)
+
+
+def record_uploaded(listing: S3Listing, key: str) -> Dict:
+    """Look up an object written straight to the bucket and add it to the cached listing.
+
+    Raises:
+        botocore.exceptions.ClientError: If the object doesn't exist.
+    """
+    head = listing.client.head_object(Bucket=listing.bucket_name, Key=key)
+    listing.record_put(key, head['ContentLength'], head['ETag'], head['LastModified'].timestamp())
+    return {'key': key, 'size': head['ContentLength'], 'etag': head['ETag'].strip('"')}
+
+
+_listings: Dict[str, S3Listing] = {}
+_listings_lock = threading.Lock()
+
+
+def get_listing(bucket_name: str) -> S3Listing:
+    """Return the shared listing for a bucket."""
+    with _listings_lock:
+        if bucket_name not in _listings:
+            _listings[bucket_name] = S3Listing(bucket_name, ttl=current_app.config.get('S3_LISTING_TTL', 60),
+                                               endpoint_url=current_app.config.get('S3_ENDPOINT_URL'))
+        return _listings[bucket_name]
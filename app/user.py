@@ -1,9 +1,23 @@
+from typing import Optional
+from flask import current_app
 from flask_login import UserMixin
-import pymongo
+from caching.lru import BoundedTTLCache
+from db import get_users
 
-client = pymongo.MongoClient('127.0.0.1', 27017)
-db = client['AUTH']
-users = db['USERS']
+USER_FIELDS = {'_id': 0, 'user_id': 1, 'name': 1, 'email': 1, 'profile_pic': 1}
+
+
+def init_user_cache(app) -> BoundedTTLCache:
+    """Attach this worker's cache of user records to the app."""
+    cache = BoundedTTLCache(maxsize=app.config.get('USER_CACHE_SIZE', 1024),
+                            ttl=app.config.get('USER_CACHE_TTL', 60))
+    app.extensions['user_cache'] = cache
+    return cache
+
+
+def get_user_cache() -> BoundedTTLCache:
+    """Return the current app's user cache."""
+    return current_app.extensions['user_cache']
 
 
 class User(UserMixin):
@@ -32,7 +46,13 @@ class User(UserMixin):
         Returns:
             _user (_type_): Returns None if user not found, else returns the info for that user.
         """
-        user = users.find_one({'user_id': user_id})
+        cache = get_user_cache()
+        user = cache.get(('user_id', user_id))
+
+        if user is None:
+            # Unknown IDs are cached too (as {}), so a stale session cookie can't hammer the DB.
+            user = get_users().find_one({'user_id': user_id}, USER_FIELDS) or {}
+            cache.set(('user_id', user_id), user)
 
         if not user:
             return None
@@ -40,12 +60,46 @@ class User(UserMixin):
         user = User(user_id=user['user_id'],
                     name=user['name'],
                     email=user['email'],
-                    profile_pic=user['profile_pic'])
+                    profile_pic=user.get('profile_pic'))
 
         return user
 
     @staticmethod
-    def create(user_id: str, name: str, email: str, profile_pic: str) -> bool:
+    def get_name(email: str) -> Optional[str]:
+        """ Retrieve a user's display name based on their email.
+
+        Args:
+            email (str): User's email/username.
+
+        Returns:
+            str: The user's name, or None if they aren't registered.
+        """
+        cache = get_user_cache()
+        user = cache.get(('email', email))
+
+        if user is None:
+            user = get_users().find_one({'email': email}, {'_id': 0, 'name': 1}) or {}
+            cache.set(('email', email), user)
+
+        return user.get('name')
+
+    @staticmethod
+    def invalidate(user_id: Optional[str] = None, email: Optional[str] = None):
+        """ Drop cached records for a user after they are created or changed.
+
+        Args:
+            user_id (str): User ID obtained from Google auth.
+            email (str): User's email/username.
+        """
+        cache = get_user_cache()
+
+        if user_id is not None:
+            cache.pop(('user_id', user_id))
+        if email is not None:
+            cache.pop(('email', email))
+
+    @staticmethod
+    def create(user_id: str, name: str, email: str, profile_pic: str, email_verified: bool = False) -> bool:
         """ Create a new collection in our DB based on provided arguments.
 
         Args:
@@ -53,12 +107,29 @@ class User(UserMixin):
             name (str): User's name obtaind from Google auth.
             email (str): User's email obtaind from Google auth.
             profile_pic (str): User's profile pic obtained from Google auth.
+            email_verified (bool): Whether Google verified the email - Required to link an existing account.
 
         Returns:
             bool: True/False based on success of collection insertion.
         """
-
-        return users.insert_one({'user_id': user_id,
-                                 'name': name,
-                                 'email': email,
-                                 'profile_pic': profile_pic})
+        from pymongo.errors import DuplicateKeyError
+
+        users = get_users()
+
+        # Cached records are dropped once the write is done - Dropped before it, a concurrent lookup
+        # could cache the user as unknown again for the whole TTL.
+        try:
+            users.insert_one({'user_id': user_id,
+                              'name': name,
+                              'email': email,
+                              'profile_pic': profile_pic})
+            return True
+        except DuplicateKeyError:
+            # The email was registered via the form first - Link the Google account to it, but only
+            # if Google vouches for the email, or anyone could claim the account with an unverified one.
+            if not email_verified:
+                return False
+            return bool(users.update_one({'email': email, 'user_id': {'$exists': False}},
+                                         {'$set': {'user_id': user_id, 'profile_pic': profile_pic}}).matched_count)
+        finally:
+            User.invalidate(user_id=user_id, email=email)
@@ -1,15 +1,15 @@
 """
 View responsible for authentication-related functions within Puploader.
 """
-import json
 import os
-import bcrypt
+import secrets
 from flask import (Blueprint, redirect, render_template,
                    request, session, url_for)
 from flask_login import login_user, logout_user
-from oauthlib.oauth2 import WebApplicationClient
-import pymongo
 import requests
+from db import get_users
+from security.oidc import OidcError, get_oidc
+from security.passwords import HashingBusy, get_hasher
 from user import User
 
 auth = Blueprint('auth', __name__, template_folder='templates')
@@ -17,38 +17,28 @@ auth = Blueprint('auth', __name__, template_folder='templates')
 
 GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID", None)
 GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_CLIENT_SECRET", None)
-GOOGLE_DISCOVERY_URL = (
-    "https://accounts.google.com/.well-known/openid-configuration"
-)
-
-client = WebApplicationClient(GOOGLE_CLIENT_ID)
+_client = None
 
 AUTH_AUTHENTICATED = 'auth.authenticated'
 AUTH_LOGIN = '/auth/login.html'
+BUSY_MESSAGE = 'We are handling a lot of logins right now - Please try again in a moment.'
 
 
-def get_google_provider_cfg():
-    """
-    Retrieve Google's Provider resource - For use with Google authentication.
-    """
-    return requests.get(GOOGLE_DISCOVERY_URL).json()
+def google_client():
+    """OAuth client for Google sign-in - oauthlib is only imported once someone signs in with Google."""
+    global _client
+    if _client is None:
+        from oauthlib.oauth2 import WebApplicationClient
+        _client = WebApplicationClient(GOOGLE_CLIENT_ID)
+    return _client
 
 
-def db_connect():
+def get_google_provider_cfg():
     """
-    Connect to the MongoDB backend to provide user information.
+    Retrieve Google's Provider resource - For use with Google authentication.
+    Cached process-wide for as long as Google's cache headers allow.
     """
-    if os.environ.get('MONGODB_URI'):
-        mongo_uri = os.environ.get('MONGODB_URI')
-    else:
-        mongo_uri = '127.0.0.1'
-
-    database = pymongo.MongoClient(mongo_uri, 27017)['AUTH']
-
-    return database['USERS']
-
-
-users = db_connect()
+    return get_oidc().config()
 
 
 @auth.route('/register', methods=['POST', 'GET'])
@@ -65,7 +55,11 @@ def register():
         password = request.form.get('inputPassword')
         password_conf = request.form.get('confirmPassword')
 
-        if users.find_one({'email': username}):
+        from pymongo.errors import DuplicateKeyError
+
+        users = get_users()
+
+        if users.find_one({'email': username}, {'_id': 1}):
             return render_template('/auth/register.html',
                                    message='Username already taken.',
                                    auth=('username' in session))
@@ -73,8 +67,20 @@ def register():
         if password != password_conf:
             return 'Passwords must match.'
 
-        hashed_pw = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-        users.insert_one({'email': username, 'name': name, 'password': hashed_pw})
+        try:
+            hashed_pw = get_hasher().hash(password)
+        except HashingBusy:
+            return render_template('/auth/register.html',
+                                   message=BUSY_MESSAGE,
+                                   auth=('username' in session)), 503, {'Retry-After': '1'}
+
+        try:
+            users.insert_one({'email': username, 'name': name, 'password': hashed_pw})
+            User.invalidate(email=username)
+        except DuplicateKeyError:
+            return render_template('/auth/register.html',
+                                   message='Username already taken.',
+                                   auth=('username' in session))
 
         return render_template('/auth/authenticated.html',
                                username=name,
@@ -83,6 +89,18 @@ def register():
     return render_template('/auth/register.html', auth=('username' in session))
 
 
+def rehash_password(email: str, password: str):
+    """
+    Re-hash a just-verified password with the current BCRYPT_ROUNDS - Skipped if the pool is busy.
+    """
+    try:
+        hashed_pw = get_hasher().hash(password)
+    except HashingBusy:
+        return
+
+    get_users().update_one({'email': email}, {'$set': {'password': hashed_pw}})
+
+
 @auth.route('/login', methods=['POST', 'GET'])
 def login():
     """
@@ -97,12 +115,24 @@ def login():
         username = request.form.get('inputUsername')
         password = request.form.get('inputPassword')
 
-        user_record = users.find_one({'email': username.lower()})
+        user_record = get_users().find_one({'email': username.lower()},
+                                           {'_id': 0, 'email': 1, 'name': 1, 'password': 1})
+
+        if user_record and user_record.get('password'):
+            hasher = get_hasher()
+            try:
+                verified = hasher.verify(password, user_record['password'])
+            except HashingBusy:
+                return render_template(AUTH_LOGIN,
+                                       message=BUSY_MESSAGE,
+                                       auth=('username' in session)), 503, {'Retry-After': '1'}
+
+            if verified:
+                if hasher.needs_rehash(user_record['password']):
+                    rehash_password(user_record['email'], password)
 
-        if user_record:
-            if bcrypt.checkpw(password.encode('utf-8'),
-                              user_record['password']):
                 session['username'] = user_record['email']
+                session['name'] = user_record.get('name')
                 return redirect(url_for(AUTH_AUTHENTICATED))
 
             message = 'Incorrect password - Please try again.'
@@ -130,10 +160,12 @@ def google_auth():
     google_provider_cfg = get_google_provider_cfg()
     auth_endpoint = google_provider_cfg['authorization_endpoint']
 
-    request_uri = client.prepare_request_uri(auth_endpoint,
-                                             redirect_uri=request.base_url + "/callback",
-                                             scope=['openid', 'email', 'profile'],
-                                             )
+    session['oidc_nonce'] = secrets.token_urlsafe(16)
+    request_uri = google_client().prepare_request_uri(auth_endpoint,
+                                                      redirect_uri=request.base_url + "/callback",
+                                                      scope=['openid', 'email', 'profile'],
+                                                      nonce=session['oidc_nonce'],
+                                                      )
 
     return redirect(request_uri)
 
@@ -149,7 +181,7 @@ def google_auth_callback():
     google_provider_cfg = get_google_provider_cfg()
     token_endpoint = google_provider_cfg['token_endpoint']
 
-    token_url, headers, body = client.prepare_token_request(
+    token_url, headers, body = google_client().prepare_token_request(
                                                             token_endpoint,
                                                             authorization_response=request.url,
                                                             redirect_url=request.base_url,
@@ -157,31 +189,40 @@ def google_auth_callback():
                                                             )
 
     token_response = requests.post(token_url, headers=headers, data=body,
-                                   auth=(GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET),)
-
-    client.parse_request_body_response(json.dumps(token_response.json()))
-
-    userinfo_endpoint = google_provider_cfg['userinfo_endpoint']
-    uri, headers, body = client.add_token(userinfo_endpoint)
-    userinfo_response = requests.get(uri, headers=headers, data=body)
+                                   auth=(GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET), timeout=10)
+
+    # The ID token already carries the user's profile - Validate it locally instead of calling userinfo.
+    try:
+        id_token = token_response.json().get('id_token')
+        if not id_token:
+            raise OidcError(f'Token endpoint returned {token_response.status_code} without an ID token.')
+        claims = get_oidc().validate_id_token(id_token, nonce=session.pop('oidc_nonce', None))
+    except (OidcError, ValueError) as exc:
+        print('Error validating Google sign-in: ', exc)
+        return render_template(AUTH_LOGIN,
+                               message='Google sign-in failed - Please try again.',
+                               auth=('username' in session))
 
-    if userinfo_response.json().get('email_verified'):
-        unique_id = userinfo_response.json()["sub"]
-        users_email = userinfo_response.json()["email"]
-        users_name = userinfo_response.json()["given_name"]
-    else:
+    email_verified = bool(claims.get('email_verified'))
+    if not email_verified:
         print('User not verified.')
-        unique_id = userinfo_response.json()["sub"]
-        users_email = userinfo_response.json()["email"]
-        users_name = userinfo_response.json()["given_name"]
+
+    unique_id = claims["sub"]
+    users_email = claims["email"]
+    users_name = claims.get("given_name") or claims.get("name") or users_email
 
     user = User(user_id=unique_id, name=users_name, email=users_email, profile_pic='')
 
-    if not User.get(unique_id):
-        User.create(unique_id, users_name, users_email, 'pic_placeholder')
+    if not User.get(unique_id) and not User.create(unique_id, users_name, users_email, 'pic_placeholder',
+                                                   email_verified=email_verified):
+        print(f'Refused Google sign-in for {users_email} - The email belongs to another account.')
+        return render_template(AUTH_LOGIN,
+                               message='This email is already registered - Please sign in with your password.',
+                               auth=('username' in session))
 
     login_user(user)
     session['username'] = users_email
+    session['name'] = users_name
 
     return redirect(url_for(AUTH_AUTHENTICATED))
 
@@ -194,7 +235,11 @@ def authenticated():
     """
     if "username" in session:
         username = session['username']
-        name = users.find_one({'email': username})['name']
+        name = session.get('name')
+
+        if name is None:
+            # Sessions created before names were stored in them.
+            name = session['name'] = User.get_name(username)
 
         return render_template('/auth/authenticated.html',
                                username=name,
@@ -212,6 +257,7 @@ def logout():
     if 'username' in session:
         logout_user()
         session.pop('username', None)
+        session.pop('name', None)
 
         return render_template('/auth/logout.html',
                                auth=('username' in session))
@@ -1,67 +1,439 @@
 """
 This view contains all routes needed to upload, retrieve, and view photos.
 """
+import base64
+import binascii
 import json
+import mimetypes
 import os
-from typing import List
-import boto3
-from flask import (Blueprint, current_app, escape, flash,
+import threading
+import time
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from flask import (Blueprint, abort, current_app, flash, jsonify,
                    redirect, render_template, request,
                    session, url_for)
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
+from caching.pages import cached_page, get_page_cache
+from catalog.catalog import get_catalog, is_photo
+from catalog.eviction import get_eviction
+from catalog.similarity import NearDuplicateScreen, get_similarity
+from imaging.phash import dhash
+from imaging.thumbnails import S3_VARIANT_PREFIX, VARIANT_DIR, get_pipeline, variant_names
+from jobs.queue import get_jobs
+from jobs.worker import register_s3_object
+from storage.archive import ExportEntry, archive_photos, seekable_upload, stream_zip
+from storage.disk_cache import get_s3_cache
+from storage.local import commit_staged, hash_stream, link_existing, stage_stream
+from storage.s3 import (abort_multipart, complete_multipart, find_stored_object, get_listing, open_object,
+                        presign_multipart, presign_post, record_uploaded, upload_stream)
+from views.uploads import s3_object_url, upload_url, upload_version
 
 
 photos = Blueprint('photos', __name__, template_folder='templates')
 
 AUTH_LOGIN = 'auth.login'
 
+_upload_executor: Optional[ThreadPoolExecutor] = None
+_upload_executor_pid = None
+_upload_executor_lock = threading.Lock()
 
-def list_folders(base_path: str) -> List[str]:
-    """List all subfolders in the given base path."""
-    return sorted([folder for folder in os.listdir(base_path) if os.path.isdir(os.path.join(base_path, folder))])
 
+def upload_bucket() -> str:
+    """Bucket public uploads are stored in - S3_BUCKET, which the gallery lists, falling back to 'puploader'."""
+    return current_app.config['S3_BUCKET'] or 'puploader'
 
-def get_s3_photos(bucket_name: str = 'puploader') -> List[str]:
-    """Retrieve all photo keys from an S3 bucket."""
-    s3_client = boto3.client('s3')
-    response = s3_client.list_objects_v2(Bucket=bucket_name)
-    return [obj['Key'] for obj in response.get('Contents', [])]
 
+def get_s3_photos(bucket_name: str = 'puploader', prefix: str = '') -> List[str]:
+    """Retrieve all photo keys (optionally under a folder prefix) from an S3 bucket."""
+    listing = get_listing(bucket_name)
+    listing.sync_version(get_catalog().version())
+    return [obj['key'] for obj in listing.list(prefix)
+            if not obj['key'].startswith(S3_VARIANT_PREFIX)]
 
-def resolve_duplicate_filename(filename: str, existing_files: List[str]) -> str:
-    """Resolve duplicate filenames by appending '_dupe'."""
-    while filename in existing_files:
-        name, extension = os.path.splitext(filename)
-        filename = f"{name}_dupe{extension}"
-    return filename
 
+def encode_cursor(mtime: float, name: str) -> str:
+    """Encode the (mtime, name) sort key of the last photo on a page as an opaque cursor."""
+    return base64.urlsafe_b64encode(json.dumps([mtime, name]).encode('utf-8')).decode('ascii')
 
-def cleanup_directory(directory: str, max_files: int):
-    """Remove oldest files if the directory exceeds the allowed limit."""
-    files = [(f, os.path.getmtime(os.path.join(directory, f))) for f in os.listdir(directory)]
-    files.sort(key=lambda x: x[1])  # Sort by modification time
-    while len(files) > max_files:
-        os.remove(os.path.join(directory, files.pop(0)[0]))
+
+def decode_cursor(cursor: str) -> Tuple[float, str]:
+    """Decode a cursor produced by encode_cursor. Raises ValueError if it is malformed."""
+    try:
+        mtime, name = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return float(mtime), str(name)
+    except (binascii.Error, TypeError, UnicodeError, json.JSONDecodeError) as exc:
+        raise ValueError(f'Invalid cursor: {cursor}') from exc
+
+
+def photo_variants(url: str, variant_url: Callable[[str], str], has_variants: bool) -> Dict[str, Optional[str]]:
+    """URLs for a photo's thumbnail/WebP variants, falling back to the original until they exist.
+
+    Args:
+        variant_url (Callable): Builds a variant's URL from its suffix (e.g. '.thumb.jpg').
+    """
+    if not has_variants:
+        return {'thumb': url, 'thumb_webp': None, 'webp': None}
+    return {variant: variant_url(suffix)
+            for variant, suffix in variant_names('').items()}
+
+
+def get_photo_page(folder: str = '', cursor: Optional[str] = None,
+                   limit: Optional[int] = None) -> Tuple[List[Dict], Optional[str]]:
+    """Retrieve one page of photos, newest first, from whichever backend is configured.
+
+    Args:
+        folder (str): Folder to page through - '' for the top level.
+        cursor (str): Cursor returned alongside the previous page, if any.
+        limit (int): Maximum page size - Defaults to GALLERY_PAGE_SIZE.
+
+    Returns:
+        Tuple: List of photo dicts (name, url, size, modified and variant URLs) and the cursor
+               for the next page.
+    """
+    limit = limit or current_app.config.get('GALLERY_PAGE_SIZE', 24)
+    after = decode_cursor(cursor) if cursor else None
+
+    prefix = f'{folder}/' if folder else ''
+    page = []
+    if current_app.config['S3_BUCKET']:
+        bucket_name = current_app.config['S3_BUCKET']
+        bucket_url = f"https://{bucket_name}.s3.amazonaws.com/"
+        listing = get_listing(bucket_name)
+        listing.sync_version(get_catalog().version())
+        objects = [obj for obj in listing.list(prefix) if not obj['key'].startswith(S3_VARIANT_PREFIX)]
+        variants = {obj['key']: obj for obj in listing.list(S3_VARIANT_PREFIX + prefix)}
+        objects.sort(key=lambda obj: (-obj['last_modified'], obj['key']))
+        if after:
+            objects = [obj for obj in objects
+                       if (-obj['last_modified'], obj['key']) > (-after[0], after[1])]
+
+        # Served through the local disk cache when there is one, straight from the bucket otherwise.
+        if get_s3_cache() is not None:
+            object_url = s3_object_url
+        else:
+            def object_url(obj: Dict) -> str:
+                return bucket_url + obj['key']
+
+        for obj in objects[:limit + 1]:
+            variant_key = S3_VARIANT_PREFIX + obj['key']
+            has_variants = variant_names(variant_key)['thumb'] in variants
+            page.append((obj['key'], {'name': obj['key'],
+                                      'url': object_url(obj),
+                                      'size': obj['size'],
+                                      'modified': obj['last_modified'],
+                                      **photo_variants(object_url(obj),
+                                                       lambda suffix, key=variant_key:
+                                                           object_url(variants.get(key + suffix,
+                                                                                   {'key': key + suffix, 'etag': ''})),
+                                                       has_variants)}))
+    else:
+        for photo in get_catalog().page_photos(folder, after, limit + 1):
+            version = upload_version(photo)
+            url = upload_url(f"{prefix}{photo['name']}", version)
+            page.append((photo['name'], {'name': prefix + photo['name'],
+                                         'url': url,
+                                         'size': photo['size'],
+                                         'modified': photo['mtime'],
+                                         **photo_variants(url,
+                                                          lambda suffix, name=photo['name'], version=version:
+                                                              upload_url(f'{prefix}{VARIANT_DIR}/{name}{suffix}',
+                                                                         version),
+                                                          photo['has_variants'])}))
+
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        sort_name, last = page[-1]
+        next_cursor = encode_cursor(last['modified'], sort_name)
+
+    return [photo for _, photo in page], next_cursor
+
+
+def resolve_duplicate_filename(filename: str, existing_files: Set[str]) -> str:
+    """Resolve duplicate filenames by appending '_dupe' (then '_dupe2', '_dupe3', ...)."""
+    name, extension = os.path.splitext(filename)
+    candidate, attempt = filename, 1
+    while candidate in existing_files:
+        candidate = f"{name}_dupe{attempt if attempt > 1 else ''}{extension}"
+        attempt += 1
+    return candidate
+
+
+def screen_upload(source, path: str, screen: Optional[NearDuplicateScreen]) -> Dict:
+    """Perceptual hash of an upload and the photo it is a near-duplicate of, if a screen is in use.
+
+    Returns:
+        Dict: 'phash' (None if not hashed here or not a readable image), 'near_duplicate_of' and
+              'rejected' - True if the policy turns the upload away.
+    """
+    if screen is None:
+        return {'phash': None, 'near_duplicate_of': None, 'rejected': False}
+
+    try:
+        phash = dhash(source)
+    except (OSError, ValueError) as exc:
+        print(f'Could not hash {path}: {exc}')
+        phash = None
+    similar = screen.check(phash, path)
+    return {'phash': phash, 'near_duplicate_of': similar, 'rejected': bool(similar) and screen.policy == 'reject'}
+
+
+def upload_to_s3(file, bucket_name: str, multipart_threshold: int = 8 * 1024 * 1024,
+                 catalog=None, screen: Optional[NearDuplicateScreen] = None, cache=None) -> Dict:
+    """Stream a file to S3 (multipart when large) and record it in the bucket's cached listing.
+
+    When a catalog is supplied, byte-identical uploads are not stored again - The returned dict's
+    'duplicate_of' names the existing key instead. Near-duplicates are handled per `screen`.
+    `cache` is the disk cache to drop objects found deleted from the bucket from.
+    """
+    size, sha256 = hash_stream(file.stream)
+    if catalog is not None:
+        existing_key = find_stored_object(get_listing(bucket_name), catalog, sha256, cache)
+        if existing_key:
+            return {'key': existing_key, 'size': size, 'sha256': sha256, 'duplicate_of': existing_key}
+
+    screened = screen_upload(file.stream, file.filename, screen)
+    if screened['rejected']:
+        return {'key': file.filename, 'size': size, 'sha256': sha256, 'duplicate_of': None, **screened}
+
+    stored = upload_stream(get_listing(bucket_name), file.filename, file.stream, size,
+                           content_type=file.mimetype, multipart_threshold=multipart_threshold)
+    if catalog is not None:
+        catalog.add_s3_object(file.filename, sha256, screened['phash'], screened['near_duplicate_of'])
+    return {**stored, 'sha256': sha256, 'duplicate_of': None, **screened}
+
+
+def spool_s3_upload(file, catalog, spool_folder: str, listing, screen: Optional[NearDuplicateScreen] = None,
+                    cache=None) -> Dict:
+    """Stream an upload durably into the spool, for a store_s3 job to push to the bucket.
+
+    Byte-identical uploads are not spooled - The returned dict's 'duplicate_of' names the existing key
+    instead, once `listing` confirms it is still in the bucket. Near-duplicates are handled per `screen`.
+    """
+    tmp_path, size, sha256 = stage_stream(file.stream, spool_folder, durable=True)
+    existing_key = find_stored_object(listing, catalog, sha256, cache)
+    if existing_key:
+        os.unlink(tmp_path)
+        return {'key': existing_key, 'size': size, 'sha256': sha256, 'duplicate_of': existing_key}
+
+    screened = screen_upload(tmp_path, file.filename, screen)
+    if screened['rejected']:
+        os.unlink(tmp_path)
+    return {'key': file.filename, 'path': tmp_path, 'size': size, 'sha256': sha256, 'duplicate_of': None,
+            **screened}
+
+
+def store_local_upload(file, catalog, folder: str, batch_hashes: Dict[str, Future],
+                       lock: threading.Lock, durable: bool = False,
+                       screen: Optional[NearDuplicateScreen] = None) -> Dict:
+    """Stream an upload into `folder`, storing byte-identical photos as references to the existing blob.
+
+    Near-duplicates (visually similar, but not byte-identical) are handled per `screen`. Of the
+    byte-identical files in a batch, the first is stored (or turned away) before the others are
+    checked against it - `batch_hashes` maps each hash to the name it ends up stored under.
+
+    Returns:
+        Dict: Size and hash of the upload, plus 'duplicate_of' if it matched a photo already in `folder`
+              and the outcome of screen_upload.
+    """
+    directory = catalog.folder_path(folder)
+    tmp_path, size, sha256 = stage_stream(file.stream, directory, durable=durable)
+
+    existing = None
+    while existing is None:
+        with lock:
+            existing = catalog.find_by_hash(sha256, folder)
+            earlier = None if existing is not None else batch_hashes.get(sha256)
+            if existing is None and earlier is None:
+                batch_hashes[sha256] = outcome = Future()
+                break
+        if earlier is not None and earlier.result() is not None:
+            existing = {'folder': folder, 'name': earlier.result()}
+        # Otherwise the earlier file was turned away - This one gets screened on its own.
+
+    if existing is None:
+        stored_as = None
+        try:
+            screened = screen_upload(tmp_path, f'{folder}/{file.filename}' if folder else file.filename, screen)
+            if screened['rejected']:
+                os.unlink(tmp_path)
+            else:
+                commit_staged(tmp_path, os.path.join(directory, file.filename))
+                stored_as = file.filename
+        finally:
+            if stored_as is None:
+                with lock:
+                    batch_hashes.pop(sha256, None)
+            outcome.set_result(stored_as)
+        return {'size': size, 'sha256': sha256, 'duplicate_of': None, **screened}
+
+    if existing['folder'] == folder:
+        os.unlink(tmp_path)
+        return {'size': size, 'sha256': sha256, 'duplicate_of': existing['name']}
+
+    # Byte-identical to a photo in another folder - Its hashes and near-duplicate status carry over.
+    existing_path = os.path.join(catalog.folder_path(existing['folder']), existing['name'])
+    if link_existing(existing_path, os.path.join(directory, file.filename)):
+        os.unlink(tmp_path)
+    else:
+        commit_staged(tmp_path, os.path.join(directory, file.filename))
+    photo = catalog.get_photo(existing['folder'], existing['name']) or {}
+    return {'size': size, 'sha256': sha256, 'duplicate_of': None, 'phash': photo.get('phash'),
+            'near_duplicate_of': None, 'rejected': False}
 
 
-def upload_to_s3(file, bucket_name: str):
-    """Upload a file to S3."""
-    bucket = boto3.resource('s3').Bucket(bucket_name)
-    bucket.Object(file.filename).put(Body=file)
+def get_upload_executor() -> ThreadPoolExecutor:
+    """Return this process's bounded pool for pushing uploaded files to storage."""
+    global _upload_executor, _upload_executor_pid
+    with _upload_executor_lock:
+        if _upload_executor_pid != os.getpid():
+            _upload_executor = ThreadPoolExecutor(max_workers=current_app.config.get('UPLOAD_THREADS', 4),
+                                                  thread_name_prefix='puploader-upload')
+            _upload_executor_pid = os.getpid()
+        return _upload_executor
 
 
 @photos.route('/upload')
 def puploader_upload():
     """Entry route for Puploader's photo upload functionality."""
     if "username" in session:
-        folders = list_folders(current_app.config['UPLOAD_FOLDER'])
-        return render_template('/photos/upload.html', folders=folders, auth=('username' in session))
+        folders = get_catalog().list_folders()
+        return render_template('/photos/upload.html', folders=folders, auth=('username' in session),
+                               direct_upload=not current_app.config['PRIVATE'])
     return redirect(url_for(AUTH_LOGIN))
 
 
+# Flash category of each ingest outcome.
+_OUTCOME_CATEGORIES = {'stored': 'success', 'duplicate': 'success', 'near_duplicate': 'error',
+                       'skipped': 'error', 'failed': 'error'}
+
+
+def upload_screen() -> Optional[NearDuplicateScreen]:
+    """Near-duplicate screen for one upload request, per NEAR_DUPLICATE_POLICY - None if hashes are left to the jobs."""
+    policy = current_app.config.get('NEAR_DUPLICATE_POLICY', 'off')
+    if policy == 'off' and current_app.config.get('JOBS_ENABLED', True):
+        return None
+    return NearDuplicateScreen(get_similarity(), policy, current_app.config.get('NEAR_DUPLICATE_DISTANCE', 6))
+
+
+def existing_upload_names(folder: str) -> Set[str]:
+    """Names new uploads to `folder` must not take - Photos already stored there or waiting to be."""
+    if current_app.config['PRIVATE']:
+        return get_catalog().photo_names(folder)
+
+    existing_files = set(get_s3_photos(upload_bucket()))
+    if current_app.config.get('JOBS_ENABLED', True):
+        existing_files.update(job['key'] for job in get_jobs().pending('store_s3'))
+    return existing_files
+
+
+def ingest_uploads(files: List, folder: str, existing_files: Set[str],
+                   screen: Optional[NearDuplicateScreen]) -> List[Tuple[str, str]]:
+    """Store a batch of uploaded files and queue (or run) their processing.
+
+    The files are streamed to storage concurrently. With JOBS_ENABLED, this returns once the bytes
+    are safely on local disk - Pushing them to S3, metadata, EXIF stripping, variants and eviction
+    are left to the job queue.
+
+    Args:
+        files (List): FileStorage-like objects (filename, stream, mimetype).
+        existing_files (Set): Names taken in the destination - Updated with the names given out.
+        screen (NearDuplicateScreen): Turns away or groups near-duplicates - Shared by a request's batches.
+
+    Returns:
+        List: (outcome, message) for each file - Outcomes are keys of _OUTCOME_CATEGORIES.
+    """
+    catalog = get_catalog()
+    pipeline = get_pipeline()
+    private = current_app.config['PRIVATE']
+    use_jobs = current_app.config.get('JOBS_ENABLED', True)
+
+    outcomes, accepted = [], []
+    for file in files:
+        # Checked as stored - A name like '..jpg' sanitizes to 'jpg', which isn't a photo.
+        safe_name = secure_filename(file.filename)
+        if not safe_name or not is_photo(safe_name):
+            outcomes.append(('skipped', f'{file.filename}: Skipped - Only gif, jpg, jpeg and png files are accepted.'))
+            continue
+
+        original_name = file.filename
+        file.filename = resolve_duplicate_filename(safe_name, existing_files)
+        existing_files.add(file.filename)
+        accepted.append((original_name, file))
+
+    executor = get_upload_executor()
+    if private:
+        batch_hashes, lock = {}, threading.Lock()
+        futures = [executor.submit(store_local_upload, file, catalog, folder, batch_hashes, lock, use_jobs, screen)
+                   for _, file in accepted]
+    elif use_jobs:
+        spool_folder = job_spool_folder()
+        listing = get_listing(upload_bucket())
+        futures = [executor.submit(spool_s3_upload, file, catalog, spool_folder, listing, screen, get_s3_cache())
+                   for _, file in accepted]
+    else:
+        threshold = current_app.config.get('S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024)
+        futures = [executor.submit(upload_to_s3, file, upload_bucket(), threshold, catalog, screen, get_s3_cache())
+                   for _, file in accepted]
+
+    stored = []
+    for (original_name, file), future in zip(accepted, futures):
+        try:
+            result = future.result()
+        except Exception as exc:
+            outcomes.append(('failed', f'{original_name}: Upload failed - {exc}'))
+            continue
+
+        if result['duplicate_of']:
+            outcomes.append(('duplicate', f"{original_name}: Already uploaded as {result['duplicate_of']} - "
+                                          'Not stored again.'))
+            continue
+        if result['rejected']:
+            outcomes.append(('near_duplicate', f"{original_name}: Looks just like {result['near_duplicate_of']} - "
+                                               'Not stored.'))
+            continue
+
+        if private:
+            catalog.add_photo(folder, file.filename, result['size'], time.time(), result['sha256'],
+                              result['phash'], result['near_duplicate_of'])
+        stored.append((file, result))
+
+        renamed = f' as {file.filename}' if file.filename != original_name else ''
+        similar = f" (grouped with {result['near_duplicate_of']})" if result['near_duplicate_of'] else ''
+        outcomes.append(('stored', f'{original_name}: Uploaded successfully{renamed}{similar}!'))
+
+    if use_jobs:
+        queue_post_upload_jobs(folder, stored, private)
+    elif private:
+        evicted = {(photo['folder'], photo['name']) for photo in get_eviction().evict(folder)}
+        for file, _ in stored:
+            if (folder, file.filename) not in evicted:
+                pipeline.submit_local(catalog, folder, file.filename)
+    else:
+        for file, _ in stored:
+            pipeline.submit_s3(get_listing(upload_bucket()), file.filename)
+
+    return outcomes
+
+
+def upload_folder() -> str:
+    """Destination folder picked on the upload page - '' for the default (top-level) folder."""
+    folder_name = request.form.get('folder_dropdown', 'default').lower()
+    return secure_filename(folder_name) if folder_name != 'default' else ''
+
+
 @photos.route('/uploaded', methods=['POST'])
 def upload_file():
-    """Handle photo uploads for private or public instances."""
+    """Handle photo uploads for private or public instances, flashing each file's outcome.
+
+    Uploads that look like a stored photo (or an earlier one in the batch) are turned away or
+    grouped with it, per NEAR_DUPLICATE_POLICY ('off', 'reject' or 'group').
+    """
     if "username" not in session:
         return redirect(url_for(AUTH_LOGIN))
 
@@ -70,35 +442,117 @@ def upload_file():
         flash('No file to upload - Please try again.', 'error')
         return redirect('/upload')
 
-    folder_name = request.form.get('folder_dropdown', 'default').lower()
-    upload_folder = (os.path.join(current_app.config['UPLOAD_FOLDER'], secure_filename(folder_name))
-                     if folder_name != 'default' else current_app.config['UPLOAD_FOLDER'])
+    folder = upload_folder()
+    for outcome, message in ingest_uploads(files, folder, existing_upload_names(folder), upload_screen()):
+        flash(message, _OUTCOME_CATEGORIES[outcome])
 
-    existing_files = (os.listdir(upload_folder) if current_app.config['PRIVATE'] else get_s3_photos())
-    for file in files:
-        if file.filename.split('.')[-1].lower() not in {'gif', 'jpg', 'jpeg', 'png'}:
-            continue
+    return redirect('/upload')
 
-        file.filename = resolve_duplicate_filename(file.filename, existing_files)
 
-        if current_app.config['PRIVATE']:
-            if len(os.listdir(upload_folder)) >= current_app.config['UPLOAD_FOLDER_MAX']:
-                cleanup_directory(upload_folder, current_app.config['UPLOAD_FOLDER_MAX'])
-            file.save(os.path.join(upload_folder, secure_filename(file.filename)))
-        else:
-            upload_to_s3(file, 'puploader')
+def import_archive_entries(archive: zipfile.ZipFile, folder: str) -> Tuple[Dict[str, int], List[str]]:
+    """Ingest an archive's photos into `folder` a batch at a time.
+
+    Returns:
+        Tuple: How many entries had each outcome, and the messages of those that failed.
+
+    Raises:
+        ValueError: If the archive is over the import limits - Nothing is ingested then.
+    """
+    entries, skipped = archive_photos(archive, current_app.config.get('ARCHIVE_IMPORT_MAX_PHOTOS', 1000),
+                                      current_app.config.get('ARCHIVE_IMPORT_MAX_BYTES', 2 * 1024 ** 3))
+
+    counts = {outcome: 0 for outcome in _OUTCOME_CATEGORIES}
+    counts['skipped'] = skipped
+    failures = []
+    existing_files, screen = existing_upload_names(folder), upload_screen()
+    batch_size = current_app.config.get('UPLOAD_THREADS', 4)
+    for start in range(0, len(entries), batch_size):
+        batch = [FileStorage(archive.open(info), filename=os.path.basename(info.filename),
+                             content_type=mimetypes.guess_type(info.filename)[0])
+                 for info in entries[start:start + batch_size]]
+        try:
+            for outcome, message in ingest_uploads(batch, folder, existing_files, screen):
+                counts[outcome] += 1
+                if outcome == 'failed':
+                    failures.append(message)
+        finally:
+            for file in batch:
+                file.close()
+    return counts, failures
+
+
+@photos.route('/import', methods=['POST'])
+def import_archive():
+    """Ingest every photo in an uploaded ZIP archive as if it had been uploaded on its own.
+
+    Entries are read straight out of the archive a few at a time, so it is never extracted as a
+    whole. ARCHIVE_IMPORT_MAX_PHOTOS and ARCHIVE_IMPORT_MAX_BYTES (decompressed) bound what one
+    archive may hold. A summary is flashed, plus the first few failures.
+    """
+    if "username" not in session:
+        return redirect(url_for(AUTH_LOGIN))
 
-    flash('File(s) uploaded successfully!', 'success')
+    upload = request.files.get('archive')
+    if upload is None or not upload.filename:
+        flash('No archive to import - Please try again.', 'error')
+        return redirect('/upload')
+
+    folder = upload_folder()
+    try:
+        with closing(seekable_upload(upload.stream)) as stream, zipfile.ZipFile(stream) as archive:
+            counts, failures = import_archive_entries(archive, folder)
+    except (zipfile.BadZipFile, ValueError) as exc:
+        flash(f'{upload.filename}: Not imported - {exc}', 'error')
+        return redirect('/upload')
+
+    flash(f"{upload.filename}: Imported {counts['stored']} photos ({counts['duplicate']} already uploaded, "
+          f"{counts['near_duplicate']} near-duplicates not stored, {counts['skipped']} other files skipped, "
+          f"{counts['failed']} failed).", 'error' if counts['failed'] else 'success')
+    for message in failures[:5]:
+        flash(message, 'error')
     return redirect('/upload')
 
 
+def job_spool_folder() -> str:
+    """Folder public uploads wait in until a store_s3 job has pushed them to the bucket."""
+    spool_folder = (current_app.config.get('JOB_SPOOL_FOLDER')
+                    or os.path.join(current_app.instance_path, 'spool'))
+    os.makedirs(spool_folder, exist_ok=True)
+    return spool_folder
+
+
+def queue_post_upload_jobs(folder: str, stored: List[Tuple], private: bool):
+    """Queue the processing of freshly stored uploads, keyed by content so a retried upload isn't processed twice.
+
+    S3 keys also name the spooled file - A photo deleted from the bucket and uploaded again gets a new job.
+    """
+    queue = get_jobs()
+    if not private:
+        for file, result in stored:
+            queue.enqueue('store_s3', {'bucket': upload_bucket(), 'key': file.filename, 'path': result['path'],
+                                       'size': result['size'], 'sha256': result['sha256'],
+                                       'phash': result['phash'], 'similar_to': result['near_duplicate_of'],
+                                       'content_type': file.mimetype},
+                          key=f"store_s3:{file.filename}:{result['sha256']}:{os.path.basename(result['path'])}",
+                          then=['generate_variants'])
+        return
+
+    chain = ['strip_exif'] if current_app.config.get('STRIP_EXIF', False) else []
+    chain += ['extract_metadata', 'generate_variants']
+    for file, result in stored:
+        queue.enqueue(chain[0], {'folder': folder, 'name': file.filename},
+                      key=f"{chain[0]}:{folder}/{file.filename}:{result['sha256']}", then=chain[1:])
+    if stored:
+        queue.enqueue('evict', {'folder': folder})
+
+
 @photos.route('/sign_s3/')
 def sign_s3():
     """Generate a presigned URL for S3 photo uploads."""
     s3_bucket = os.environ.get('S3_BUCKET', current_app.config['S3_BUCKET'])
     file_name = secure_filename(request.args.get('file_name', ''))
     file_type = request.args.get('file_type', '')
-    s3_client = boto3.client('s3')
+    s3_client = get_listing(s3_bucket).client
     presigned_post = s3_client.generate_presigned_post(
         Bucket=s3_bucket,
         Key=file_name,
@@ -109,6 +563,143 @@ def sign_s3():
     return json.dumps({'data': presigned_post, 'url': f'https://{s3_bucket}.s3.amazonaws.com/{file_name}'})
 
 
+def direct_upload_tokens() -> URLSafeTimedSerializer:
+    """Signs the key (and multipart upload ID) handed out for each direct upload."""
+    return URLSafeTimedSerializer(current_app.secret_key, salt='direct-upload')
+
+
+@photos.route('/sign_s3/batch', methods=['POST'])
+def sign_s3_batch():
+    """Presign direct-to-S3 uploads for a batch of files, so their bytes never pass through a worker.
+
+    Expects JSON {"files": [{"name": ..., "type": ..., "size": ...}, ...]}. Each accepted file gets
+    a key, a token for /uploaded/complete and either a presigned POST or, at S3_MULTIPART_THRESHOLD
+    and above, a multipart upload with a presigned URL per part. Bucket CORS must expose ETag.
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    if "username" not in session:
+        return jsonify({'error': 'Authentication required.'}), 401
+    if current_app.config['PRIVATE']:
+        return jsonify({'error': 'Direct uploads are only available on public instances.'}), 400
+
+    files = (request.get_json(silent=True) or {}).get('files')
+    if not isinstance(files, list) or not files:
+        return jsonify({'error': 'Expected a non-empty list of files.'}), 400
+    if len(files) > current_app.config.get('S3_SIGN_BATCH_MAX', 100):
+        return jsonify({'error': 'Too many files in one batch.'}), 400
+
+    listing = get_listing(upload_bucket())
+    threshold = current_app.config.get('S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024)
+    expires = current_app.config.get('S3_PRESIGN_EXPIRES', 3600)
+    max_size = current_app.config.get('MAX_CONTENT_LENGTH')
+    tokens = direct_upload_tokens()
+
+    existing_files = set(get_s3_photos(upload_bucket()))
+    uploads = []
+    for file in files:
+        name = str(file.get('name', '')) if isinstance(file, dict) else ''
+        size = file.get('size') if isinstance(file, dict) else None
+        safe_name = secure_filename(name)
+        error = None
+        if not safe_name or not is_photo(safe_name):
+            error = 'Only gif, jpg, jpeg and png files are accepted.'
+        elif not isinstance(size, int) or size <= 0 or (max_size and size > max_size):
+            error = 'Missing or unsupported file size.'
+        if error:
+            flash(f'{name}: Skipped - {error}', 'error')
+            uploads.append({'name': name, 'error': error})
+            continue
+
+        key = resolve_duplicate_filename(safe_name, existing_files)
+        existing_files.add(key)
+        content_type = str(file.get('type') or 'application/octet-stream')
+
+        try:
+            if size < threshold:
+                upload = {'post': presign_post(listing, key, content_type, size, expires)}
+            else:
+                upload = {'multipart': presign_multipart(listing, key, content_type, size, threshold, expires)}
+        except (BotoCoreError, ClientError) as exc:
+            flash(f'{name}: Upload failed - {exc}', 'error')
+            uploads.append({'name': name, 'error': str(exc)})
+            continue
+
+        upload_id = upload.get('multipart', {}).get('upload_id')
+        uploads.append({'name': name, 'key': key,
+                        'token': tokens.dumps({'name': name, 'key': key, 'upload_id': upload_id}),
+                        **upload})
+
+    return jsonify({'uploads': uploads})
+
+
+@photos.route('/uploaded/complete', methods=['POST'])
+def complete_direct_uploads():
+    """Register files the browser uploaded straight to S3 and flash each one's outcome.
+
+    Like uploads through the app, they are deduplicated and screened for near-duplicates (see
+    register_s3_object) - By a register_s3 job with JOBS_ENABLED, otherwise before this returns.
+
+    Expects JSON {"uploads": [{"token": ..., "parts": [{"part_number": ..., "etag": ...}], "error": ...}]},
+    where parts are only sent for multipart uploads and error only for uploads that failed.
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    if "username" not in session:
+        return jsonify({'error': 'Authentication required.'}), 401
+
+    listing = get_listing(upload_bucket())
+    catalog = get_catalog()
+    use_jobs = current_app.config.get('JOBS_ENABLED', True)
+    screen = None if use_jobs else upload_screen()
+    tokens = direct_upload_tokens()
+    max_age = current_app.config.get('S3_PRESIGN_EXPIRES', 3600) * 2
+
+    uploaded, failed = [], []
+    for upload in (request.get_json(silent=True) or {}).get('uploads') or []:
+        try:
+            signed = tokens.loads(upload.get('token', ''), max_age=max_age)
+        except (AttributeError, BadSignature):
+            continue
+
+        name, key, upload_id = signed['name'], signed['key'], signed['upload_id']
+        try:
+            if upload.get('error'):
+                if upload_id:
+                    abort_multipart(listing, key, upload_id)
+                raise ValueError(upload['error'])
+            if upload_id:
+                complete_multipart(listing, key, upload_id, upload.get('parts') or [])
+            stored = record_uploaded(listing, key)
+            result = None if use_jobs else register_s3_object(listing, catalog, key, screen, get_s3_cache())
+        except (BotoCoreError, ClientError, KeyError, TypeError, ValueError) as exc:
+            flash(f'{name}: Upload failed - {exc}', 'error')
+            failed.append(name)
+            continue
+
+        if result is not None and result['duplicate_of']:
+            flash(f"{name}: Already uploaded as {result['duplicate_of']} - Not stored again.", 'success')
+            continue
+        if result is not None and result['rejected']:
+            flash(f"{name}: Looks just like {result['near_duplicate_of']} - Not stored.", 'error')
+            continue
+
+        if use_jobs:
+            get_jobs().enqueue('register_s3', {'bucket': listing.bucket_name, 'key': key},
+                               key=f"register_s3:{key}:{stored['etag']}", then=['generate_variants'])
+        else:
+            get_pipeline().submit_s3(listing, key)
+        uploaded.append(key)
+        renamed = f' as {key}' if key != name else ''
+        similar = f" (grouped with {result['near_duplicate_of']})" if result and result['near_duplicate_of'] else ''
+        flash(f'{name}: Uploaded successfully{renamed}{similar}!', 'success')
+
+    if uploaded:
+        catalog.bump_version()
+
+    return jsonify({'uploaded': uploaded, 'failed': failed})
+
+
 @photos.route('/new_folder', methods=['POST'])
 def create_new_folder():
     """Allow private instances to create new folders for uploads."""
@@ -121,38 +712,136 @@ def create_new_folder():
 
     try:
         os.mkdir(new_folder_path)
+        get_catalog().add_folder(new_folder)
         flash(f'New folder "{new_folder}" created!')
     except FileExistsError:
         flash('Folder already exists - No folder created.')
     return redirect('upload')
 
 
+def render_gallery_page(folder: str) -> str:
+    """Render a gallery page, reusing its rendered photo grid until storage changes."""
+    def load_grid() -> Dict:
+        photos, next_cursor = get_photo_page(folder)
+        return {'photos': photos, 'folder': folder, 'next_cursor': next_cursor}
+
+    folders = [] if current_app.config['S3_BUCKET'] else get_catalog().list_folders(folder)
+    grid = get_page_cache().fragment('/photos/_grid.html', folder, load_grid)
+
+    return render_template('/photos/gallery.html', grid=grid, folders=folders, folder=folder, auth=True)
+
+
 @photos.route('/gallery', methods=['GET'])
 def render_gallery():
-    """Render Puploader's photo gallery."""
+    """Render the first page of Puploader's photo gallery - Later pages are fetched from /api/photos."""
     if "username" not in session:
         return redirect(url_for(AUTH_LOGIN))
 
-    if current_app.config['S3_BUCKET']:
-        bucket_url = f"https://{current_app.config['S3_BUCKET']}.s3.amazonaws.com/"
-        photos = [f"{bucket_url}{photo}" for photo in get_s3_photos()]
-        folders = []
-    else:
-        folders = list_folders(current_app.config['UPLOAD_FOLDER'])
-        photos = [photo for photo in os.listdir(current_app.config['UPLOAD_FOLDER']) if '.' in photo]
-
-    return render_template('/photos/gallery.html', photos=photos, folders=folders, auth=True)
+    return cached_page('gallery', lambda: render_gallery_page(''))
 
 
 @photos.route('/gallery/<subfolder>', methods=['GET'])
 def render_subfolder_gallery(subfolder):
-    """Render photos from a specific subfolder."""
+    """Render the first page of photos from a specific subfolder."""
+    if '.' in subfolder or "username" not in session:
+        return redirect(url_for(AUTH_LOGIN))
+
+    safe_subfolder = secure_filename(subfolder)
+    return cached_page(f'gallery/{safe_subfolder}', lambda: render_gallery_page(safe_subfolder))
+
+
+def folder_export_entries(folder: str) -> Optional[List[ExportEntry]]:
+    """Every photo in `folder` (a prefix of the bucket on public instances), as entries for stream_zip.
+
+    S3 objects are streamed straight from the bucket rather than through the disk cache, so an
+    export doesn't evict the photos being viewed.
+
+    Returns:
+        List: The entries, by name - None if there is no such folder.
+    """
+    if current_app.config['S3_BUCKET']:
+        listing = get_listing(current_app.config['S3_BUCKET'])
+        listing.sync_version(get_catalog().version())
+        objects = [obj for obj in listing.list(f'{folder}/') if not obj['key'].startswith(S3_VARIANT_PREFIX)]
+        return [(obj['key'][len(folder) + 1:], obj['size'], obj['last_modified'],
+                 lambda obj=obj: open_object(listing, obj['key'], obj['etag']))
+                for obj in objects] or None
+
+    catalog = get_catalog()
+    directory = catalog.folder_path(folder)
+    if not os.path.isdir(directory):
+        return None
+    return [(photo['name'], photo['size'], photo['mtime'],
+             lambda name=photo['name']: open(os.path.join(directory, name), 'rb'))
+            for photo in sorted(catalog.list_photos(folder), key=lambda photo: photo['name'])]
+
+
+@photos.route('/gallery/<subfolder>/export', methods=['GET'])
+def export_folder(subfolder):
+    """Download a folder's photos as a ZIP archive, streamed while it is built - No temporary file is written."""
     if '.' in subfolder or "username" not in session:
         return redirect(url_for(AUTH_LOGIN))
 
     safe_subfolder = secure_filename(subfolder)
-    subfolder_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], safe_subfolder)
-    folders = list_folders(subfolder_dir)
-    photos = [f"{safe_subfolder}/{photo}" for photo in os.listdir(subfolder_dir) if '.' in photo]
+    entries = folder_export_entries(safe_subfolder)
+    if entries is None:
+        abort(404)
+
+    response = current_app.response_class(stream_zip(entries), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=f'{safe_subfolder}.zip')
+    response.cache_control.no_store = True
+    return response
 
-    return render_template('/photos/gallery.html', photos=photos, folders=folders, auth=True)
+
+@photos.route('/api/photos', methods=['GET'])
+def api_photos():
+    """Return one page of photos as JSON for the gallery's infinite scroll."""
+    if "username" not in session:
+        return jsonify({'error': 'Authentication required.'}), 401
+
+    folder = secure_filename(request.args.get('folder', ''))
+    limit = min(request.args.get('limit', current_app.config.get('GALLERY_PAGE_SIZE', 24), type=int), 100)
+
+    try:
+        page, next_cursor = get_photo_page(folder, request.args.get('cursor'), max(limit, 1))
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+
+    return jsonify({'photos': page, 'next_cursor': next_cursor})
+
+
+def photo_url(path: str) -> str:
+    """URL of a photo given its catalog path ('folder/name', or the key on public instances)."""
+    if current_app.config['S3_BUCKET']:
+        obj = get_listing(current_app.config['S3_BUCKET']).lookup(path)
+        if obj is not None and get_s3_cache() is not None:
+            return s3_object_url(obj)
+        return f"https://{current_app.config['S3_BUCKET']}.s3.amazonaws.com/{path}"
+
+    folder, _, name = path.rpartition('/')
+    photo = get_catalog().get_photo(folder, name)
+    return upload_url(path, upload_version(photo) if photo else None)
+
+
+@photos.route('/api/photos/similar', methods=['GET'])
+def api_similar_photos():
+    """Return the photos that look like `photo` (a path as returned by /api/photos), closest first.
+
+    `distance` is the largest Hamming distance between perceptual hashes to count as similar (0-64).
+    The photos grouped with it as near-duplicates at upload are listed under 'group'.
+    """
+    if "username" not in session:
+        return jsonify({'error': 'Authentication required.'}), 401
+
+    path = request.args.get('photo', '')
+    catalog = get_catalog()
+    phash = catalog.find_phash(path)
+    if phash is None:
+        return jsonify({'error': f'No perceptual hash for {path!r} - Unknown photo, or not hashed yet.'}), 404
+
+    distance = min(max(request.args.get('distance', current_app.config.get('NEAR_DUPLICATE_DISTANCE', 6),
+                                        type=int), 0), 64)
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    similar = [{'name': other, 'url': photo_url(other), 'distance': other_distance}
+               for other, other_distance in get_similarity().search(phash, distance, limit, exclude=path)]
+    return jsonify({'photo': path, 'similar': similar, 'group': catalog.similar_to(path)})
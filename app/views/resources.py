@@ -3,12 +3,20 @@ View responsible for resource generation (Charities, Orgs, etc.)
 """
 import json
 import os
-from flask import (Blueprint, redirect, render_template, request, session, url_for)
-from charitynav_api.charitynav_api import CharityNavAPI
-from petfinder_api.petfinder_api import PetFinder
+import threading
+from flask import (Blueprint, current_app, redirect, render_template, request, session, url_for)
+from api_client.api_client import ApiClient, ApiError, RateLimitError
+from caching.result_cache import get_result_cache
+from charitynav_api.charitynav_api import BASE_URL as CHARITYNAV_BASE_URL, CharityNavAPI
+from petfinder_api.petfinder_api import BASE_URL as PETFINDER_BASE_URL, PetFinder
 
 resources = Blueprint('resources', __name__, template_folder='templates')
 
+_petfinder_api = None
+_petfinder_lock = threading.Lock()
+_charitynav_api = None
+_charitynav_lock = threading.Lock()
+
 
 def load_api_config():
     """Load API configuration from a JSON file or environment variables."""
@@ -19,15 +27,28 @@ def load_api_config():
         return None
 
 
-def get_petfinder_api():
-    """Initialize and authenticate the PetFinder API client."""
-    config = load_api_config()
-    petfinder_key = config['PETFINDER_KEY'] if config else os.environ.get('PETFINDER_KEY')
-    petfinder_sec = config['PETFINDER_SEC'] if config else os.environ.get('PETFINDER_SEC')
+def build_api_client(prefix: str) -> ApiClient:
+    """Build an HTTP client for one external API from its `<prefix>_*` config values."""
+    config = current_app.config
+    return ApiClient(rate=config.get(f'{prefix}_RATE', 5),
+                     burst=config.get(f'{prefix}_BURST', 10),
+                     max_retries=config.get(f'{prefix}_MAX_RETRIES', 3),
+                     timeout=config.get(f'{prefix}_TIMEOUT', 10),
+                     name=prefix.lower())
 
-    petfinder_api = PetFinder(petfinder_key, petfinder_sec)
-    petfinder_api.auth()
-    return petfinder_api
+
+def get_petfinder_api():
+    """Return the process-wide PetFinder API client, creating it on first use."""
+    global _petfinder_api
+    with _petfinder_lock:
+        if _petfinder_api is None:
+            config = load_api_config()
+            petfinder_key = config['PETFINDER_KEY'] if config else os.environ.get('PETFINDER_KEY')
+            petfinder_sec = config['PETFINDER_SEC'] if config else os.environ.get('PETFINDER_SEC')
+            _petfinder_api = PetFinder(petfinder_key, petfinder_sec, client=build_api_client('PETFINDER'),
+                                       max_workers=current_app.config.get('PETFINDER_WORKERS', 4),
+                                       base_url=current_app.config.get('PETFINDER_BASE_URL', PETFINDER_BASE_URL))
+        return _petfinder_api
 
 
 def process_pets(pets):
@@ -48,11 +69,17 @@ def process_organizations(orgs):
 
 
 def get_charitynav_api():
-    """Initialize the Charity Navigator API client."""
-    config = load_api_config()
-    charitynav_id = config['CHARITY_APP_ID'] if config else os.environ.get('CHARITY_APP_ID')
-    charitynav_key = config['CHARITY_APP_KEY'] if config else os.environ.get('CHARITY_APP_KEY')
-    return CharityNavAPI(charitynav_id, charitynav_key)
+    """Return the process-wide Charity Navigator API client, creating it on first use."""
+    global _charitynav_api
+    with _charitynav_lock:
+        if _charitynav_api is None:
+            config = load_api_config()
+            charitynav_id = config['CHARITY_APP_ID'] if config else os.environ.get('CHARITY_APP_ID')
+            charitynav_key = config['CHARITY_APP_KEY'] if config else os.environ.get('CHARITY_APP_KEY')
+            _charitynav_api = CharityNavAPI(charitynav_id, charitynav_key,
+                                            client=build_api_client('CHARITYNAV'),
+                                            base_url=current_app.config.get('CHARITYNAV_BASE_URL', CHARITYNAV_BASE_URL))
+        return _charitynav_api
 
 
 def process_charities(charities):
@@ -68,22 +95,52 @@ def render_resources(resource):
     Route responsible for rendering pages related to animal-friendly resources.
     """
     location = request.form.get('inputZip')
+    # Several comma-separated ZIP codes are searched concurrently and merged.
+    locations = [zip_code.strip() for zip_code in (location or '').split(',') if zip_code.strip()] or [None]
+    zip_codes = ','.join(filter(None, locations))
     petfinder_api = get_petfinder_api()
+    cache = get_result_cache()
+    max_pages = current_app.config.get('PETFINDER_MAX_PAGES', 1)
 
-    if resource == 'local_pups':
-        pets = petfinder_api.get_animals(type='dog', location=location)
-        processed_pets = process_pets(pets)
-        return render_template('/resources/pups.html', pups=processed_pets, auth=('username' in session))
-
-    elif resource == 'local_orgs':
-        organizations = petfinder_api.get_organizations(location=location)
-        processed_orgs = process_organizations(organizations)
-        return render_template('/resources/organizations.html', organizations=processed_orgs, auth=('username' in session))
-
-    elif resource == 'charities':
-        charitynav_api = get_charitynav_api()
-        charities = charitynav_api.get_organizations(category_id=1, sort='RATING:DESC')[:10]
-        processed_charities = process_charities(charities)
-        return render_template('/resources/charities.html', charities=processed_charities)
+    try:
+        if resource == 'local_pups':
+            pets = cache.get_or_fetch('petfinder/animals', {'type': 'dog', 'location': zip_codes, 'pages': max_pages},
+                                      lambda: petfinder_api.search_animals(locations, types=['dog'],
+                                                                           max_pages=max_pages))
+            processed_pets = process_pets(pets)
+            return render_template('/resources/pups.html', pups=processed_pets, auth=('username' in session))
+
+        elif resource == 'local_orgs':
+            limit = current_app.config.get('PETFINDER_ORG_LIMIT', 10)
+            organizations = cache.get_or_fetch('petfinder/organizations',
+                                               {'location': zip_codes, 'limit': limit, 'pages': max_pages},
+                                               lambda: petfinder_api.search_organizations(locations, limit=limit,
+                                                                                          max_pages=max_pages))
+            processed_orgs = process_organizations(organizations)
+            return render_template('/resources/organizations.html', organizations=processed_orgs,
+                                   auth=('username' in session))
+
+        elif resource == 'charities':
+            charitynav_api = get_charitynav_api()
+            params = {'category_id': 1, 'sort': 'RATING:DESC', 'pageSize': 10}
+            charities = cache.get_or_fetch('charitynav/organizations', params,
+                                           lambda: charitynav_api.get_organizations(**params))[:10]
+            processed_charities = process_charities(charities)
+            return render_template('/resources/charities.html', charities=processed_charities)
+
+    except ApiError as exc:
+        print(f'Error loading {resource}: ', exc)
+        if isinstance(exc, RateLimitError):
+            message, status = 'This service is busy right now - Please try again in a minute.', 503
+        else:
+            message, status = 'This service is unavailable right now - Please try again later.', 502
+
+        templates = {'local_pups': ('/resources/pups.html', 'pups'),
+                     'local_orgs': ('/resources/organizations.html', 'organizations'),
+                     'charities': ('/resources/charities.html', 'charities')}
+        template, context_name = templates[resource]
+        response = render_template(template, message=message, auth=('username' in session), **{context_name: []})
+        headers = {'Retry-After': str(int(exc.retry_after))} if exc.retry_after else {}
+        return response, status, headers
 
     return redirect('/')
@@ -0,0 +1,198 @@
+"""
+Serves uploaded photos and Puploader's static assets with long-lived caching.
+
+Gallery URLs for uploads carry a `?v=` version derived from the photo's content hash, so a
+matching request can be cached as immutable - Anything else is served `no-cache` and revalidated
+against its ETag. Files are sent with conditional/range support and handed to the server's
+wsgi.file_wrapper (sendfile under gunicorn) or X-Sendfile when USE_X_SENDFILE is set.
+
+Public instances serve S3 photos the same way, from a local disk cache that is filled from
+the bucket on first read (S3_CACHE_MAX_BYTES = 0 links straight to the bucket instead). Their
+URLs are versioned by the object's ETag.
+
+Static assets (css, js, images) are served by WhiteNoise ahead of Flask.
+"""
+import mimetypes
+import os
+import time
+from typing import Dict, Optional, Tuple
+from flask import Blueprint, abort, current_app, request, send_file, send_from_directory, url_for
+from whitenoise import WhiteNoise
+from whitenoise.compress import Compressor
+from catalog.catalog import get_catalog, is_photo
+from catalog.eviction import get_eviction
+from imaging.thumbnails import S3_VARIANT_PREFIX, VARIANT_DIR, variant_names
+from storage.disk_cache import cached_s3_object, get_s3_cache
+from storage.s3 import get_listing
+
+uploads = Blueprint('uploads', __name__)
+
+# Longest first, so '.thumb.webp' is stripped before '.webp'.
+_VARIANT_SUFFIXES = sorted(variant_names('').values(), key=len, reverse=True)
+
+
+def upload_version(photo: Dict) -> str:
+    """Version token for a catalogued photo - Its content hash, or its size and mtime if unhashed.
+
+    Variants are rendered from the original, so they share its version.
+    """
+    if photo.get('sha256'):
+        return photo['sha256'][:16]
+    return f"{int(photo['mtime'] * 1000):x}-{photo['size']:x}"
+
+
+def upload_url(path: str, version: Optional[str] = None) -> str:
+    """URL for a file under UPLOAD_FOLDER, versioned so it can be cached indefinitely."""
+    return url_for('uploads.serve_upload', filename=path, v=version)
+
+
+def s3_object_url(obj: Dict) -> str:
+    """URL serving an S3 object (as listed) through the disk cache, versioned by its ETag."""
+    return url_for('uploads.serve_s3_object', key=obj['key'], v=obj['etag'][:16])
+
+
+def split_upload_path(path: str) -> Tuple[str, str, bool]:
+    """Split a path under UPLOAD_FOLDER into the catalog folder and name of the photo it belongs to.
+
+    Returns:
+        Tuple: Folder, original photo name and whether the path is one of its variants.
+
+    Raises:
+        ValueError: If the path names a hidden file or anything other than a photo or its variants.
+    """
+    parts = path.split('/')
+    variant = len(parts) >= 2 and parts[-2] == VARIANT_DIR
+    folder_parts = parts[:-2] if variant else parts[:-1]
+    if any(not part or part.startswith('.') for part in folder_parts + [parts[-1]]):
+        raise ValueError(f'Not an upload: {path}')
+
+    name = parts[-1]
+    if variant:
+        suffix = next((suffix for suffix in _VARIANT_SUFFIXES if name.endswith(suffix)), None)
+        if suffix is None:
+            raise ValueError(f'Not a photo variant: {path}')
+        name = name[:-len(suffix)]
+
+    if not is_photo(name):
+        raise ValueError(f'Not a photo: {path}')
+    return '/'.join(folder_parts), name, variant
+
+
+@uploads.route('/uploads/<path:filename>')
+def serve_upload(filename):
+    """Serve a photo (or one of its variants) from UPLOAD_FOLDER."""
+    try:
+        folder, name, variant = split_upload_path(filename)
+    except ValueError:
+        abort(404)
+
+    catalog = get_catalog()
+    photo = catalog.get_photo(folder, name)
+    immutable = photo is not None and request.args.get('v') == upload_version(photo)
+
+    # The content hash makes a strong ETag for originals - Variants use Werkzeug's mtime/size tag.
+    etag = photo['sha256'] if photo is not None and photo['sha256'] and not variant else True
+    response = send_from_directory(os.path.abspath(catalog.base_path), filename, etag=etag,
+                                   max_age=current_app.config.get('UPLOAD_MAX_AGE', 31536000) if immutable else None,
+                                   conditional=True)
+    if immutable:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+
+    if photo is not None and get_eviction().order == 'access':
+        catalog.touch(folder, name, time.time())
+
+    return response
+
+
+def _is_s3_photo_key(key: str) -> bool:
+    """Whether `key` names a photo or one of its variants - The only objects served from the bucket."""
+    if any(not part or part.startswith('.') for part in key.split('/')):
+        return False
+    if key.startswith(S3_VARIANT_PREFIX):
+        key = key[len(S3_VARIANT_PREFIX):]
+        suffix = next((suffix for suffix in _VARIANT_SUFFIXES if key.endswith(suffix)), None)
+        if suffix is None:
+            return False
+        key = key[:-len(suffix)]
+    return is_photo(key)
+
+
+@uploads.route('/s3/<path:key>')
+def serve_s3_object(key):
+    """Serve a photo (or one of its variants) from the S3 bucket through the local disk cache."""
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    cache = get_s3_cache()
+    if cache is None or not _is_s3_photo_key(key):
+        abort(404)
+
+    listing = get_listing(current_app.config['S3_BUCKET'])
+    listing.sync_version(get_catalog().version())
+    # A second attempt covers the object changing since it was listed, or being evicted before it is opened.
+    for attempt in range(2):
+        obj = listing.lookup(key)
+        if obj is None:
+            abort(404)
+
+        if request.if_none_match.contains(obj['etag']):
+            # Revalidations are answered from the listing alone, without touching the cache.
+            response = current_app.response_class(status=304)
+            response.set_etag(obj['etag'])
+            break
+
+        try:
+            response = send_file(cached_s3_object(cache, listing, obj), mimetype=mimetypes.guess_type(key)[0],
+                                 download_name=os.path.basename(key), etag=obj['etag'], conditional=True)
+            break
+        except (BotoCoreError, ClientError, FileNotFoundError) as exc:
+            if attempt:
+                print(f'Could not serve {key} from S3: {exc}')
+                abort(404)
+            listing.invalidate(key.rsplit('/', 1)[0] + '/' if '/' in key else '')
+
+    if request.args.get('v') == obj['etag'][:16]:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get('UPLOAD_MAX_AGE', 31536000)
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def _static_entries(app):
+    """Top-level entries of the static folder, leaving out UPLOAD_FOLDER if it lives there."""
+    upload_folder = os.path.realpath(app.config['UPLOAD_FOLDER'])
+    with os.scandir(app.static_folder) as entries:
+        return [entry for entry in entries if os.path.realpath(entry.path) != upload_folder]
+
+
+def init_static(app) -> WhiteNoise:
+    """Serve the static folder through WhiteNoise - Uploads keep going through serve_upload."""
+    static = WhiteNoise(app.wsgi_app, max_age=app.config.get('STATIC_MAX_AGE', 3600), autorefresh=app.debug)
+    for entry in _static_entries(app):
+        if entry.is_dir():
+            static.add_files(entry.path, prefix=f'{app.static_url_path}/{entry.name}/')
+        else:
+            static.add_file_to_dictionary(f'{app.static_url_path}/{entry.name}', entry.path)
+
+    app.wsgi_app = static
+    return static
+
+
+def compress_static(app) -> int:
+    """Write gzip (and brotli, if installed) copies of static assets for WhiteNoise to serve.
+
+    Images and other already-compressed formats are skipped, as are uploads.
+    """
+    compressor = Compressor(quiet=True)
+    compressed = 0
+    for entry in _static_entries(app):
+        paths = ([entry.path] if entry.is_file() else
+                 [os.path.join(root, name) for root, _, names in os.walk(entry.path) for name in names])
+        for path in paths:
+            if compressor.should_compress(path):
+                compressed += bool(compressor.compress(path))
+    return compressed
@@ -0,0 +1,54 @@
+"""
+Compare two bench/run_bench.py result files and flag regressions.
+
+Usage:
+    python bench/compare.py before.json after.json --tolerance 0.10
+
+Exits with status 1 if any scenario's p50/p99 latency grew, or its throughput fell, by more
+than the tolerance (or started returning errors).
+"""
+import argparse
+import json
+import sys
+from typing import List, Optional
+
+LOWER_IS_BETTER = ('p50_ms', 'p99_ms')
+HIGHER_IS_BETTER = ('throughput_rps',)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files.')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='Allowed relative change (0.10 = 10%%).')
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as baseline_file, open(args.candidate) as candidate_file:
+        baseline = json.load(baseline_file)['scenarios']
+        candidate = json.load(candidate_file)['scenarios']
+
+    regressions = []
+    print(f"{'scenario':<22} {'metric':<15} {'baseline':>10} {'candidate':>10} {'change':>8}")
+    for name in sorted(set(baseline) & set(candidate)):
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            before, after = baseline[name][metric], candidate[name][metric]
+            change = (after - before) / before if before else 0.0
+            worse = change > args.tolerance if metric in LOWER_IS_BETTER else change < -args.tolerance
+            flag = '  <-- regression' if worse else ''
+            print(f'{name:<22} {metric:<15} {before:>10.2f} {after:>10.2f} {change:>+8.1%}{flag}')
+            if worse:
+                regressions.append((name, metric))
+
+        if candidate[name]['errors'] > baseline[name]['errors']:
+            print(f"{name:<22} {'errors':<15} {baseline[name]['errors']:>10} {candidate[name]['errors']:>10}"
+                  f"{'':>8}  <-- regression")
+            regressions.append((name, 'errors'))
+
+    for name in sorted(set(baseline) ^ set(candidate)):
+        print(f'{name:<22} only present in {"baseline" if name in baseline else "candidate"}')
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,302 @@
+"""
+End-to-end benchmark for Puploader, run entirely against local stand-ins.
+
+Boots the app (run.py, i.e. create_app()) with mongomock (or a real mongod via --mongo-uri),
+a fake PetFinder/Charity Navigator server with injectable latency and, with --storage s3, moto's
+S3 server. The app is served over HTTP on a local port and each scenario is driven by
+--concurrency client threads.
+Throughput and latency percentiles are written as JSON for bench/compare.py.
+
+Usage:
+    python bench/run_bench.py --photos 500 --requests 200 --concurrency 8 --output before.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+import requests
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(ROOT, 'app')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import standins  # noqa: E402
+
+BENCH_USER = {'inputFirstName': 'Bench', 'inputUsername': 'bench@example.com',
+              'inputPassword': 'bench-password', 'confirmPassword': 'bench-password'}
+SCENARIOS = ['index', 'gallery', 'api_photos', 'uploaded', 'login',
+             'resources_pups', 'resources_orgs', 'resources_charities']
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--storage', choices=['local', 's3'], default='local',
+                        help='Serve photos from UPLOAD_FOLDER (private) or from a moto S3 bucket (public).')
+    parser.add_argument('--photos', type=int, default=200, help='Photos seeded before measuring.')
+    parser.add_argument('--folders', type=int, default=1, help='Folders the seeded photos are spread across.')
+    parser.add_argument('--requests', type=int, default=100, help='Measured requests per scenario.')
+    parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests per scenario.')
+    parser.add_argument('--concurrency', type=int, default=4, help='Client threads per scenario.')
+    parser.add_argument('--upload-files', type=int, default=5, help='Files per /uploaded request.')
+    parser.add_argument('--image-size', type=int, default=256, help='Width/height of generated images (px).')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='Delay added by the fake APIs (s).')
+    parser.add_argument('--api-rate', type=float,
+                        help='Outbound calls/s allowed to each fake API (the app default if unset).')
+    parser.add_argument('--cold-api', action='store_true', help='Disable the API result cache.')
+    parser.add_argument('--bcrypt-rounds', type=int, default=12, help='BCRYPT_ROUNDS for /login.')
+    parser.add_argument('--mongo-uri', help='Use this MongoDB instead of mongomock.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'Comma-separated subset of: {", ".join(SCENARIOS)}.')
+    parser.add_argument('--output', default='bench-results.json', help='Where to write the JSON results.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for generated images.')
+    return parser.parse_args(argv)
+
+
+def make_image(rng: random.Random, size: int) -> bytes:
+    """A JPEG of random blocks - Distinct per call, so uploads aren't deduplicated."""
+    image = Image.new('RGB', (size, size))
+    block = max(size // 8, 1)
+    for x in range(0, size, block):
+        for y in range(0, size, block):
+            image.paste((rng.randrange(256), rng.randrange(256), rng.randrange(256)), (x, y, x + block, y + block))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of `values`."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> Dict:
+    return {'requests': len(latencies),
+            'errors': errors,
+            'elapsed_s': round(elapsed, 4),
+            'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p90_ms': round(percentile(latencies, 90) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'max_ms': round(max(latencies) * 1000, 2) if latencies else 0.0}
+
+
+def run_scenario(make_session: Callable[[], requests.Session],
+                 send: Callable[[requests.Session, int], requests.Response],
+                 ok_statuses: set, total: int, warmup: int, concurrency: int) -> Dict:
+    """Send `warmup` + `total` requests from `concurrency` threads and summarize the measured ones."""
+    local = threading.local()
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def one(index: int, measured: bool):
+        if not hasattr(local, 'session'):
+            local.session = make_session()
+        started = time.perf_counter()
+        try:
+            failed = send(local.session, index).status_code not in ok_statuses
+        except requests.RequestException:
+            failed = True
+        took = time.perf_counter() - started
+        if measured:
+            with lock:
+                latencies.append(took)
+                errors.append(failed)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda index: one(index, False), range(warmup)))
+        started = time.perf_counter()
+        list(pool.map(lambda index: one(warmup + index, True), range(total)))
+        elapsed = time.perf_counter() - started
+
+    return summarize(latencies, sum(errors), elapsed)
+
+
+def seed_photos(args, rng: random.Random, upload_folder: str, bucket: Optional[str], endpoint_url: Optional[str]):
+    """Write the initial collection, before the app builds its catalog."""
+    folders = [''] + [f'folder{index}' for index in range(1, args.folders)]
+
+    if args.storage == 's3':
+        import boto3
+        s3_client = boto3.client('s3', endpoint_url=endpoint_url)
+        s3_client.create_bucket(Bucket=bucket)
+        for index in range(args.photos):
+            prefix = f'{folders[index % len(folders)]}/' if folders[index % len(folders)] else ''
+            s3_client.put_object(Bucket=bucket, Key=f'{prefix}seed{index}.jpg',
+                                 Body=make_image(rng, args.image_size), ContentType='image/jpeg')
+        return folders
+
+    for folder in folders:
+        os.makedirs(os.path.join(upload_folder, folder), exist_ok=True)
+    for index in range(args.photos):
+        with open(os.path.join(upload_folder, folders[index % len(folders)], f'seed{index}.jpg'), 'wb') as photo:
+            photo.write(make_image(rng, args.image_size))
+    return folders
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: Optional[List[str]] = None) -> Dict:
+    args = parse_args(argv)
+    args.output = os.path.abspath(args.output)
+    rng = random.Random(args.seed)
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+
+    workdir = tempfile.mkdtemp(prefix='puploader-bench-')
+    upload_folder = os.path.join(workdir, 'uploads')
+    os.makedirs(upload_folder)
+
+    api_server = standins.FakeApiServer(latency=args.api_latency).start()
+    s3_server = endpoint_url = bucket = None
+    if args.storage == 's3':
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        s3_server, endpoint_url = standins.start_s3_server()
+        bucket = 'puploader-bench'
+    if not args.mongo_uri:
+        standins.use_mongomock()
+
+    folders = seed_photos(args, rng, upload_folder, bucket, endpoint_url)
+
+    uploads_total = (args.requests + args.warmup) * args.upload_files if 'uploaded' in scenarios else 0
+    config = {'SECRET_KEY': 'bench',
+              'UPLOAD_FOLDER': upload_folder,
+              'UPLOAD_FOLDER_MAX': args.photos + uploads_total + 1,
+              'PRIVATE': args.storage == 'local',
+              'S3_BUCKET': bucket or '',
+              'S3_ENDPOINT_URL': endpoint_url,
+              'MONGODB_URI': args.mongo_uri or '',
+              'CATALOG_PATH': os.path.join(workdir, 'catalog.sqlite3'),
+              'API_CACHE_PATH': '' if args.cold_api else os.path.join(workdir, 'api_cache.sqlite3'),
+              # Uploads are queued into the workdir and left there - Job workers would compete with
+              # the timed requests, and their jobs would outlive the workdir.
+              'JOB_QUEUE_PATH': os.path.join(workdir, 'jobs.sqlite3'),
+              'JOB_SPOOL_FOLDER': os.path.join(workdir, 'spool'),
+              'JOB_WORKERS': 0,
+              # A fresh S3 disk cache, so each run starts cold.
+              'S3_CACHE_FOLDER': os.path.join(workdir, 's3-cache'),
+              'PETFINDER_BASE_URL': api_server.petfinder_url,
+              'CHARITYNAV_BASE_URL': api_server.charitynav_url,
+              'BCRYPT_ROUNDS': args.bcrypt_rounds,
+              'PASSWORD_MAX_PENDING': max(args.concurrency * 2, 16)}
+    if args.api_rate:
+        config.update(PETFINDER_RATE=args.api_rate, PETFINDER_BURST=args.api_rate,
+                      CHARITYNAV_RATE=args.api_rate, CHARITYNAV_BURST=args.api_rate)
+    if args.cold_api:
+        config.update(API_CACHE_TTL=0, API_CACHE_STALE_TTL=0)
+
+    # run.py builds the app at import time (as gunicorn does), so hand it the stand-in settings
+    # through a settings file rather than create_app(config).
+    settings_path = os.path.join(workdir, 'bench.cfg')
+    with open(settings_path, 'w') as settings:
+        settings.writelines(f'{name} = {value!r}\n' for name, value in config.items())
+    os.environ['PUPLOADER_SETTINGS'] = settings_path
+
+    os.chdir(APP_DIR)
+    sys.path.insert(0, APP_DIR)
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from run import app
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    requests.post(f'{base_url}/register', data=BENCH_USER, timeout=60)
+
+    def anonymous() -> requests.Session:
+        return requests.Session()
+
+    def logged_in() -> requests.Session:
+        session = requests.Session()
+        session.post(f'{base_url}/login', data=BENCH_USER, allow_redirects=False, timeout=60)
+        return session
+
+    upload_payloads = {}
+    if 'uploaded' in scenarios:
+        upload_payloads = {index: [make_image(rng, args.image_size) for _ in range(args.upload_files)]
+                           for index in range(args.requests + args.warmup)}
+
+    def upload(session: requests.Session, index: int) -> requests.Response:
+        files = [('files', (f'bench{index}_{number}.jpg', data, 'image/jpeg'))
+                 for number, data in enumerate(upload_payloads[index])]
+        return session.post(f'{base_url}/uploaded', files=files, allow_redirects=False, timeout=120)
+
+    def zip_code(index: int) -> str:
+        return f'{10000 + index % 20:05d}'
+
+    definitions = {
+        'index': (logged_in, lambda session, index: session.get(f'{base_url}/', timeout=60), {200}),
+        'gallery': (logged_in, lambda session, index: session.get(
+            f'{base_url}/gallery' + (f'/{folders[index % len(folders)]}' if folders[index % len(folders)] else ''),
+            timeout=60), {200}),
+        'api_photos': (logged_in, lambda session, index: session.get(f'{base_url}/api/photos', timeout=60), {200}),
+        'uploaded': (logged_in, upload, {302}),
+        'login': (anonymous, lambda session, index: session.post(
+            f'{base_url}/login', data=BENCH_USER, allow_redirects=False, timeout=60), {302}),
+        'resources_pups': (anonymous, lambda session, index: session.post(
+            f'{base_url}/resources/local_pups', data={'inputZip': zip_code(index)}, timeout=60), {200}),
+        'resources_orgs': (anonymous, lambda session, index: session.post(
+            f'{base_url}/resources/local_orgs', data={'inputZip': zip_code(index)}, timeout=60), {200}),
+        'resources_charities': (anonymous, lambda session, index: session.post(
+            f'{base_url}/resources/charities', timeout=60), {200}),
+    }
+
+    results = {'meta': {'commit': git_commit(),
+                        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                        'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'args': vars(args)},
+               'scenarios': {}}
+    try:
+        for name in scenarios:
+            make_session, send, ok_statuses = definitions[name]
+            calls_before = api_server.calls
+            summary = run_scenario(make_session, send, ok_statuses, args.requests, args.warmup, args.concurrency)
+            summary['upstream_api_calls'] = api_server.calls - calls_before
+            results['scenarios'][name] = summary
+            print(f"{name:<22} {summary['throughput_rps']:>9.1f} req/s  p50 {summary['p50_ms']:>8.1f} ms  "
+                  f"p99 {summary['p99_ms']:>8.1f} ms  errors {summary['errors']}")
+    finally:
+        server.shutdown()
+        app.extensions['variants'].shutdown()
+        api_server.stop()
+        if s3_server is not None:
+            s3_server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f'Results written to {args.output}')
+    return results
+
+
+if __name__ == '__main__':
+    main()
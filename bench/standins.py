@@ -0,0 +1,154 @@
+"""
+Local stand-ins for Puploader's external dependencies, used by the benchmark harness.
+
+- FakeApiServer answers PetFinder and Charity Navigator requests with canned data after an
+  injectable delay.
+- start_s3_server runs moto's S3 implementation over HTTP.
+- use_mongomock routes every pymongo.MongoClient to one shared in-memory mongomock client.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def _animal(animal_id: int, location: str) -> dict:
+    return {'id': animal_id,
+            'name': f'Pup {animal_id}',
+            'url': f'https://example.com/pets/{animal_id}',
+            'description': 'A very good dog.',
+            'gender': 'Female', 'age': 'Young', 'size': 'Medium',
+            'breeds': {'primary': 'Labrador Retriever'},
+            'photos': [{'medium': f'https://example.com/pets/{animal_id}.jpg'}],
+            'contact': {'email': 'shelter@example.com', 'phone': '555-0100',
+                        'address': {'address1': '1 Main St', 'city': 'Springfield', 'postcode': location}}}
+
+
+def _organization(org_id: str, location: str) -> dict:
+    return {'id': org_id,
+            'name': f'Shelter {org_id}',
+            'url': f'https://example.com/orgs/{org_id}',
+            'email': 'shelter@example.com', 'phone': '555-0100',
+            'mission_statement': 'Finding dogs homes.',
+            'address': {'address1': '1 Main St', 'city': 'Springfield', 'postcode': location},
+            'hours': {'monday': '9-5', 'tuesday': '9-5'},
+            'photos': [], 'social_media': {}}
+
+
+def _charity(index: int) -> dict:
+    return {'charityName': f'Charity {index}',
+            'mission': 'Helping animals.', 'tagLine': 'Paws first.',
+            'websiteURL': 'https://example.com',
+            'mailingAddress': {'streetAddress1': '1 Main St', 'city': 'Springfield'},
+            'category': {'image': ''},
+            'organization': {'ein': f'{index:09d}'},
+            'irsClassification': {'deductibility': 'Contributions are deductible'}}
+
+
+class FakeApiServer:
+    """
+    Threaded HTTP server imitating the PetFinder (/petfinder/v2) and Charity Navigator
+    (/charitynav/v2) APIs. Every request waits `latency` seconds before it is answered.
+    """
+
+    def __init__(self, latency: float = 0.0, results_per_page: int = 20, total_pages: int = 3):
+        self.latency = latency
+        self.results_per_page = results_per_page
+        self.total_pages = total_pages
+        self.calls = 0
+
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    @property
+    def petfinder_url(self) -> str:
+        return f'{self.url}/petfinder/v2'
+
+    @property
+    def charitynav_url(self) -> str:
+        return f'{self.url}/charitynav/v2'
+
+    def start(self) -> 'FakeApiServer':
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _json(self, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _count(self):
+                with stand_in._lock:
+                    stand_in.calls += 1
+                time.sleep(stand_in.latency)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self._count()
+                self._json({'token_type': 'Bearer', 'access_token': 'bench-token', 'expires_in': 3600})
+
+            def do_GET(self):
+                self._count()
+                url = urlparse(self.path)
+                query = {name: values[0] for name, values in parse_qs(url.query).items()}
+                page = int(query.get('page', 1))
+                location = query.get('location', '00000')
+                count = int(query.get('limit', stand_in.results_per_page))
+                pagination = {'current_page': page, 'total_pages': stand_in.total_pages}
+
+                if url.path.startswith('/petfinder/v2/animals'):
+                    return self._json({'animals': [_animal(page * 1000 + index, location) for index in range(count)],
+                                       'pagination': pagination})
+                if url.path.startswith('/petfinder/v2/organizations'):
+                    return self._json({'organizations': [_organization(f'{location}-{page}-{index}', location)
+                                                         for index in range(count)],
+                                       'pagination': pagination})
+                if url.path.startswith('/charitynav/v2/organizations'):
+                    return self._json([_charity(index) for index in range(int(query.get('pageSize', 10)))])
+
+                self.send_error(404)
+
+        return Handler
+
+
+def start_s3_server():
+    """Start moto's S3 server on a free local port, returning (server, endpoint_url)."""
+    import logging
+    from moto.server import ThreadedMotoServer
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    return server, f'http://{host}:{port}'
+
+
+def use_mongomock():
+    """Make every pymongo.MongoClient share one in-memory mongomock client."""
+    import mongomock
+    import pymongo
+
+    client = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *args, **kwargs: client
+    return client
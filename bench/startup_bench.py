@@ -0,0 +1,201 @@
+"""
+Startup-time and memory benchmark for Puploader under gunicorn.
+
+Measures, in fresh interpreters, how long importing the app module and running create_app()
+take, then boots gunicorn with app/gunicorn_config.py with and without preload_app and records
+the time until every worker is serving plus each process's RSS, PSS (proportional set size -
+shared pages split between the processes sharing them) and USS (pages private to the process),
+read from /proc/<pid>/smaps_rollup. Linux only. Results are written as JSON.
+
+Usage:
+    python bench/startup_bench.py --workers 4 --runs 5 --output startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(ROOT, 'app')
+GUNICORN_CONFIG = os.path.join(APP_DIR, 'gunicorn_config.py')
+
+_IMPORT_PROBE = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+created = time.perf_counter()
+print(json.dumps({'import_ms': (imported - started) * 1000, 'create_app_ms': (created - imported) * 1000}))
+"""
+
+# Wraps app/gunicorn_config.py, adding a marker file per worker once it has loaded the app.
+_WRAPPER_CONFIG = """
+import os
+_base = {{'__file__': {config!r}}}
+exec(compile(open({config!r}).read(), {config!r}, 'exec'), _base)
+globals().update({{name: value for name, value in _base.items() if not name.startswith('__')}})
+
+
+def post_worker_init(worker):
+    _base['post_worker_init'](worker)
+    open(os.path.join({ready_dir!r}, str(os.getpid())), 'w').close()
+"""
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4, help='Gunicorn worker processes.')
+    parser.add_argument('--runs', type=int, default=3, help='Repetitions of each measurement.')
+    parser.add_argument('--warm-requests', type=int, default=50,
+                        help='Requests sent before memory is measured again.')
+    parser.add_argument('--mongo-uri', default='mongodb://127.0.0.1:1/',
+                        help='MongoDB the app points at - The pages requested never query it.')
+    parser.add_argument('--output', default='startup.json', help='Where to write the JSON results.')
+    return parser.parse_args(argv)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def memory(pid: int) -> Dict[str, float]:
+    """RSS, PSS and USS of a process, in MiB."""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as rollup:
+        for line in rollup:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    uss = fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    return {'rss_mb': fields.get('Rss', 0) / 1024, 'pss_mb': fields.get('Pss', 0) / 1024, 'uss_mb': uss / 1024}
+
+
+def children(pid: int) -> List[int]:
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as listing:
+            return [int(child) for child in listing.read().split()]
+    except FileNotFoundError:
+        return []
+
+
+def summarize_memory(master: int, workers: List[int]) -> Dict:
+    per_worker = [memory(pid) for pid in workers]
+    return {'master': memory(master),
+            'workers': per_worker,
+            'worker_mean': {name: statistics.mean(sample[name] for sample in per_worker)
+                            for name in ('rss_mb', 'pss_mb', 'uss_mb')},
+            'total_pss_mb': memory(master)['pss_mb'] + sum(sample['pss_mb'] for sample in per_worker)}
+
+
+def measure_imports(env: Dict[str, str], runs: int) -> Dict:
+    samples = [json.loads(subprocess.check_output([sys.executable, '-c', _IMPORT_PROBE], cwd=APP_DIR, env=env,
+                                                  text=True).strip().splitlines()[-1])
+               for _ in range(runs)]
+    return {name: statistics.median(sample[name] for sample in samples) for name in ('import_ms', 'create_app_ms')}
+
+
+def measure_gunicorn(env: Dict[str, str], workdir: str, workers: int, preload: bool, warm_requests: int) -> Dict:
+    ready_dir = tempfile.mkdtemp(dir=workdir)
+    wrapper = os.path.join(workdir, 'gunicorn_bench.py')
+    with open(wrapper, 'w') as config:
+        config.write(_WRAPPER_CONFIG.format(config=GUNICORN_CONFIG, ready_dir=ready_dir))
+
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    env = {**env, 'GUNICORN_PRELOAD': '1' if preload else '0',
+           'PROMETHEUS_MULTIPROC_DIR': os.path.join(workdir, f'metrics-{port}')}
+    started = time.perf_counter()
+    master = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', wrapper, '--chdir', APP_DIR,
+                               '-b', f'127.0.0.1:{port}', '-w', str(workers), 'run:app'],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while len(os.listdir(ready_dir)) < workers:
+            if master.poll() is not None:
+                raise RuntimeError('gunicorn exited during startup.')
+            if time.perf_counter() - started > 120:
+                raise RuntimeError('Workers did not start within 120s.')
+            time.sleep(0.01)
+        while True:
+            try:
+                if requests.get(f'{url}/about', timeout=5).status_code == 200:
+                    break
+            except requests.ConnectionError:
+                time.sleep(0.01)
+        ready_ms = (time.perf_counter() - started) * 1000
+
+        pids = children(master.pid)
+        result = {'preload': preload, 'ready_ms': ready_ms, 'cold': summarize_memory(master.pid, pids)}
+
+        with requests.Session() as session:
+            for index in range(warm_requests):
+                session.get(f'{url}/about' if index % 2 else f'{url}/', timeout=30)
+        result['warm'] = summarize_memory(master.pid, pids)
+        return result
+    finally:
+        master.terminate()
+        master.wait()
+
+
+def main(argv: Optional[List[str]] = None) -> Dict:
+    args = parse_args(argv)
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        raise SystemExit('This benchmark reads /proc/<pid>/smaps_rollup and only runs on Linux.')
+
+    workdir = tempfile.mkdtemp(prefix='puploader-startup-')
+    config = {'SECRET_KEY': 'bench',
+              'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+              'PRIVATE': True,
+              'S3_BUCKET': '',
+              'MONGODB_URI': args.mongo_uri,
+              'MONGO_ENSURE_INDEXES': False,
+              'CATALOG_PATH': os.path.join(workdir, 'catalog.sqlite3'),
+              'API_CACHE_PATH': os.path.join(workdir, 'api_cache.sqlite3'),
+              'JOB_QUEUE_PATH': os.path.join(workdir, 'jobs.sqlite3'),
+              'JOB_WORKERS': 0}
+    settings_path = os.path.join(workdir, 'startup.cfg')
+    with open(settings_path, 'w') as settings:
+        settings.writelines(f'{name} = {value!r}\n' for name, value in config.items())
+    env = {**os.environ, 'PUPLOADER_SETTINGS': settings_path}
+
+    results = {'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                        'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'args': vars(args)}}
+    try:
+        results['imports'] = measure_imports(env, args.runs)
+        print(f"import app {results['imports']['import_ms']:.0f} ms  "
+              f"create_app {results['imports']['create_app_ms']:.0f} ms")
+
+        for preload in (False, True):
+            runs = [measure_gunicorn(env, workdir, args.workers, preload, args.warm_requests)
+                    for _ in range(args.runs)]
+            name = 'preload' if preload else 'no_preload'
+            results[name] = {'ready_ms': statistics.median(run['ready_ms'] for run in runs), 'runs': runs}
+            last = runs[-1]
+            print(f"{name:<11} ready {results[name]['ready_ms']:>7.0f} ms  "
+                  f"worker RSS {last['warm']['worker_mean']['rss_mb']:.1f} MiB  "
+                  f"USS {last['warm']['worker_mean']['uss_mb']:.1f} MiB  "
+                  f"total PSS {last['warm']['total_pss_mb']:.1f} MiB")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f'Results written to {args.output}')
+    return results
+
+
+if __name__ == '__main__':
+    main()
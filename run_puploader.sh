@@ -1,2 +1,2 @@
 #!/bin/bash
-exec gunicorn --chdir app -b 0.0.0.0:5000 run:app
\ No newline at end of file
+exec gunicorn -c app/gunicorn_config.py --chdir app -b 0.0.0.0:5000 run:app
\ No newline at end of file